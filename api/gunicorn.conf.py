@@ -0,0 +1,57 @@
+"""
+gunicorn settings, read from the working directory when the server starts.
+
+With PRELOAD_MODELS the app and the models are loaded once in the master
+process, before the workers are forked, so the workers share that memory
+instead of each loading their own. Each worker logs its memory as it starts
+and again after warm-up.
+"""
+import gc
+import os
+import threading
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+
+from django.conf import settings  # noqa: E402
+
+bind = f"0.0.0.0:{os.getenv('PORT', 8080)}"
+workers = int(os.getenv("WORKER_COUNT", 1))
+threads = settings.WORKER_THREADS
+timeout = 0
+preload_app = settings.PRELOAD_MODELS
+
+
+def on_starting(server):
+    from helpers import metrics
+
+    # Metrics of earlier runs' processes would otherwise count
+    metrics.REGISTRY.clear()
+
+
+def when_ready(server):
+    if not settings.PRELOAD_MODELS:
+        return
+    from karaoke import shared_models, warmup
+
+    # Download missing models once, rather than in every worker at once
+    warmup.prepare_models(warm=False)
+    loaded = shared_models.preload()
+    server.log.info(f"Preloaded {loaded / 2**20:.0f} MiB of models")
+    # Logged only: a gauge from the master, which never exits, would count forever
+    shared_models.report_memory("before forking", export=False)
+    # Keep the collector from touching, and so copying, the master's objects
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    from karaoke import shared_models, warmup
+
+    shared_models.report_memory("started")
+    if not settings.WARM_UP_ON_BOOT:
+        return
+
+    def warm_up():
+        warmup.prepare_models()
+        shared_models.report_memory("warmed up")
+
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
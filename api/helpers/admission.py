@@ -0,0 +1,215 @@
+"""
+Limit how much CPU-heavy work runs at once, across every worker process.
+
+Separation, rendering and YouTube downloads each have a number of slots. A
+request takes a free slot, or waits in a bounded queue for one. When the queue
+is full, or the wait runs past ADMISSION_QUEUE_TIMEOUT_SECONDS, the request is
+turned away with 429 and a Retry-After. A few requests at full speed beat many
+requests that all time out.
+
+Slots and queue places are lock files under ADMISSION_DIR held with flock, so
+they are shared by gunicorn's workers and freed by the kernel if a worker dies.
+The queue is shared by all kinds of work.
+
+Requests hold one of their worker's WORKER_THREADS threads while they work or
+wait, so each worker also admits at most ADMISSION_RESERVED_THREADS fewer
+requests than it has threads. The rest stay free for health checks, progress
+and job polling.
+"""
+import fcntl
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import structlog
+from django.conf import settings
+
+from helpers import metrics
+
+logger = structlog.get_logger(__name__)
+
+SEPARATION = "separation"
+RENDER = "render"
+YOUTUBE = "youtube"
+
+# Cores and memory one unit of work uses, for choosing limits automatically.
+# Separation runs ONNX inference on several threads, rendering is one x264
+# encode and downloading mostly waits on the network.
+COSTS = {
+    SEPARATION: (4, 2048 * 1024 * 1024),
+    RENDER: (2, 512 * 1024 * 1024),
+    YOUTUBE: (0.5, 256 * 1024 * 1024),
+}
+POLL_SECONDS = 0.1
+# Retry-After before any work has finished to learn from
+DEFAULT_WORK_SECONDS = 30
+MAX_RETRY_AFTER = 3600
+
+_limiters: dict[str, "Limiter"] = {}
+_limiters_lock = threading.Lock()
+# Request threads this process lets admitted and queued requests hold
+_request_threads: threading.Semaphore | None = None
+
+REJECTED = metrics.Counter(
+    "tuul_admission_rejected_total", "Requests turned away with 429.", ("kind",)
+)
+WAITING = metrics.Gauge(
+    "tuul_admission_waiting", "Requests waiting for a slot.", ("kind",)
+)
+
+
+class Overloaded(Exception):
+    """Raised when there's no slot or queue place for more work."""
+
+    def __init__(self, kind: str, retry_after: int):
+        super().__init__(f"Too much {kind} work in progress, try again later.")
+        self.kind = kind
+        self.retry_after = retry_after
+
+
+class Limiter:
+    def __init__(
+        self,
+        directory: Path,
+        kind: str,
+        limit: int,
+        queue_size: int,
+        queue_timeout: float,
+        threads: threading.Semaphore | None = None,
+    ):
+        """threads, if given, bounds the queued requests plus those at work in
+        this process, and is shared by the limiters of every kind."""
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        self.kind = kind
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self._threads = threads
+        self._slots = [directory / f"{kind}-{i}.lock" for i in range(limit)]
+        self._queue = [directory / f"queued-{i}.lock" for i in range(queue_size)]
+        # Average seconds a slot is held, for Retry-After
+        self._work_seconds = float(DEFAULT_WORK_SECONDS)
+
+    @contextmanager
+    def admit(self, queue: bool = True) -> Iterator[None]:
+        """Run the block in a slot, waiting for one in the queue if all are taken.
+
+        Raise Overloaded if the queue is full or the wait times out. Without
+        queue, wait as long as it takes instead; background jobs do that, as
+        they are already bounded by the job queue, and don't take a request
+        thread.
+        """
+        threads = self._threads if queue else None
+        if threads is not None and not threads.acquire(blocking=False):
+            raise self._overloaded()
+        try:
+            fd = _lock_any(self._slots)
+            if fd is None:
+                fd = self._wait(queue)
+            start = time.monotonic()
+            try:
+                yield
+            finally:
+                _unlock(fd)
+                self._work_seconds = 0.8 * self._work_seconds + 0.2 * (
+                    time.monotonic() - start
+                )
+        finally:
+            if threads is not None:
+                threads.release()
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog has probably cleared."""
+        backlog = self._work_seconds * (self.limit + self.queue_size) / self.limit
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(backlog)))
+
+    def _wait(self, queue: bool) -> int:
+        queue_fd = None
+        if queue:
+            queue_fd = _lock_any(self._queue)
+            if queue_fd is None:
+                raise self._overloaded()
+        deadline = time.monotonic() + self.queue_timeout if queue else None
+        try:
+            with WAITING.track_in_progress(kind=self.kind):
+                while True:
+                    time.sleep(POLL_SECONDS)
+                    fd = _lock_any(self._slots)
+                    if fd is not None:
+                        return fd
+                    if deadline and time.monotonic() > deadline:
+                        raise self._overloaded()
+        finally:
+            if queue_fd is not None:
+                _unlock(queue_fd)
+
+    def _overloaded(self) -> Overloaded:
+        logger.warning("admission_rejected", kind=self.kind)
+        REJECTED.inc(kind=self.kind)
+        return Overloaded(self.kind, self.retry_after())
+
+
+def _lock_any(paths: list[Path]) -> int | None:
+    """Lock the first free file of paths. Return its descriptor, or None if all are locked."""
+    for path in paths:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            os.close(fd)
+    return None
+
+
+def _unlock(fd: int) -> None:
+    # Closing the descriptor releases its lock
+    os.close(fd)
+
+
+def host_resources() -> tuple[int, int]:
+    """Return the cores and bytes of memory this process may use."""
+    cores = len(os.sched_getaffinity(0))
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    # Containers are usually limited by their cgroup, not the host
+    try:
+        cgroup_memory = Path("/sys/fs/cgroup/memory.max").read_text().strip()
+        if cgroup_memory != "max":
+            memory = min(memory, int(cgroup_memory))
+    except (OSError, ValueError):
+        pass
+    return cores, memory
+
+
+def auto_limit(kind: str, cores: int, memory: int) -> int:
+    """How many of kind fit in cores and memory at once."""
+    cores_each, memory_each = COSTS[kind]
+    return max(1, min(int(cores / cores_each), memory // memory_each))
+
+
+def get_limiter(kind: str) -> Limiter:
+    """Return the limiter for kind, sized by settings or by this host's resources."""
+    global _request_threads
+    with _limiters_lock:
+        if _request_threads is None:
+            _request_threads = threading.Semaphore(
+                max(1, settings.WORKER_THREADS - settings.ADMISSION_RESERVED_THREADS)
+            )
+        if kind not in _limiters:
+            limit = settings.ADMISSION_LIMITS[kind]
+            if not limit:
+                limit = auto_limit(kind, *host_resources())
+            logger.info("admission_limit", kind=kind, limit=limit)
+            _limiters[kind] = Limiter(
+                settings.ADMISSION_DIR,
+                kind,
+                limit=limit,
+                queue_size=settings.ADMISSION_QUEUE_SIZE,
+                queue_timeout=settings.ADMISSION_QUEUE_TIMEOUT_SECONDS,
+                threads=_request_threads,
+            )
+        return _limiters[kind]
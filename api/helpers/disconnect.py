@@ -0,0 +1,30 @@
+"""
+Notice when a client hangs up before its response is ready.
+
+gunicorn passes the client's socket to the app as gunicorn.socket. Once the
+request has been read, the socket only becomes readable again when the client
+closes it (or pipelines another request, which peeking tells apart). Other
+servers don't expose the socket, so there a request never looks abandoned.
+"""
+import select
+import socket
+from typing import Callable
+
+from django.http import HttpRequest
+
+
+def client_disconnected(request: HttpRequest) -> Callable[[], bool]:
+    """Return a function that says whether request's client has gone away."""
+    sock = request.META.get("gunicorn.socket")
+    if sock is None:
+        return lambda: False
+
+    def disconnected() -> bool:
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+        except (OSError, ValueError):
+            # Reset by the client, or already closed
+            return True
+
+    return disconnected
@@ -0,0 +1,132 @@
+"""
+File responses that the WSGI server can send with sendfile, with support for
+HTTP Range requests so interrupted downloads can be resumed.
+
+Job results are served this way. The synchronous endpoints stream their zips
+as they're made, so there is no file to serve a range of, and clients that
+need to resume use the job endpoints instead.
+"""
+import os
+import re
+from pathlib import Path
+from typing import Callable
+
+from django.http import FileResponse, HttpResponse
+from django.utils.http import http_date
+from rest_framework.request import Request
+from rest_framework import status
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class FileRange:
+    """
+    File-like view of length bytes of f starting at start.
+
+    It keeps f's real file descriptor, positioned at start, so a server that
+    uses sendfile (like gunicorn) copies the bytes in the kernel and stops at
+    the response's Content-Length. Servers that read instead never get past the
+    end of the range.
+    """
+
+    def __init__(self, f, start: int, length: int, on_close: Callable[[], None]):
+        self._file = f
+        self._remaining = length
+        self._on_close = on_close
+        f.seek(start)
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self) -> int:
+        return self._file.fileno()
+
+    def close(self) -> None:
+        try:
+            self._file.close()
+        finally:
+            self._on_close()
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """Parse a single byte range. Return (start, end) with end inclusive.
+
+    Return None if the header should be ignored, which is allowed for anything
+    we don't support such as multiple ranges. Raise ValueError if the range
+    can't be satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end
+
+
+def file_response(
+    request: Request,
+    path: Path,
+    filename: str | None = None,
+    as_attachment: bool = True,
+    on_close: Callable[[], None] = lambda: None,
+) -> HttpResponse:
+    """Return a response that sends the file at path.
+
+    on_close is called once the response is finished with the file, whether or
+    not it was sent completely.
+    """
+    f = path.open("rb")
+    try:
+        stat = os.fstat(f.fileno())
+    except BaseException:
+        f.close()
+        on_close()
+        raise
+    size = stat.st_size
+    etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+    last_modified = http_date(stat.st_mtime)
+
+    byte_range = None
+    range_header = request.META.get("HTTP_RANGE")
+    if_range = request.META.get("HTTP_IF_RANGE")
+    if range_header and (not if_range or if_range in (etag, last_modified)):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            f.close()
+            on_close()
+            response = HttpResponse(
+                status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+            )
+            response["Content-Range"] = f"bytes */{size}"
+            return response
+
+    start, end = byte_range or (0, size - 1)
+    response = FileResponse(
+        FileRange(f, start, end - start + 1, on_close),
+        as_attachment=as_attachment,
+        filename=filename or path.name,
+    )
+    response["Content-Length"] = end - start + 1
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    response["Last-Modified"] = last_modified
+    if byte_range:
+        response.status_code = status.HTTP_206_PARTIAL_CONTENT
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return response
@@ -0,0 +1,191 @@
+"""
+Background jobs for work that takes too long to do inside a request.
+
+Each job gets a directory under the jobs root holding its inputs, its result
+and a job.json describing its state. Jobs run on a bounded thread pool in the
+process that submitted them, but because the state lives on disk any worker
+process can answer status and result requests. Finished jobs are deleted once
+they are older than the TTL.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable
+
+import structlog
+from django.conf import settings
+
+from helpers import metrics
+
+logger = structlog.get_logger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_job_manager: "JobManager | None" = None
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    status: str
+    created_at: float
+    pid: int
+    finished_at: float | None = None
+    result_name: str | None = None
+    error: str | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+
+class JobManager:
+    def __init__(self, root: Path, max_workers: int, max_queued: int, ttl: float):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.ttl = ttl
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="job"
+        )
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def job_dir(self, job: Job) -> Path:
+        return self.root / job.id
+
+    def create(self, kind: str) -> Job:
+        """Create a job and its directory. Its inputs should be written there before start()."""
+        self.expire()
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queued:
+                raise QueueFull(f"{self._pending} jobs already pending")
+            self._pending += 1
+        job = Job(
+            id=uuid.uuid4().hex,
+            kind=kind,
+            status=QUEUED,
+            created_at=time.time(),
+            pid=os.getpid(),
+        )
+        self.job_dir(job).mkdir()
+        self._save(job)
+        metrics.JOBS.inc(status=QUEUED)
+        return job
+
+    def start(self, job: Job, work: Callable[[], Path]) -> None:
+        """Run work in the background. It should return the path of the job's result."""
+        self._executor.submit(self._run, job, work)
+
+    def abandon(self, job: Job) -> None:
+        """Delete a created job that will never be started."""
+        with self._lock:
+            self._pending -= 1
+        metrics.JOBS.dec(status=QUEUED)
+        shutil.rmtree(self.job_dir(job), ignore_errors=True)
+
+    def get(self, job_id: str) -> Job | None:
+        try:
+            job = Job(**json.loads((self.root / job_id / "job.json").read_text()))
+        except (FileNotFoundError, ValueError, TypeError):
+            return None
+        if not job.finished and not _pid_alive(job.pid):
+            job.status = FAILED
+            job.error = "The worker running this job exited."
+        return job
+
+    def result_path(self, job: Job) -> Path | None:
+        if job.status != DONE or not job.result_name:
+            return None
+        return self.job_dir(job) / job.result_name
+
+    def pending(self) -> int:
+        """Number of jobs queued or running in this process."""
+        with self._lock:
+            return self._pending
+
+    def expire(self) -> None:
+        """Delete jobs that finished more than ttl seconds ago."""
+        cutoff = time.time() - self.ttl
+        for path in self.root.iterdir():
+            job = self.get(path.name)
+            if job is None:
+                # Unreadable state, probably a half-created job, or one another
+                # worker just deleted
+                try:
+                    if path.stat().st_mtime < cutoff:
+                        shutil.rmtree(path, ignore_errors=True)
+                except FileNotFoundError:
+                    pass
+            elif job.finished and (job.finished_at or job.created_at) < cutoff:
+                logger.info("job_expired", job_id=job.id)
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _run(self, job: Job, work: Callable[[], Path]) -> None:
+        job.status = RUNNING
+        self._save(job)
+        metrics.JOBS.dec(status=QUEUED)
+        metrics.JOBS.inc(status=RUNNING)
+        log = logger.bind(job_id=job.id, kind=job.kind)
+        log.info("job_started")
+        try:
+            result_path = work()
+            job.result_name = str(result_path.relative_to(self.job_dir(job)))
+            job.status = DONE
+            log.info("job_done", result=job.result_name)
+        except Exception as e:
+            log.exception("job_failed")
+            job.status = FAILED
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            self._save(job)
+            with self._lock:
+                self._pending -= 1
+            metrics.JOBS.dec(status=RUNNING)
+
+    def _save(self, job: Job) -> None:
+        # Write then rename, so readers in other processes never see partial JSON
+        path = self.job_dir(job) / "job.json"
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp_path.write_text(json.dumps(asdict(job)))
+        os.replace(tmp_path, path)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def get_job_manager() -> JobManager:
+    """Return this process's job manager."""
+    global _job_manager
+    if _job_manager is None:
+        _job_manager = JobManager(
+            settings.JOBS_DIR,
+            max_workers=settings.JOB_WORKERS,
+            max_queued=settings.JOB_QUEUE_SIZE,
+            ttl=settings.JOB_TTL_SECONDS,
+        )
+    return _job_manager
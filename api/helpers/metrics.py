@@ -0,0 +1,347 @@
+"""
+Counters, gauges and histograms, exported in Prometheus text format.
+
+gunicorn runs several worker processes, and separation may run in processes of
+its own, so each process keeps its values in memory and a background thread
+writes them to METRICS_DIR/<pid>.json every FLUSH_SECONDS while they change,
+and once more as the process exits. The metrics endpoint adds up the files of
+every process. Gauges of processes that have exited are left out, but their
+counters and histograms still count, so clear() has to be called as the server
+starts, or counts from earlier runs carry over. gunicorn.conf.py does that.
+
+Without Django settings, as in tests, values are only kept in memory.
+"""
+import atexit
+import json
+import logging
+import math
+import multiprocessing.util
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from django.conf import settings
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+# Stages range from milliseconds (zipping a small file) to many minutes
+# (separating an hour-long mix)
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+# How often changed values are written out for other processes to read
+FLUSH_SECONDS = 1.0
+
+
+class Registry:
+    def __init__(self, directory: Path | None = None):
+        self._directory = directory
+        self._metrics: dict[str, "Metric"] = {}
+        self._values: dict[str, dict[tuple, float | list]] = {}
+        self._lock = threading.Lock()
+        # Held while writing, so an older snapshot never replaces a newer one
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        # The process the flushing thread runs in; a forked child starts its own
+        self._flusher_pid: int | None = None
+
+    @property
+    def directory(self) -> Path | None:
+        if self._directory is None and settings.configured:
+            self._directory = Path(settings.METRICS_DIR)
+        return self._directory
+
+    def register(self, metric: "Metric") -> None:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+            self._values[metric.name] = {}
+
+    def update(self, metric: "Metric", labels: tuple, change) -> None:
+        """Apply change to the metric's value for labels. The next flush saves it."""
+        with self._lock:
+            values = self._values[metric.name]
+            values[labels] = change(values.get(labels, metric.initial()))
+            self._dirty = True
+            start_flusher = self._flusher_pid != os.getpid()
+            if start_flusher:
+                self._flusher_pid = os.getpid()
+        if start_flusher and self.directory is not None:
+            self._start_flusher()
+
+    def flush(self) -> None:
+        """Save this process's values, if they changed since they were last saved."""
+        directory = self.directory
+        if directory is None:
+            return
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._dirty = False
+                snapshot = json.dumps(
+                    {
+                        name: [[list(key), value] for key, value in samples.items()]
+                        for name, samples in self._values.items()
+                    }
+                )
+            directory.mkdir(parents=True, exist_ok=True)
+            path = directory / f"{os.getpid()}.json"
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_text(snapshot)
+            os.replace(tmp_path, path)
+
+    def clear(self) -> None:
+        """Remove the saved values of every process."""
+        directory = self.directory
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def collect(self) -> str:
+        """Return the values of every process, in Prometheus text format."""
+        with self._lock:
+            totals = {
+                name: {key: _copy(value) for key, value in samples.items()}
+                for name, samples in self._values.items()
+            }
+        for pid, values in self._other_processes():
+            alive = _pid_alive(pid)
+            for name, samples in values.items():
+                metric = self._metrics.get(name)
+                if metric is None or (metric.type == GAUGE and not alive):
+                    continue
+                for key, value in samples:
+                    key = tuple(key)
+                    totals[name][key] = _add(
+                        totals[name].get(key, metric.initial()), value
+                    )
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for key, value in sorted(totals[name].items()):
+                lines.extend(metric.format(key, value))
+        return "\n".join(lines) + "\n"
+
+    def _start_flusher(self) -> None:
+        def flush_periodically():
+            while True:
+                time.sleep(FLUSH_SECONDS)
+                try:
+                    self.flush()
+                except OSError as e:
+                    logging.warning(f"Couldn't save metrics: {e}")
+
+        threading.Thread(
+            target=flush_periodically, name="metrics-flush", daemon=True
+        ).start()
+        atexit.register(self.flush)
+        # Processes started by multiprocessing exit without running atexit
+        multiprocessing.util.Finalize(None, self.flush, exitpriority=0)
+
+    def _other_processes(self) -> Iterator[tuple[int, dict]]:
+        directory = self.directory
+        if directory is None or not directory.is_dir():
+            return
+        for path in directory.glob("*.json"):
+            pid = int(path.stem)
+            if pid == os.getpid():
+                continue
+            try:
+                yield pid, json.loads(path.read_text())
+            except (FileNotFoundError, ValueError):
+                continue
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type: str
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        registry: Registry = REGISTRY,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._registry = registry
+        registry.register(self)
+
+    def initial(self) -> float | list:
+        return 0.0
+
+    def format(self, key: tuple, value) -> list[str]:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}"]
+
+    def _update(self, labels: dict[str, str], change) -> None:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} takes labels {self.labelnames}, not {list(labels)}"
+            )
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        self._registry.update(self, key, change)
+
+
+class Counter(Metric):
+    type = COUNTER
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        self._update(labels, lambda value: value + amount)
+
+
+class Gauge(Metric):
+    type = GAUGE
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        self._update(labels, lambda value: value + amount)
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self._update(labels, lambda value: value - amount)
+
+    def set(self, amount: float, **labels: str) -> None:
+        self._update(labels, lambda value: amount)
+
+    @contextmanager
+    def track_in_progress(self, **labels: str) -> Iterator[None]:
+        """Count the block as in progress while it runs."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    type = HISTOGRAM
+
+    def __init__(self, *args, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        self.buckets = tuple(buckets)
+        super().__init__(*args, **kwargs)
+
+    def initial(self) -> list:
+        # Count per bucket, then one for observations above every bucket,
+        # then the sum of all observations
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, amount: float, **labels: str) -> None:
+        index = next(
+            (i for i, bound in enumerate(self.buckets) if amount <= bound),
+            len(self.buckets),
+        )
+
+        def change(value: list) -> list:
+            value = list(value)
+            value[index] += 1
+            value[-1] += amount
+            return value
+
+        self._update(labels, change)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe how many seconds the block takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def format(self, key: tuple, value: list) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), value[:-1]):
+            cumulative += count
+            labels = _labels(self.labelnames + ("le",), key + (_number(bound),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_number(value[-1])}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def _labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def _copy(value: float | list) -> float | list:
+    return list(value) if isinstance(value, list) else value
+
+
+def _add(total: float | list, value: float | list) -> float | list:
+    if isinstance(total, list):
+        return [a + b for a, b in zip(total, value)]
+    return total + value
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+# Metrics shared by the views, the pipeline and the helpers
+
+STAGE_SECONDS = Histogram(
+    "tuul_stage_seconds",
+    "Time spent in each stage of separating, rendering and downloading.",
+    ("stage",),
+)
+REQUEST_SECONDS = Histogram(
+    "tuul_request_seconds",
+    "Time to handle a request, until its response starts.",
+    ("view",),
+)
+REQUEST_BYTES = Counter(
+    "tuul_request_bytes_total", "Bytes received in request bodies.", ("view",)
+)
+RESPONSE_BYTES = Counter(
+    "tuul_response_bytes_total", "Bytes sent in response bodies.", ("view",)
+)
+CACHE_LOOKUPS = Counter(
+    "tuul_cache_lookups_total",
+    "Lookups in the model pool and on-disk caches, by whether they hit.",
+    ("cache", "result"),
+)
+SUBPROCESSES_RUNNING = Gauge(
+    "tuul_subprocesses_running", "ffmpeg processes running now.", ("command",)
+)
+SEPARATIONS_RUNNING = Gauge(
+    "tuul_separations_running", "Songs or windows being separated now."
+)
+JOBS = Gauge("tuul_jobs", "Background jobs, by status.", ("status",))
+MEMORY_BYTES = Gauge(
+    "tuul_memory_bytes",
+    "Memory of the server processes: rss, pss (shared pages split between their users) and shared.",
+    ("kind",),
+)
+
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_LOOKUPS.inc(cache=cache, result="hit" if hit else "miss")
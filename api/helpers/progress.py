@@ -0,0 +1,136 @@
+"""
+Progress events for long-running requests and jobs.
+
+Each request or job that reports progress gets a channel: an append-only file
+of JSON lines under PROGRESS_DIR. Writers append an event per stage, and the
+progress endpoint tails the file and forwards events to the client as
+server-sent events. Keeping channels on disk lets any worker process serve a
+channel, whichever process does the work.
+
+An open stream holds one of its worker's threads until it ends, so streams
+close after PROGRESS_STREAM_TIMEOUT_SECONDS without an event. Clients can
+instead poll for the events after an offset with read_events(), which answers
+straight away.
+"""
+import json
+import re
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import structlog
+from django.conf import settings
+
+logger = structlog.get_logger(__name__)
+
+CHANNEL_ID_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+DONE = "done"
+FAILED = "failed"
+POLL_SECONDS = 0.5
+KEEPALIVE_SECONDS = 15
+
+
+def channel_path(channel_id: str) -> Path:
+    if not CHANNEL_ID_RE.match(channel_id):
+        raise ValueError(f"Invalid progress id: {channel_id}")
+    return Path(settings.PROGRESS_DIR) / f"{channel_id}.ndjson"
+
+
+class ProgressReporter:
+    """Report progress events to a channel. Call it with a stage name and any details."""
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def __call__(self, stage: str, **details) -> None:
+        event = {"stage": stage, "time": round(time.time(), 3), **details}
+        # Appends this small are atomic, so events from several threads don't interleave
+        with self.path.open("a") as f:
+            f.write(json.dumps(event) + "\n")
+
+
+def get_reporter(channel_id: str | None) -> ProgressReporter | None:
+    """Return a reporter for channel_id, or None if the client didn't ask for progress."""
+    if not channel_id:
+        return None
+    try:
+        path = channel_path(channel_id)
+    except ValueError:
+        logger.warning("invalid_progress_id", progress_id=channel_id)
+        return None
+    path.parent.mkdir(parents=True, exist_ok=True)
+    expire_channels(path.parent, settings.PROGRESS_TTL_SECONDS)
+    return ProgressReporter(path)
+
+
+@contextmanager
+def tracking(progress: ProgressReporter | None) -> Iterator[None]:
+    """Report done when the block finishes, or failed if it raises."""
+    try:
+        yield
+    except Exception as e:
+        if progress:
+            progress(FAILED, error=str(e))
+        raise
+    if progress:
+        progress(DONE)
+
+
+def read_events(path: Path, offset: int = 0) -> tuple[list[dict], int]:
+    """Return a channel's events written after offset, and the offset after them."""
+    try:
+        with path.open("rb") as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        data = b""
+    # Only consume whole lines; a writer may be midway through one
+    data = data[: data.rfind(b"\n") + 1]
+    return [json.loads(line) for line in data.splitlines()], offset + len(data)
+
+
+def finished(events: list[dict]) -> bool:
+    return any(event["stage"] in (DONE, FAILED) for event in events)
+
+
+def follow(path: Path, timeout: float) -> Iterator[dict | None]:
+    """Yield a channel's events as they are written, until it's finished.
+
+    Yields None while waiting, so callers can send keepalives. Stops after
+    timeout seconds without a new event.
+    """
+    offset = 0
+    last_event = time.monotonic()
+    while time.monotonic() - last_event < timeout:
+        events, offset = read_events(path, offset)
+        for event in events:
+            last_event = time.monotonic()
+            yield event
+            if event["stage"] in (DONE, FAILED):
+                return
+        if not events:
+            yield None
+            time.sleep(POLL_SECONDS)
+
+
+def server_sent_events(path: Path, timeout: float) -> Iterator[bytes]:
+    """Format a channel's events as a text/event-stream."""
+    last_sent = time.monotonic()
+    for event in follow(path, timeout):
+        if event is not None:
+            last_sent = time.monotonic()
+            yield f"event: {event['stage']}\ndata: {json.dumps(event)}\n\n".encode()
+        elif time.monotonic() - last_sent > KEEPALIVE_SECONDS:
+            last_sent = time.monotonic()
+            yield b": keepalive\n\n"
+
+
+def expire_channels(directory: Path, ttl: float) -> None:
+    cutoff = time.time() - ttl
+    for path in directory.glob("*.ndjson"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,49 @@
+"""
+Store uploaded files without copying them.
+
+Django spools uploads bigger than FILE_UPLOAD_MAX_MEMORY_SIZE to a temporary
+file. Renaming that file into a song's working directory is free, where
+copying it would write the whole upload to disk a second time.
+"""
+import errno
+import os
+from pathlib import Path
+
+import structlog
+from django.core.files import File
+from django.utils.text import get_valid_filename
+
+from helpers import metrics
+
+logger = structlog.get_logger(__name__)
+
+
+def store_upload(upload: File, directory: Path | str, name: str | None = None) -> Path:
+    """Put upload in directory, named name or the upload's own name. Return its path.
+
+    Uploads spooled to disk are moved, and only copied if FILE_UPLOAD_TEMP_DIR is
+    on a different filesystem. Uploads held in memory are written out.
+    """
+    with metrics.STAGE_SECONDS.time(stage="store_upload"):
+        return _store_upload(upload, directory, name)
+
+
+def _store_upload(upload: File, directory: Path | str, name: str | None) -> Path:
+    path = Path(directory) / get_valid_filename(Path(name or upload.name).name)
+    if hasattr(upload, "temporary_file_path"):
+        try:
+            # Django ignores its temp file having gone when the upload is closed
+            os.rename(upload.temporary_file_path(), path)
+            return path
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            logger.warning(
+                "upload_copied_across_filesystems",
+                upload_dir=str(Path(upload.temporary_file_path()).parent),
+                directory=str(directory),
+            )
+    with path.open("wb") as f:
+        for chunk in upload.chunks():
+            f.write(chunk)
+    return path
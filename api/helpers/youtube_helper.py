@@ -1,29 +1,191 @@
 import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Iterator
 import structlog
 
 import pytubefix as pytube
+from django.conf import settings
+
+from helpers import metrics
+from karaoke.disk_cache import DiskCache
 
 logger = structlog.get_logger(__name__)
 
+AUDIO = "audio"
+VIDEO = "video"
+METADATA = "metadata.json"
+
+# A mode is "audio", or the highest video resolution to download, like "480p"
+AUDIO_ONLY = "audio"
+DEFAULT_MODE = "1080p"
+RESOLUTION_RE = re.compile(r"^(\d{3,4})p$")
+# YouTube's smallest video resolution
+MIN_HEIGHT = 144
+# Separation needs decent audio, so audio streams below this bitrate are only
+# used if there's nothing better
+MIN_AUDIO_KBPS = 128
+
+_youtube_cache: DiskCache | None = None
+# Concurrent requests for a video wait for the first to download it. Each key's
+# lock is dropped once nobody holds or waits for it, with the number of users.
+_fetch_locks: dict[str, tuple[threading.Lock, int]] = {}
+_fetch_locks_lock = threading.Lock()
+
+
+def get_youtube_cache() -> DiskCache | None:
+    """Return the on-disk cache of YouTube downloads, or None if it's disabled.
+
+    Without Django settings, as in tests, there's no cache.
+    """
+    global _youtube_cache
+    if _youtube_cache is None and settings.configured and settings.YOUTUBE_CACHE_MAX_MB:
+        _youtube_cache = DiskCache(
+            settings.YOUTUBE_CACHE_DIR,
+            max_bytes=settings.YOUTUBE_CACHE_MAX_MB * 1024 * 1024,
+            ttl=settings.YOUTUBE_CACHE_TTL_SECONDS,
+        )
+    return _youtube_cache
+
+
+@contextmanager
+def _fetch_lock(key: str) -> Iterator[None]:
+    """Hold the lock of key, which only requests for the same key share."""
+    with _fetch_locks_lock:
+        lock, users = _fetch_locks.get(key, (threading.Lock(), 0))
+        _fetch_locks[key] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _fetch_locks_lock:
+            lock, users = _fetch_locks[key]
+            if users == 1:
+                del _fetch_locks[key]
+            else:
+                _fetch_locks[key] = (lock, users - 1)
+
+
+def max_height(mode: str) -> int | None:
+    """Return the highest video resolution mode allows, or None for audio only.
+    Raise ValueError if mode is invalid."""
+    if mode == AUDIO_ONLY:
+        return None
+    match = RESOLUTION_RE.match(mode)
+    if not match or int(match.group(1)) < MIN_HEIGHT:
+        raise ValueError(
+            f"mode must be {AUDIO_ONLY} or a resolution of at least {MIN_HEIGHT}p"
+            f" like 720p, not {mode}"
+        )
+    return int(match.group(1))
+
 
 def get_youtube_streams(
-    youtube_url: str, song_files_dir: Path
-) -> tuple[dict[str, str], Path, Path]:
+    youtube_url: str, song_files_dir: Path, mode: str = DEFAULT_MODE
+) -> tuple[dict[str, str], Path, Path | None]:
     """Download audio and video streams from YouTube URL.
-    Video has max resolution of 1080p.
-    Return audio and video paths.
+    mode is audio for no video, or the maximum video resolution.
+    Return audio and video paths. The video path is None in audio mode.
+
+    Downloads are cached by video id, so popular videos are only fetched once
+    per YOUTUBE_CACHE_TTL_SECONDS.
     """
+    height = max_height(mode)
+    cache = get_youtube_cache()
+    if cache is None:
+        with metrics.STAGE_SECONDS.time(stage="youtube_download"):
+            return download_youtube_streams(youtube_url, song_files_dir, height)
+
+    key = f"{pytube.extract.video_id(youtube_url)}-{mode}"
+    with _fetch_lock(key):
+        files = cache.fetch(key, song_files_dir)
+        metrics.cache_lookup("youtube", hit=bool(files))
+        if files:
+            logger.info("youtube_cache_hit", key=key)
+        else:
+            with metrics.STAGE_SECONDS.time(stage="youtube_download"):
+                metadata, audio_path, video_path = download_youtube_streams(
+                    youtube_url, song_files_dir, height
+                )
+            metadata_path = song_files_dir / METADATA
+            metadata_path.write_text(json.dumps(metadata))
+            files = {AUDIO: audio_path, METADATA: metadata_path}
+            if video_path:
+                files[VIDEO] = video_path
+            cache.put(key, files)
+    metadata = json.loads(files.pop(METADATA).read_text())
+    return metadata, files[AUDIO], files.get(VIDEO)
 
+
+def download_youtube_streams(
+    youtube_url: str, song_files_dir: Path, height: int | None = 1080
+) -> tuple[dict[str, str], Path, Path | None]:
+    """Download the audio stream, and the video stream up to height unless it's
+    None, at the same time."""
     youtube = pytube.YouTube(youtube_url)
-    audio_stream = youtube.streams.filter(only_audio=True).first()
-    video_stream = youtube.streams.filter(only_video=True, res="1080p").first()
-    if not video_stream:
-        video_stream = youtube.streams.filter(only_video=True).first()
-    audio_path = audio_stream.download(song_files_dir, "audio")
-    video_path = video_stream.download(song_files_dir, "video")
-    logger.info("video_stream", video_stream=video_stream)
-    return assemble_metadata(youtube), Path(audio_path), Path(video_path)
+    audio_stream = select_audio_stream(youtube.streams.filter(only_audio=True))
+    logger.info("audio_stream", audio_stream=audio_stream)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        audio_download = executor.submit(audio_stream.download, song_files_dir, AUDIO)
+        video_download = None
+        if height is not None:
+            video_stream = select_video_stream(
+                youtube.streams.filter(only_video=True), height
+            )
+            logger.info("video_stream", video_stream=video_stream)
+            video_download = executor.submit(
+                video_stream.download, song_files_dir, VIDEO
+            )
+        metadata = assemble_metadata(youtube)
+        audio_path = Path(audio_download.result())
+        video_path = Path(video_download.result()) if video_download else None
+    return metadata, audio_path, video_path
+
+
+def select_audio_stream(streams: list[pytube.Stream]) -> pytube.Stream:
+    """Pick the smallest mp4 audio stream that's good enough to separate.
+
+    Clients expect mp4 audio, so other containers are a last resort.
+    """
+
+    def kbps(stream: pytube.Stream) -> int:
+        return int(re.sub(r"\D", "", stream.abr or "") or 0)
+
+    def preference(stream: pytube.Stream) -> tuple:
+        good_enough = kbps(stream) >= MIN_AUDIO_KBPS
+        # Good enough streams sort by size, the rest by quality
+        return (
+            stream.subtype != "mp4",
+            not good_enough,
+            kbps(stream) if good_enough else -kbps(stream),
+        )
+
+    return min(streams, key=preference)
+
+
+def select_video_stream(streams: list[pytube.Stream], height: int) -> pytube.Stream:
+    """Pick the smallest of the highest resolution mp4 video streams up to height.
+
+    If every stream is taller than height, pick the smallest one. The video is
+    sent as video.mp4, so other containers are a last resort.
+    """
+
+    def stream_height(stream: pytube.Stream) -> int:
+        return int(re.sub(r"\D", "", stream.resolution or "") or 0)
+
+    streams = [stream for stream in streams if stream.subtype == "mp4"] or streams
+    allowed = [stream for stream in streams if stream_height(stream) <= height]
+    if allowed:
+        best = max(stream_height(stream) for stream in allowed)
+        candidates = [stream for stream in allowed if stream_height(stream) == best]
+    else:
+        candidates = list(streams)
+    return min(
+        candidates, key=lambda stream: (stream_height(stream), stream.filesize_approx)
+    )
 
 
 def assemble_metadata(youtube: pytube.YouTube) -> dict[str, str]:
@@ -0,0 +1,95 @@
+"""
+Build zip archives on the fly, yielding bytes as each member is read.
+
+Audio and video members are already compressed (mp4, mp3) or barely
+compressible (wav), so they are stored rather than deflated. Deflating them
+costs a lot of CPU for a few percent smaller downloads.
+"""
+import zipfile
+from pathlib import Path
+from typing import Iterable, Iterator
+
+from helpers import metrics
+
+# Members with these suffixes are stored without compression
+STORED_SUFFIXES = {
+    ".aac",
+    ".flac",
+    ".m4a",
+    ".mp3",
+    ".mp4",
+    ".ogg",
+    ".opus",
+    ".wav",
+    ".webm",
+    ".zip",
+}
+CHUNK_SIZE = 1024 * 1024
+
+# A member is the name it has in the archive and either a file or its contents
+ZipMember = tuple[str, Path | bytes]
+
+
+class _Sink:
+    """Unseekable file-like that collects what zipfile writes to it."""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def compress_type(arcname: str) -> int:
+    if Path(arcname).suffix.lower() in STORED_SUFFIXES:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def zip_info(arcname: str, source: Path | bytes) -> zipfile.ZipInfo:
+    if isinstance(source, bytes):
+        # Contents from memory have no file date, so they get ZipInfo's default
+        info = zipfile.ZipInfo(arcname)
+        info.file_size = len(source)
+    else:
+        info = zipfile.ZipInfo.from_file(source, arcname)
+    info.compress_type = compress_type(arcname)
+    return info
+
+
+def stream_zip(members: Iterable[ZipMember]) -> Iterator[bytes]:
+    """Yield a zip archive of members, reading files as it goes."""
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w") as zip_file:
+        for arcname, source in members:
+            with zip_file.open(zip_info(arcname, source), "w") as member:
+                if isinstance(source, bytes):
+                    member.write(source)
+                else:
+                    with source.open("rb") as f:
+                        while chunk := f.read(CHUNK_SIZE):
+                            member.write(chunk)
+                            if data := sink.drain():
+                                yield data
+            if data := sink.drain():
+                yield data
+    # Closing the archive writes the central directory
+    if data := sink.drain():
+        yield data
+
+
+def write_zip(members: Iterable[ZipMember], zip_path: Path) -> Path:
+    """Write a zip archive of members to zip_path."""
+    with metrics.STAGE_SECONDS.time(stage="zip"), zip_path.open("wb") as f:
+        for chunk in stream_zip(members):
+            f.write(chunk)
+    return zip_path
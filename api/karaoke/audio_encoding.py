@@ -0,0 +1,90 @@
+"""
+Encode separated stems into smaller formats before they are sent to clients.
+"""
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+from helpers import metrics
+
+from .make_karaoke_video import subprocess_call
+
+
+@dataclass(frozen=True)
+class StemFormat:
+    extension: str
+    codec: str
+    default_bitrate: str | None = None
+
+
+# WAV is what separation produces, so it needs no encoding
+STEM_FORMATS = {
+    "wav": StemFormat("wav", "pcm_s16le"),
+    "flac": StemFormat("flac", "flac"),
+    "opus": StemFormat("opus", "libopus", "128k"),
+    "aac": StemFormat("m4a", "aac", "192k"),
+    "mp3": StemFormat("mp3", "libmp3lame", "192k"),
+}
+
+BITRATE_RE = re.compile(r"^\d{2,3}k$")
+
+
+def get_stem_format(output_format: str, bitrate: str | None = None) -> StemFormat:
+    """Validate a requested output format and bitrate. Raise ValueError if either is invalid."""
+    if output_format not in STEM_FORMATS:
+        raise ValueError(
+            f"Unknown output format {output_format}. Available formats: {list(STEM_FORMATS)}"
+        )
+    if bitrate and not BITRATE_RE.match(bitrate):
+        raise ValueError(f"Bitrate must look like 192k, not {bitrate}")
+    return STEM_FORMATS[output_format]
+
+
+def encode_stem(
+    stem_path: Path,
+    output_format: str,
+    bitrate: str | None = None,
+    cancelled: Callable[[], bool] | None = None,
+) -> Path:
+    """Encode a WAV stem next to itself. Return the encoded file's path."""
+    stem_format = get_stem_format(output_format, bitrate)
+    if stem_format.extension == stem_path.suffix[1:]:
+        return stem_path
+    output_path = stem_path.with_suffix(f".{stem_format.extension}")
+    bitrate = bitrate or stem_format.default_bitrate
+    bitrate_args = ["-b:a", bitrate] if bitrate else []
+    subprocess_call(
+        [
+            "ffmpeg",
+            "-i",
+            str(stem_path),
+            "-c:a",
+            stem_format.codec,
+            *bitrate_args,
+            "-y",
+            str(output_path),
+        ],
+        cancelled=cancelled,
+    )
+    return output_path
+
+
+def encode_stems(
+    stem_paths: list[Path],
+    output_format: str,
+    bitrate: str | None = None,
+    cancelled: Callable[[], bool] | None = None,
+) -> list[Path]:
+    """Encode several stems at once, each in its own ffmpeg process."""
+    get_stem_format(output_format, bitrate)
+    with metrics.STAGE_SECONDS.time(stage="encode_stems"), ThreadPoolExecutor(
+        max_workers=max(len(stem_paths), 1)
+    ) as executor:
+        return list(
+            executor.map(
+                lambda path: encode_stem(path, output_format, bitrate, cancelled),
+                stem_paths,
+            )
+        )
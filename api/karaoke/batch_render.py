@@ -0,0 +1,369 @@
+"""
+Render karaoke videos for a whole catalog from the command line.
+
+    cd api && python -m karaoke.batch_render songs/ --out videos/ -s 1 -r 4
+
+Each song is a directory holding its audio and either subtitles.ass, or
+lyrics.txt and timings.json to lay subtitles out from, as in a project zip.
+An optional song.json gives its title, artist, audioDelay (with
+subtitles.ass), backgroundColor and videoOptions.
+
+Songs are separated in one pool of processes and rendered in another, each
+sized on its own since separation is bound by the model and rendering by
+ffmpeg. Each song's status and stage timings go to a manifest, rewritten as
+they change. Running again with the same manifest skips songs that are done,
+renders songs whose separation finished without separating them again, and
+retries songs that failed.
+
+Separations are kept in their own artifact store next to the manifest, with
+no size cap, so none is evicted before its song is rendered however large the
+catalog. Nothing else is kept there: each song's other stages run in a store
+of their own that's deleted with the song's work dir. Delete the separations
+once the videos are done.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    wait,
+)
+from pathlib import Path
+from typing import Callable
+
+import click
+
+from . import encode_profiles, music_separation
+from .make_karaoke_video import SONG_ROOT_PATH
+
+MANIFEST = "manifest.json"
+ARTIFACTS = "artifacts"
+SONG_INFO = "song.json"
+AUDIO_SUFFIXES = {".aac", ".flac", ".m4a", ".mp3", ".ogg", ".opus", ".wav", ".webm"}
+
+PENDING = "pending"
+SEPARATED = "separated"
+DONE = "done"
+FAILED = "failed"
+
+
+def find_audio(song_dir: Path) -> Path:
+    """Return the song's audio file. Raise LookupError if there isn't one."""
+    for path in sorted(song_dir.iterdir()):
+        if path.suffix.lower() in AUDIO_SUFFIXES:
+            return path
+    raise LookupError(f"No audio file in {song_dir}")
+
+
+def find_songs(songs_dir: Path) -> list[Path]:
+    """Return the song directories in songs_dir."""
+    songs = []
+    for song_dir in sorted(path for path in songs_dir.iterdir() if path.is_dir()):
+        try:
+            find_audio(song_dir)
+        except LookupError:
+            continue
+        songs.append(song_dir)
+    return songs
+
+
+def load_manifest(path: Path, song_dirs: list[Path] = ()) -> dict:
+    """Load the manifest at path, if there is one, adding any new song_dirs as
+    pending."""
+    manifest = json.loads(path.read_text()) if path.exists() else {"songs": {}}
+    for song_dir in song_dirs:
+        manifest["songs"].setdefault(
+            song_dir.name, {"dir": str(song_dir.resolve()), "status": PENDING}
+        )
+    return manifest
+
+
+def save_manifest(path: Path, manifest: dict) -> None:
+    # Written to a temporary file first, so an interrupted run never leaves half
+    # a manifest
+    with tempfile.NamedTemporaryFile(
+        "w", dir=path.parent, prefix=f".{path.name}.", delete=False
+    ) as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f.name, path)
+
+
+def song_info(song_dir: Path) -> dict:
+    info_path = song_dir / SONG_INFO
+    info = json.loads(info_path.read_text()) if info_path.exists() else {}
+    info.setdefault("title", song_dir.name)
+    info.setdefault("artist", "")
+    return info
+
+
+def output_filename(info: dict) -> str:
+    if info["artist"]:
+        name = f"{info['artist']} - {info['title']} [karaoke].mp4"
+    else:
+        name = f"{info['title']} [karaoke].mp4"
+    return name.replace("/", "_")
+
+
+def song_subtitles(song_dir: Path, info: dict) -> tuple[str, float]:
+    """Return the song's subtitles and the audio delay they need."""
+    subtitles_path = song_dir / "subtitles.ass"
+    if subtitles_path.exists():
+        return subtitles_path.read_text(), float(info.get("audioDelay", 0.0))
+    from .make_karaoke_video import audio_duration
+    from .subtitles import KaraokeOptions, create_layout
+
+    layout = create_layout(
+        (song_dir / "lyrics.txt").read_text(),
+        json.loads((song_dir / "timings.json").read_text()),
+        audio_duration(find_audio(song_dir)),
+        info["title"],
+        info["artist"],
+        KaraokeOptions.from_dict(info.get("videoOptions", {})),
+    )
+    return layout.to_ass(), float(layout.audio_delay)
+
+
+def _init_worker(separation_workers: int) -> None:
+    import django
+
+    django.setup()
+    from django.conf import settings
+
+    from . import onnx_threads
+
+    # Separation workers share the machine's cores, and each separates its
+    # song by itself rather than starting a pool of its own for chunks
+    onnx_threads.set_concurrency(separation_workers)
+    settings.CHUNKED_SEPARATION_WORKERS = 0
+
+
+def _separate(
+    song_dir: str, model_name: str | None, artifacts_dir: str
+) -> tuple[str, float]:
+    """Separate a song in a worker process, keeping only the separation in
+    artifacts_dir. Return the separation's id and the seconds it took."""
+    from .disk_cache import DiskCache
+    from .pipeline import Pipeline
+
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="batch-separate-") as work_dir:
+        work_dir = Path(work_dir)
+        pipeline = Pipeline(work_dir, store=DiskCache(work_dir / "artifacts"))
+        song = pipeline.ingest(find_audio(Path(song_dir)))
+        separation = pipeline.separate(song, model_name)
+        DiskCache(Path(artifacts_dir)).put(separation.id, separation.files)
+    return separation.id, time.perf_counter() - start
+
+
+def _render(
+    song_dir: str,
+    separation_id: str,
+    out_dir: str,
+    encode_profile: str | None,
+    artifacts_dir: str,
+) -> tuple[str, float]:
+    """Render a separated song in a worker process. Return the video's path and
+    the seconds it took."""
+    from . import make_karaoke_video
+    from .disk_cache import DiskCache
+    from .pipeline import ArtifactMissing
+
+    start = time.perf_counter()
+    song_dir = Path(song_dir)
+    info = song_info(song_dir)
+    subtitles, audio_delay = song_subtitles(song_dir, info)
+    filename = output_filename(info)
+    with tempfile.TemporaryDirectory(prefix="batch-render-") as work_dir:
+        # Render stages are stored only until the video is copied out
+        store = DiskCache(Path(work_dir) / "artifacts")
+        separation = DiskCache(Path(artifacts_dir)).fetch(
+            separation_id, Path(tempfile.mkdtemp(dir=work_dir))
+        )
+        if separation is None:
+            raise ArtifactMissing(f"Separation {separation_id} isn't stored")
+        store.put(separation_id, separation)
+        make_karaoke_video.run(
+            None,
+            subtitles,
+            output_filename=filename,
+            audio_delay=audio_delay,
+            metadata={"title": info["title"], "artist": info["artist"]},
+            background_color=info.get("backgroundColor", "#000000"),
+            encode_profile=encode_profile,
+            separation_id=separation_id,
+            output_dir=Path(work_dir),
+            store=store,
+        )
+        # The video is linked from the artifact store, so copy it out
+        video_path = Path(out_dir or song_dir) / filename
+        shutil.copyfile(Path(work_dir) / filename, video_path)
+    return str(video_path), time.perf_counter() - start
+
+
+def render_all(
+    manifest: dict,
+    save: Callable[[dict], None],
+    artifacts_dir: Path,
+    out_dir: Path | None = None,
+    separation_workers: int = 1,
+    render_workers: int = 2,
+    model_name: str | None = None,
+    encode_profile: str | None = None,
+    executor_class: type[Executor] = ProcessPoolExecutor,
+) -> dict[str, int]:
+    """Separate and render every song in manifest that isn't done, calling
+    save(manifest) whenever a song's status changes. Separations are stored in
+    artifacts_dir. Return the status counts."""
+    from .disk_cache import DiskCache
+    from .pipeline import artifact_exists
+
+    store = DiskCache(artifacts_dir)
+
+    def pool(workers: int):
+        if executor_class is not ProcessPoolExecutor:
+            return executor_class(max_workers=workers)
+        # Spawned, since forking a process with inference threads isn't safe
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(separation_workers,),
+        )
+
+    running: dict[Future, tuple[str, str]] = {}
+    with pool(separation_workers) as separators, pool(render_workers) as renderers:
+
+        def render(name: str, entry: dict) -> None:
+            future = renderers.submit(
+                _render,
+                entry["dir"],
+                entry["separationId"],
+                str(out_dir) if out_dir else None,
+                encode_profile,
+                str(artifacts_dir),
+            )
+            running[future] = (name, "render")
+
+        for name, entry in manifest["songs"].items():
+            if entry["status"] == DONE:
+                continue
+            separation_id = entry.get("separationId")
+            if separation_id and artifact_exists(separation_id, "separate", store):
+                render(name, entry)
+            else:
+                future = separators.submit(
+                    _separate, entry["dir"], model_name, str(artifacts_dir)
+                )
+                running[future] = (name, "separate")
+
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, stage = running.pop(future)
+                entry = manifest["songs"][name]
+                try:
+                    result, seconds = future.result()
+                except Exception as e:
+                    logging.error(f"{stage} {name} failed: {e}")
+                    entry.update(status=FAILED, error=f"{stage}: {e}")
+                    save(manifest)
+                    continue
+                entry.setdefault("seconds", {})[stage] = round(seconds, 3)
+                entry.pop("error", None)
+                if stage == "separate":
+                    entry.update(status=SEPARATED, separationId=result)
+                    render(name, entry)
+                else:
+                    entry.update(status=DONE, video=result)
+                click.echo(f"{stage:>8} {name} in {seconds:.1f}s")
+                save(manifest)
+
+    counts: dict[str, int] = {}
+    for entry in manifest["songs"].values():
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    return counts
+
+
+@click.command()
+@click.argument(
+    "songs", type=click.Path(exists=True, path_type=Path), default=SONG_ROOT_PATH
+)
+@click.option(
+    "--manifest",
+    "manifest_path",
+    type=click.Path(path_type=Path),
+    help=f"Manifest to record progress in (default: SONGS/{MANIFEST})",
+)
+@click.option(
+    "--out",
+    "out_dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    help="Directory for the videos (default: each song's directory)",
+)
+@click.option("--separation-workers", "-s", default=1, help="Songs separated at once")
+@click.option("--render-workers", "-r", default=2, help="Songs rendered at once")
+@click.option(
+    "--model",
+    "model_name",
+    type=click.Choice(music_separation.AVAILABLE_MODELS),
+    default=None,
+    help="Separation model",
+)
+@click.option(
+    "--profile",
+    "encode_profile",
+    type=click.Choice(list(encode_profiles.ENCODE_PROFILES)),
+    default=None,
+    help="Video encoding profile",
+)
+def main(
+    songs,
+    manifest_path,
+    out_dir,
+    separation_workers,
+    render_workers,
+    model_name,
+    encode_profile,
+):
+    """Separate and render every song in SONGS, a directory of song
+    directories or a manifest from an earlier run."""
+    import django
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+    django.setup()
+
+    if songs.is_file():
+        manifest_path = manifest_path or songs
+        manifest = load_manifest(songs)
+    else:
+        manifest_path = manifest_path or songs / MANIFEST
+        manifest = load_manifest(manifest_path, find_songs(songs))
+    if out_dir:
+        out_dir.mkdir(parents=True, exist_ok=True)
+    save_manifest(manifest_path, manifest)
+    counts = render_all(
+        manifest,
+        lambda manifest: save_manifest(manifest_path, manifest),
+        manifest_path.parent / ARTIFACTS,
+        out_dir=out_dir,
+        separation_workers=separation_workers,
+        render_workers=render_workers,
+        model_name=model_name,
+        encode_profile=encode_profile,
+    )
+    click.echo(
+        ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+    )
+    if counts.get(FAILED):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
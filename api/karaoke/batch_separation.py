@@ -0,0 +1,194 @@
+"""
+Separate many songs with one model, several songs to a pass.
+
+Each song is decoded and scaled the way a separation on its own would scale
+it, then songs are laid end to end with a few seconds of silence between them
+and separated as one file. The model is loaded once, and the separator's
+inference batches (SEPARATION_BATCH_SIZE segments each) span songs instead of
+ending half-empty at the end of every song. The silence keeps one song's
+segments out of the next one's, so each song's stems match a separation of
+the song on its own. Afterwards the stems are cut back into songs.
+
+A song that can't be decoded, or whose stems can't be cut out of the pack's,
+fails alone. If separating a pack fails, its songs are separated one by one
+so only the song at fault fails.
+"""
+import logging
+import shutil
+import tempfile
+import wave
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from . import music_separation
+from .chunked_separation import CHANNELS, MAX_PEAK, SAMPLE_RATE, decode, peak, to_pcm
+
+# Silence between songs in a pack, longer than the model's segments
+GAP_SECONDS = 10
+# Longest pack, so results of a big batch come back as it goes
+MAX_PACK_SECONDS = 900
+# Frames read or written at a time
+BLOCK_FRAMES = SAMPLE_RATE * 30
+
+
+@dataclass
+class SongResult:
+    index: int
+    songfile: Path
+    accompaniment: Path | None = None
+    vocals: Path | None = None
+    error: str | None = None
+
+
+@dataclass
+class _Song:
+    index: int
+    songfile: Path
+    pcm: np.ndarray
+    gain: float
+
+
+def split_songs(
+    songfiles: Iterable[Path],
+    out_dir: Path,
+    model_name: str = music_separation.DEFAULT_MODEL,
+    max_pack_seconds: float = MAX_PACK_SECONDS,
+    gap_seconds: float = GAP_SECONDS,
+) -> Iterator[SongResult]:
+    """Separate songfiles. Yield each song's result as soon as it's ready.
+
+    Song i's stems are written to out_dir/i. Results come in the order songs
+    finish, which isn't always the order they were given in.
+    """
+    pack: list[_Song] = []
+    pack_frames = 0
+    max_frames = int(max_pack_seconds * SAMPLE_RATE)
+    gap = int(gap_seconds * SAMPLE_RATE)
+    for index, songfile in enumerate(songfiles):
+        song_dir = out_dir / str(index)
+        song_dir.mkdir(parents=True)
+        try:
+            pcm = decode(songfile, song_dir / "mix.pcm")
+        except Exception as e:
+            logging.warning(f"Couldn't decode {songfile.name}: {e}")
+            yield SongResult(index, songfile, error=f"Couldn't decode the song: {e}")
+            continue
+        if pack and pack_frames + len(pcm) > max_frames:
+            yield from _separate_pack(pack, out_dir, model_name, gap)
+            pack, pack_frames = [], 0
+        gain = min(1.0, MAX_PEAK / max(peak(pcm), 1e-6))
+        pack.append(_Song(index, songfile, pcm, gain))
+        pack_frames += len(pcm) + gap
+    if pack:
+        yield from _separate_pack(pack, out_dir, model_name, gap)
+
+
+def _separate_pack(
+    pack: list[_Song], out_dir: Path, model_name: str, gap: int
+) -> Iterator[SongResult]:
+    pack_dir = Path(tempfile.mkdtemp(prefix="pack-", dir=out_dir))
+    try:
+        pack_path = pack_dir / "pack.wav"
+        _write_pack(pack, pack_path, gap)
+        logging.info(f"Separating {len(pack)} songs in one pass")
+        accompaniment_path, vocals_path = music_separation.split_song(
+            pack_path, pack_dir, model_name=model_name
+        )
+    except Exception as e:
+        if len(pack) == 1:
+            logging.exception(f"Separating {pack[0].songfile.name} failed")
+            yield SongResult(pack[0].index, pack[0].songfile, error=str(e))
+        else:
+            logging.warning(
+                f"Separating a pack failed, separating its songs one by one: {e}"
+            )
+            for song in pack:
+                yield from _separate_pack([song], out_dir, model_name, gap)
+        shutil.rmtree(pack_dir, ignore_errors=True)
+        return
+    finally:
+        for song in pack:
+            (out_dir / str(song.index) / "mix.pcm").unlink(missing_ok=True)
+
+    results = [
+        SongResult(
+            song.index,
+            song.songfile,
+            accompaniment=out_dir / str(song.index) / "accompaniment.wav",
+            vocals=out_dir / str(song.index) / "vocals.wav",
+        )
+        for song in pack
+    ]
+    lengths = [len(song.pcm) for song in pack]
+    for stem_path, attribute in (
+        (accompaniment_path, "accompaniment"),
+        (vocals_path, "vocals"),
+    ):
+        output_paths = [getattr(result, attribute) for result in results]
+        errors = _cut_stem(stem_path, output_paths, lengths, gap)
+        for result, error in zip(results, errors):
+            if error and not result.error:
+                logging.warning(
+                    f"Cutting {result.songfile.name}'s stems failed: {error}"
+                )
+                result.error = f"Couldn't cut the song's stems: {error}"
+    for result in results:
+        if result.error:
+            result.accompaniment = result.vocals = None
+    shutil.rmtree(pack_dir, ignore_errors=True)
+    yield from results
+
+
+def _write_pack(pack: list[_Song], path: Path, gap: int) -> None:
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(CHANNELS)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        for song in pack:
+            for start in range(0, len(song.pcm), BLOCK_FRAMES):
+                block = song.pcm[start : start + BLOCK_FRAMES].astype(np.float32)
+                wav.writeframes(to_pcm(block * (song.gain / 32768)))
+            wav.writeframes(bytes(gap * CHANNELS * 2))
+
+
+def _cut_stem(
+    stem_path: Path, output_paths: list[Path], lengths: list[int], gap: int
+) -> list[str | None]:
+    """Split a pack's stem into one file per song. Return why each song's cut
+    failed, or None where it didn't."""
+    try:
+        stem = wave.open(str(stem_path), "rb") if stem_path.exists() else None
+    except (OSError, EOFError, wave.Error) as e:
+        return [str(e)] * len(output_paths)
+    errors = []
+    position = 0
+    try:
+        for output_path, length in zip(output_paths, lengths):
+            try:
+                if stem:
+                    # Seek to each song, so one that fails doesn't shift the rest
+                    stem.setpos(position)
+                _write_stem(stem, output_path, length)
+                errors.append(None)
+            except (OSError, EOFError, wave.Error) as e:
+                errors.append(str(e))
+            position += length + gap
+    finally:
+        if stem:
+            stem.close()
+    return errors
+
+
+def _write_stem(stem: wave.Wave_read | None, output_path: Path, length: int) -> None:
+    with wave.open(str(output_path), "wb") as out:
+        out.setnchannels(CHANNELS)
+        out.setsampwidth(2)
+        out.setframerate(SAMPLE_RATE)
+        for start in range(0, length, BLOCK_FRAMES):
+            frames = min(BLOCK_FRAMES, length - start)
+            # The separator skips writing stems that are silent
+            data = stem.readframes(frames) if stem else b""
+            out.writeframes(data.ljust(frames * CHANNELS * 2, b"\0"))
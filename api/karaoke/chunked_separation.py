@@ -0,0 +1,262 @@
+"""
+Separate long songs in overlapping windows spread over several processes.
+
+A single separation runs one inference session over the whole song, so a long
+live recording or DJ mix keeps one core busy for many minutes. Here the song is
+decoded once, cut into windows that overlap by a few seconds, and each window
+is separated in a pool of worker processes. The separated windows are stitched
+back together with a linear crossfade across each overlap.
+
+MDX-Net models only ever look at a few seconds of audio at a time, so away from
+the window overlaps the result matches a single pass. Inside an overlap the two
+windows' outputs are blended, which keeps the difference from a single pass
+well below audibility; benchmarks/chunked_separation.py measures it as the
+signal-to-noise ratio of the chunked output against single-pass output.
+"""
+import logging
+import multiprocessing
+import shutil
+import subprocess as sp
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+import numpy as np
+from django.conf import settings
+
+from . import music_separation, onnx_threads
+from .make_karaoke_video import audio_duration, subprocess_call
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+# separate() scales any input louder than this down, window by window. Scaling
+# the whole song first keeps every window at the same gain.
+MAX_PEAK = 0.9
+
+_executor: ProcessPoolExecutor | None = None
+
+
+def read_wav(path: Path) -> np.ndarray:
+    """Read a 16-bit WAV file as float32 samples shaped (frames, channels)."""
+    with wave.open(str(path), "rb") as wav:
+        channels = wav.getnchannels()
+        frames = wav.readframes(wav.getnframes())
+    samples = np.frombuffer(frames, dtype="<i2").reshape(-1, channels)
+    if channels == 1:
+        samples = np.repeat(samples, CHANNELS, axis=1)
+    return samples.astype(np.float32) / 32768
+
+
+def to_pcm(samples: np.ndarray) -> bytes:
+    return (np.clip(samples, -1, 32767 / 32768) * 32768).astype("<i2").tobytes()
+
+
+def write_wav(path: Path, samples: np.ndarray) -> Path:
+    """Write float samples shaped (frames, channels) as a 16-bit WAV file."""
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(samples.shape[1])
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(to_pcm(samples))
+    return path
+
+
+def decode(
+    songfile: Path, pcm_path: Path, cancelled: Callable[[], bool] | None = None
+) -> np.ndarray:
+    """Decode any audio file to raw stereo 44.1kHz PCM.
+
+    Return the samples memory-mapped from pcm_path, shaped (frames, channels),
+    so hours-long recordings don't have to fit in memory. ffmpeg runs with the
+    usual subprocess limits, and is killed once cancelled() returns True.
+    """
+    subprocess_call(
+        [
+            "ffmpeg",
+            "-v",
+            "error",
+            "-i",
+            str(songfile),
+            "-ac",
+            str(CHANNELS),
+            "-ar",
+            str(SAMPLE_RATE),
+            "-f",
+            "s16le",
+            "-y",
+            str(pcm_path),
+        ],
+        cancelled=cancelled,
+    )
+    return np.memmap(pcm_path, dtype="<i2", mode="r").reshape(-1, CHANNELS)
+
+
+def peak(pcm: np.ndarray, block: int = SAMPLE_RATE * 60) -> float:
+    """Return the peak level of 16-bit samples, scanning them a block at a time."""
+    level = 0
+    for start in range(0, len(pcm), block):
+        level = max(
+            level, int(np.abs(pcm[start : start + block].astype(np.int32)).max())
+        )
+    return level / 32768
+
+
+def plan_windows(frames: int, window: int, overlap: int) -> list[tuple[int, int]]:
+    """Return (start, end) frame ranges covering frames, overlapping by overlap.
+
+    A short final window would be separated with little context, so instead
+    the window before it is stretched to the end.
+    """
+    if window < 2 * overlap:
+        raise ValueError("Windows must be at least twice as long as the overlap")
+    step = window - overlap
+    windows = [(0, min(window, frames))]
+    while windows[-1][1] < frames:
+        start = windows[-1][0] + step
+        windows.append((start, min(start + window, frames)))
+    if len(windows) > 1 and windows[-1][1] - windows[-1][0] < window // 2:
+        windows.pop()
+        windows[-1] = (windows[-1][0], frames)
+    return windows
+
+
+def stitch(
+    parts: Iterable[np.ndarray], windows: list[tuple[int, int]]
+) -> Iterator[np.ndarray]:
+    """Join separated windows, crossfading linearly wherever two overlap.
+
+    Yield the result in order, a window at a time, holding back each window's
+    overlap with the next one until that has been read.
+    """
+    tail = None
+    for i, (part, (start, end)) in enumerate(zip(parts, windows)):
+        part = _fit(part, end - start)
+        if tail is not None:
+            fade_in = np.linspace(0, 1, len(tail) + 2, dtype=np.float32)[1:-1, None]
+            part = part.copy()
+            part[: len(tail)] = tail * (1 - fade_in) + part[: len(tail)] * fade_in
+        if i == len(windows) - 1:
+            yield part
+        else:
+            overlap = end - windows[i + 1][0]
+            yield part[: len(part) - overlap]
+            tail = part[len(part) - overlap :]
+
+
+def _fit(samples: np.ndarray, length: int) -> np.ndarray:
+    """Trim or zero-pad samples to length frames."""
+    if len(samples) >= length:
+        return samples[:length]
+    return np.pad(samples, ((0, length - len(samples)), (0, 0)))
+
+
+def _init_worker() -> None:
+    import django
+
+    django.setup()
+    # Workers share the cores of the separation that is using them
+    onnx_threads.set_concurrency(settings.CHUNKED_SEPARATION_WORKERS)
+
+
+def _separate_window(window_path: str, model_name: str) -> tuple[str, str]:
+    """Separate one window in a worker process. Return the stems' paths."""
+    window_path = Path(window_path)
+    out_dir = window_path.with_suffix("")
+    out_dir.mkdir()
+    accompaniment_path, vocals_path = music_separation.split_song(
+        window_path, out_dir, model_name=model_name
+    )
+    return str(accompaniment_path), str(vocals_path)
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """Return the pool of separation worker processes, starting it if needed.
+
+    Workers are spawned rather than forked, since forking a process that is
+    already running inference threads isn't safe. They live as long as this
+    process so each keeps its loaded models warm.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.CHUNKED_SEPARATION_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+    return _executor
+
+
+def should_chunk(songfile: Path) -> bool:
+    """Whether songfile is long enough to be worth separating in windows."""
+    if settings.CHUNKED_SEPARATION_WORKERS < 2:
+        return False
+    try:
+        duration = audio_duration(songfile)
+    except (sp.CalledProcessError, ValueError, OSError):
+        return False
+    return duration >= settings.CHUNKED_SEPARATION_MIN_SECONDS
+
+
+def split_song_chunked(
+    songfile: Path,
+    song_dir: Path,
+    model_name: str = music_separation.DEFAULT_MODEL,
+    window_seconds: float | None = None,
+    overlap_seconds: float | None = None,
+    executor: ProcessPoolExecutor | None = None,
+    progress: Callable[..., None] | None = None,
+) -> tuple[Path, Path]:
+    """
+    Split song into instrumental and vocal tracks, separating overlapping
+    windows in parallel. Returns paths to accompaniment and vocal tracks.
+    """
+    window_seconds = window_seconds or settings.CHUNKED_SEPARATION_WINDOW_SECONDS
+    overlap_seconds = overlap_seconds or settings.CHUNKED_SEPARATION_OVERLAP_SECONDS
+    executor = executor or get_executor()
+    windows_dir = song_dir / "windows"
+    windows_dir.mkdir(exist_ok=True)
+
+    mix = decode(songfile, windows_dir / "mix.pcm")
+    gain = min(1.0, MAX_PEAK / max(peak(mix), 1e-6))
+
+    windows = plan_windows(
+        len(mix), int(window_seconds * SAMPLE_RATE), int(overlap_seconds * SAMPLE_RATE)
+    )
+    logging.info(f"Separating {songfile.name} in {len(windows)} windows")
+    futures = []
+    for i, (start, end) in enumerate(windows):
+        window_path = write_wav(
+            windows_dir / f"window{i:04}.wav",
+            mix[start:end].astype(np.float32) * (gain / 32768),
+        )
+        futures.append(executor.submit(_separate_window, str(window_path), model_name))
+    if progress:
+        progress("separation", percent=0, windows=len(windows))
+        for done, _ in enumerate(as_completed(futures), 1):
+            percent = round(100 * done / len(futures), 1)
+            progress("separation", percent=percent, windows=len(windows))
+    stems = [future.result() for future in futures]
+
+    accompaniment_path = song_dir / "accompaniment.wav"
+    vocals_path = song_dir / "vocals.wav"
+    for index, output_path in enumerate([accompaniment_path, vocals_path]):
+        parts = (
+            _read_stem(Path(paths[index]), end - start)
+            for paths, (start, end) in zip(stems, windows)
+        )
+        with wave.open(str(output_path), "wb") as wav:
+            wav.setnchannels(CHANNELS)
+            wav.setsampwidth(2)
+            wav.setframerate(SAMPLE_RATE)
+            for block in stitch(parts, windows):
+                wav.writeframes(to_pcm(block))
+    shutil.rmtree(windows_dir, ignore_errors=True)
+    return accompaniment_path, vocals_path
+
+
+def _read_stem(path: Path, frames: int) -> np.ndarray:
+    # The separator skips writing stems that are silent
+    if not path.exists():
+        return np.zeros((frames, CHANNELS), dtype=np.float32)
+    return read_wav(path)
@@ -0,0 +1,186 @@
+"""
+Size-capped, content-addressed cache of files on local disk.
+
+Each entry is a directory of files named by its key. Entries are assembled in a
+staging directory and renamed into place, so other threads and processes
+sharing the cache directory only ever see complete entries. Reading an entry
+bumps its mtime, and the least recently used entries are removed once the
+cache grows past its size cap. Entries older than the cache's TTL, if it has
+one, count as missing.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+STAGING_PREFIX = ".staging-"
+TRASH_PREFIX = ".trash-"
+# Empty file in each entry whose mtime is when the entry was stored
+CREATED_MARKER = ".created"
+# Staging dirs older than this were left behind by a crashed writer
+STALE_STAGING_SECONDS = 3600
+
+
+def hash_file(path: Path, *extra: str) -> str:
+    """Return a hex digest of the file's bytes and any extra strings."""
+    digest = hashlib.sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    for value in extra:
+        digest.update(b"\0" + value.encode("utf8"))
+    return digest.hexdigest()
+
+
+def link_or_copy(src: Path, dest: Path) -> Path:
+    """Hardlink src to dest, copying instead if they are on different filesystems."""
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+    return dest
+
+
+class DiskCache:
+    """
+    A directory of cache entries under `root`, capped at `max_bytes` and
+    expiring `ttl` seconds after they're stored. 0 means no cap or no expiry.
+    """
+
+    def __init__(self, root: Path, max_bytes: int = 0, ttl: float = 0):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Path | None:
+        """Return the directory for key if it's cached."""
+        entry = self.root / key
+        try:
+            if self._expired(entry):
+                self.remove(key)
+                raise FileNotFoundError(entry)
+            os.utime(entry)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry
+
+    def fetch(self, key: str, dest_dir: Path) -> dict[str, Path] | None:
+        """Link every file of a cached entry into dest_dir.
+
+        Return the linked paths by file name, or None on a miss. The links stay
+        valid even if the entry is evicted afterwards.
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        try:
+            return {
+                path.name: link_or_copy(path, dest_dir / path.name)
+                for path in entry.iterdir()
+                if path.name != CREATED_MARKER
+            }
+        except FileNotFoundError:
+            # Evicted by another worker between get() and here
+            return None
+
+    def put(self, key: str, files: dict[str, Path]) -> Path:
+        """Store files under key, named by their dict keys. Return the entry directory."""
+        entry = self.root / key
+        staging = Path(tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=self.root))
+        try:
+            for name, path in files.items():
+                link_or_copy(path, staging / name)
+            (staging / CREATED_MARKER).touch()
+            try:
+                staging.rename(entry)
+            except OSError:
+                # Another worker published the same entry first; keep theirs
+                if not entry.is_dir():
+                    raise
+                shutil.rmtree(staging, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        self.evict()
+        return entry
+
+    def evict(self) -> None:
+        """Remove expired entries, then the least recently used until the cache fits in max_bytes."""
+        if not self.max_bytes and not self.ttl:
+            return
+        entries = []
+        total = 0
+        for path in self.root.iterdir():
+            if path.name.startswith((STAGING_PREFIX, TRASH_PREFIX)):
+                self._remove_if_stale(path)
+                continue
+            try:
+                if self._expired(path):
+                    self.remove(path.name)
+                    continue
+                size = sum(f.stat().st_size for f in path.iterdir())
+                entries.append((path.stat().st_mtime, size, path))
+            except FileNotFoundError:
+                continue
+            total += size
+        if not self.max_bytes:
+            return
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(path.name)
+            total -= size
+
+    def remove(self, key: str) -> None:
+        # Rename first so readers never see a half-deleted entry
+        trash = self.root / f"{TRASH_PREFIX}{key}-{os.getpid()}-{threading.get_ident()}"
+        try:
+            (self.root / key).rename(trash)
+        except FileNotFoundError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+        with self._lock:
+            self.evictions += 1
+        logger.info(f"Evicted {key} from {self.root}")
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _expired(self, entry: Path) -> bool:
+        if not self.ttl:
+            return False
+        try:
+            created = (entry / CREATED_MARKER).stat().st_mtime
+        except FileNotFoundError:
+            # Stored before the cache had a TTL, so its age is unknown
+            return entry.is_dir()
+        return time.time() - created > self.ttl
+
+    def _remove_if_stale(self, path: Path) -> None:
+        try:
+            if time.time() - path.stat().st_mtime > STALE_STAGING_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,90 @@
+"""
+x264 settings for rendering karaoke videos, and the outputs they render to.
+
+The video is a solid background with subtitles, so nearly every frame repeats
+the one before it except where a highlight moves. tune=stillimage and long
+keyframe intervals suit that, and the profiles trade encode time for quality.
+The default, standard, keeps x264's own defaults at 20 fps, which is how
+videos were rendered before there were profiles, so the same request still
+makes the same video.
+
+A render can make several outputs of the same song at once, picked from
+OUTPUT_TARGETS. The subtitles are rendered once at the largest size and
+scaled down for the others.
+"""
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class EncodeProfile:
+    preset: str
+    crf: int
+    fps: int
+    # Seconds between keyframes. Longer makes smaller files but coarser seeking.
+    # None keeps x264's default of 250 frames.
+    keyframe_seconds: int | None
+    tune: str | None = "stillimage"
+    # 0 lets x264 pick a thread count from the number of cores
+    threads: int = 0
+
+    def video_args(self) -> list[str]:
+        """Return ffmpeg output arguments that encode video with this profile."""
+        args = ["-c:v", "libx264", "-preset", self.preset, "-crf", str(self.crf)]
+        if self.tune:
+            args += ["-tune", self.tune]
+        if self.keyframe_seconds:
+            args += ["-g", str(self.fps * self.keyframe_seconds)]
+        return args + ["-threads", str(self.threads)]
+
+
+ENCODE_PROFILES = {
+    "standard": EncodeProfile(
+        preset="medium", crf=23, fps=20, keyframe_seconds=None, tune=None
+    ),
+    "fast-preview": EncodeProfile(
+        preset="ultrafast", crf=30, fps=10, keyframe_seconds=10
+    ),
+    "balanced": EncodeProfile(preset="veryfast", crf=23, fps=20, keyframe_seconds=10),
+    "archive": EncodeProfile(preset="slow", crf=18, fps=30, keyframe_seconds=5),
+}
+
+DEFAULT_PROFILE = "standard"
+
+
+def get_encode_profile(name: str | None = None) -> EncodeProfile:
+    """Look up an encode profile by name. Raise ValueError if there's no such profile."""
+    name = name or DEFAULT_PROFILE
+    if name not in ENCODE_PROFILES:
+        raise ValueError(
+            f"Unknown encode profile {name}. Available profiles: {list(ENCODE_PROFILES)}"
+        )
+    return ENCODE_PROFILES[name]
+
+
+@dataclass(frozen=True)
+class OutputTarget:
+    suffix: str
+    # Frame width and height, or None for an output with only audio
+    size: tuple[int, int] | None = None
+
+
+OUTPUT_TARGETS = {
+    "720p": OutputTarget(".mp4", (1280, 720)),
+    "1080p": OutputTarget(".mp4", (1920, 1080)),
+    "mp3": OutputTarget(".mp3"),
+}
+
+DEFAULT_TARGETS = ["720p"]
+
+
+def get_output_targets(names: list[str] | None = None) -> dict[str, OutputTarget]:
+    """Look up output targets by name, in order and without repeats. Raise
+    ValueError if there's no such target."""
+    targets = {}
+    for name in names or DEFAULT_TARGETS:
+        if name not in OUTPUT_TARGETS:
+            raise ValueError(
+                f"Unknown output target {name}. Available targets: {list(OUTPUT_TARGETS)}"
+            )
+        targets[name] = OUTPUT_TARGETS[name]
+    return targets
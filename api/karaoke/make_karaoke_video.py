@@ -1,72 +1,323 @@
 import logging
+import os
+import re
+import resource
+import signal
 from pathlib import Path
 import subprocess as sp
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, IO, Iterator
 
 import click
-
 from django.conf import settings
+from helpers import metrics
 
-from . import music_separation
+from .disk_cache import DiskCache, link_or_copy
+from .encode_profiles import get_encode_profile, get_output_targets
 
 SONG_ROOT_PATH = "songs/"
+# Shared memory, for small files ffmpeg can only read from a path
+MEMORY_DIR = "/dev/shm"
+# Lines of a subprocess's stderr kept for its error message
+STDERR_LINES = 200
+MAX_LINE_LENGTH = 4096
+READ_SIZE = 64 * 1024
+CPU_GRACE_SECONDS = 5
+# How often a running subprocess is checked for timeout and cancellation
+POLL_SECONDS = 0.5
+# ffprobe only reads a file's header, so it's killed long before ffmpeg would be
+PROBE_TIMEOUT_SECONDS = 60
+# How the accompaniment is encoded for videos. Part of the encoded audio's
+# cache key, so changing it never reuses audio encoded the old way.
+AUDIO_CODEC = ["-c:a", "libmp3lame"]
 
 
 def run(
-    lyricsfile: Path,
-    songfile: Path,
-    timingsfile: Path,
+    songfile: Path | None,
     lyric_subtitles: str,
     output_filename: str = "karaoke.mp4",
     audio_delay: float = 0.0,
     metadata: dict = {},
     background_color: str = "#000000",
-):
-    song_files_dir = songfile.parent
-    instrumental_path = song_files_dir.joinpath("accompaniment.wav")
-    vocal_path = song_files_dir.joinpath("vocals.wav")
+    encode_profile: str | None = None,
+    separation_id: str | None = None,
+    output_dir: Path | None = None,
+    targets: list[str] | None = None,
+    progress: Callable[..., None] | None = None,
+    cancelled: Callable[[], bool] | None = None,
+    store: DiskCache | None = None,
+) -> dict[str, Path]:
+    """
+    Render a karaoke video of songfile to output_dir, which defaults to the
+    song's dir. With separation_id, the accompaniment of that earlier
+    separation is used instead of separating songfile. targets names the
+    outputs to make, from encode_profiles.OUTPUT_TARGETS, named as
+    output_filenames() names them. Return each target's path. Rendering stops
+    with ProcessCancelled once cancelled() returns True. Artifacts are kept in
+    store, by default the artifact store.
+    """
+    from .pipeline import ArtifactMissing, Pipeline, output_file
 
-    if instrumental_path.exists() and vocal_path.exists():
-        click.echo(f"Using existing instrumental track at {instrumental_path}")
+    output_dir = output_dir or songfile.parent
+    pipeline = Pipeline(output_dir, store=store, progress=progress, cancelled=cancelled)
+    if separation_id:
+        separation = pipeline.load(separation_id, "separate")
+        if separation is None:
+            raise ArtifactMissing(f"Separation {separation_id} isn't available anymore")
+        click.echo(f"Using instrumental track from {separation_id}")
     else:
         click.echo("Splitting song into instrumental and vocal tracks..")
-        instrumental_path, vocal_path = music_separation.split_song(
-            songfile, song_files_dir
-        )
-        click.echo(f"Wrote instrumental track to {instrumental_path}")
-
-    fonts_dir = settings.BASE_DIR / "assets" / "fonts"
+        separation = pipeline.separate(pipeline.ingest(songfile))
+        click.echo(f"Wrote instrumental track to {separation.id}")
 
-    return create_video(
-        instrumental_path,
+    rendered = pipeline.render(
+        separation,
         lyric_subtitles,
-        output_dir=song_files_dir,
-        fonts_dir=fonts_dir,
-        filename=output_filename,
         audio_delay=audio_delay,
         metadata=metadata,
         background_color=background_color,
+        encode_profile=encode_profile,
+        targets=targets,
     )
+    outputs = {}
+    for name, filename in output_filenames(output_filename, targets).items():
+        outputs[name] = link_or_copy(
+            rendered.files[output_file(name)], output_dir / filename
+        )
+    return outputs
+
+
+def output_filenames(filename: str, targets: list[str] | None = None) -> dict[str, str]:
+    """Name each target's output after filename. The target's name is added
+    only when another of targets makes the same kind of file."""
+    targets = get_output_targets(targets)
+    stem = Path(filename).stem
+    suffixes = [target.suffix for target in targets.values()]
+    filenames = {}
+    for name, target in targets.items():
+        if suffixes.count(target.suffix) > 1:
+            filenames[name] = f"{stem} {name}{target.suffix}"
+        else:
+            filenames[name] = f"{stem}{target.suffix}"
+    return filenames
+
+
+class ProcessTimedOut(IOError):
+    """Raised when a subprocess runs longer than its time limit."""
 
 
-def subprocess_call(cmd):
-    """Executes the given subprocess command."""
+class ProcessCancelled(IOError):
+    """Raised when a subprocess is stopped because nobody wants its output anymore."""
+
+
+@dataclass
+class SubprocessLimits:
+    # Wall-clock seconds before the process is killed
+    timeout: float | None = None
+    # CPU seconds summed over all threads, enforced by the kernel with SIGXCPU
+    cpu_seconds: int | None = None
+    # Niceness, so encodes yield to request handling
+    nice: int = 0
+
+
+def default_limits() -> SubprocessLimits:
+    """Limits from settings, or none when running without Django settings."""
+    if not settings.configured:
+        return SubprocessLimits()
+    return SubprocessLimits(
+        timeout=settings.FFMPEG_TIMEOUT_SECONDS or None,
+        cpu_seconds=settings.FFMPEG_CPU_SECONDS or None,
+        nice=settings.FFMPEG_NICE,
+    )
+
+
+def subprocess_call(
+    cmd,
+    on_progress: Callable[[dict], None] | None = None,
+    cancelled: Callable[[], bool] | None = None,
+    limits: SubprocessLimits | None = None,
+):
+    """Executes the given subprocess command.
+
+    If on_progress is given, cmd must be an ffmpeg command. It is run with
+    -progress, and on_progress is called with each block of progress values.
+    The process is killed when limits.timeout passes, raising ProcessTimedOut,
+    or when cancelled() returns True, raising ProcessCancelled. Only the last
+    STDERR_LINES lines of stderr are kept, for the error message.
+    """
     logger = logging.getLogger("shell")
+    limits = limits or default_limits()
+    if on_progress:
+        cmd = [cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]]
     logger.info("Running:\n>>> " + " ".join(cmd))
 
-    popen_params = {"stdout": sp.DEVNULL, "stderr": sp.PIPE, "stdin": sp.DEVNULL}
+    popen_params = {
+        "stdout": sp.PIPE if on_progress else sp.DEVNULL,
+        "stderr": sp.PIPE,
+        "stdin": sp.DEVNULL,
+    }
 
-    proc = sp.Popen(cmd, **popen_params)
-
-    out, err = proc.communicate()  # proc.wait()
-    proc.stderr.close()
+    stderr: deque[bytes] = deque(maxlen=STDERR_LINES)
+    with metrics.SUBPROCESSES_RUNNING.track_in_progress(command=Path(cmd[0]).name):
+        proc = sp.Popen(cmd, **popen_params)
+        # Read both pipes on other threads so neither can fill up and stall the
+        # process, while this thread watches the clock
+        readers = [
+            threading.Thread(target=stderr.extend, args=(read_lines(proc.stderr),))
+        ]
+        if on_progress:
+            readers.append(
+                threading.Thread(
+                    target=_report_progress, args=(proc.stdout, on_progress, logger)
+                )
+            )
+        try:
+            _apply_limits(proc.pid, limits)
+            for reader in readers:
+                reader.start()
+            _wait(proc, limits.timeout, cancelled)
+        finally:
+            if proc.poll() is None:
+                logger.warning(f"Killing {cmd[0]} (pid {proc.pid})")
+                proc.kill()
+                proc.wait()
+            for reader in readers:
+                if reader.ident is not None:
+                    reader.join()
+            proc.stderr.close()
+            if proc.stdout:
+                proc.stdout.close()
 
     if proc.returncode:
         logger.info("Command returned an error")
-        raise IOError(err.decode("utf8"))
+        err = b"\n".join(stderr).decode("utf8", "replace")
+        if proc.returncode == -signal.SIGXCPU:
+            err = f"{cmd[0]} used more than {limits.cpu_seconds}s of CPU time\n{err}"
+        raise IOError(err)
     else:
         logger.info("Command successful")
 
-    del proc
+
+def _apply_limits(pid: int, limits: SubprocessLimits) -> None:
+    # Applied to the running child, because preexec_fn isn't safe in threaded servers
+    try:
+        if limits.nice:
+            # Niceness can only go up, so never below this process's own
+            nice = max(limits.nice, os.getpriority(os.PRIO_PROCESS, 0))
+            os.setpriority(os.PRIO_PROCESS, pid, nice)
+        if limits.cpu_seconds:
+            # SIGXCPU at the soft limit, SIGKILL at the hard one if it's ignored
+            resource.prlimit(
+                pid,
+                resource.RLIMIT_CPU,
+                (limits.cpu_seconds, limits.cpu_seconds + CPU_GRACE_SECONDS),
+            )
+    except ProcessLookupError:
+        # It already exited
+        pass
+
+
+def _wait(
+    proc: sp.Popen, timeout: float | None, cancelled: Callable[[], bool] | None
+) -> None:
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        try:
+            proc.wait(POLL_SECONDS)
+            return
+        except sp.TimeoutExpired:
+            pass
+        if deadline and time.monotonic() > deadline:
+            raise ProcessTimedOut(f"{proc.args[0]} took longer than {timeout}s")
+        if cancelled and cancelled():
+            raise ProcessCancelled(f"{proc.args[0]} was cancelled")
+
+
+def _report_progress(
+    stdout: IO[bytes], on_progress: Callable[[dict], None], logger: logging.Logger
+) -> None:
+    for values in parse_progress(stdout):
+        try:
+            on_progress(values)
+        except Exception:
+            logger.exception("Reporting progress failed")
+
+
+def read_lines(stream: IO[bytes], max_length: int = MAX_LINE_LENGTH) -> Iterator[bytes]:
+    """Yield the lines of stream as they arrive, split on newlines and carriage returns.
+
+    ffmpeg redraws its status line with a carriage return, so without splitting
+    on those one line could grow for the whole encode. Lines longer than
+    max_length are cut.
+    """
+    pending = b""
+    while chunk := stream.read1(READ_SIZE):
+        lines = re.split(rb"[\r\n]", pending + chunk)
+        pending = lines.pop()[:max_length]
+        for line in lines:
+            if line:
+                yield line[:max_length]
+    if pending:
+        yield pending
+
+
+def parse_progress(stream: IO[bytes]) -> Iterator[dict[str, str]]:
+    """Parse ffmpeg -progress output. Yield the values of each progress block."""
+    values = {}
+    for line in stream:
+        key, _, value = line.decode("utf8", "replace").strip().partition("=")
+        values[key] = value
+        # Each block ends with progress=continue, or progress=end for the last
+        if key == "progress":
+            yield values
+            values = {}
+
+
+def audio_duration(path: Path) -> float:
+    """Return the duration of an audio file in seconds. Raise ProcessTimedOut
+    if ffprobe takes longer than PROBE_TIMEOUT_SECONDS."""
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "format=duration",
+        "-of",
+        "csv=p=0",
+        str(path),
+    ]
+    try:
+        output = sp.check_output(cmd, stdin=sp.DEVNULL, timeout=PROBE_TIMEOUT_SECONDS)
+    except sp.TimeoutExpired as e:
+        raise ProcessTimedOut(f"ffprobe took over {e.timeout}s on {path.name}")
+    return float(output)
+
+
+def render_progress_reporter(
+    progress: Callable[..., None], duration: float | None
+) -> Callable[[dict], None]:
+    """Turn ffmpeg progress values into render progress events."""
+
+    def report(values: dict[str, str]) -> None:
+        try:
+            seconds = int(values.get("out_time_us", "")) / 1_000_000
+        except ValueError:
+            seconds = 0.0
+        event = {
+            "frame": int(values.get("frame", 0) or 0),
+            "seconds": round(seconds, 2),
+            "speed": values.get("speed"),
+        }
+        if duration:
+            event["percent"] = min(100, round(100 * seconds / duration, 1))
+        progress("render", **event)
+
+    return report
 
 
 def get_metadata_args(metadata: dict) -> list[str]:
@@ -84,6 +335,59 @@ def get_metadata_args(metadata: dict) -> list[str]:
     return result
 
 
+@contextmanager
+def subtitles_file(subtitles: str) -> Iterator[str]:
+    """Write subtitles to a temporary file for ffmpeg's ass filter. Yield its path.
+
+    The file goes in shared memory where there is any, so it never touches the disk.
+    """
+    directory = MEMORY_DIR if os.access(MEMORY_DIR, os.W_OK) else None
+    with tempfile.NamedTemporaryFile(
+        "w", suffix=".ass", dir=directory, encoding="utf8"
+    ) as f:
+        f.write(subtitles)
+        f.flush()
+        yield f.name
+
+
+def background_args(
+    background_color: str, size: tuple[int, int], fps: int
+) -> list[str]:
+    """Get ffmpeg arguments for an input that is a plain background of size."""
+    width, height = size
+    return [
+        "-f",
+        "lavfi",
+        "-i",
+        f"color=c=0x{background_color[1:]}:s={width}x{height}:r={fps}",
+    ]
+
+
+def subtitle_filters(
+    subtitle_filter: str, sizes: list[tuple[int, int]]
+) -> tuple[list[str], list[str]]:
+    """
+    Return filtergraph chains that burn subtitles into the first input's video
+    once and split it into a copy for each of sizes, and the copies' labels.
+
+    The first input has to be the largest of sizes. The smaller copies are
+    scaled down from it, so every size shows the same layout.
+    """
+    largest = max(sizes)
+    chains = [
+        f"[0:v]{subtitle_filter},split={len(sizes)}"
+        + "".join(f"[s{i}]" for i in range(len(sizes)))
+    ]
+    labels = []
+    for i, (width, height) in enumerate(sizes):
+        if (width, height) == largest:
+            labels.append(f"[s{i}]")
+        else:
+            chains.append(f"[s{i}]scale={width}:{height}[v{i}]")
+            labels.append(f"[v{i}]")
+    return chains, labels
+
+
 def create_video(
     audio_path: Path,
     subtitles: str,
@@ -93,44 +397,184 @@ def create_video(
     audio_delay: float = 0.0,
     metadata: dict = {},
     background_color: str = "#000000",
-):
+    encode_profile: str | None = None,
+    targets: list[str] | None = None,
+    progress: Callable[..., None] | None = None,
+    cancelled: Callable[[], bool] | None = None,
+) -> dict[str, Path]:
     """
     Run ffmpeg to create the karaoke video.
-    """
-    ass_path = output_dir.joinpath("subtitles.ass")
-    ass_path.write_text(subtitles)
 
-    video_path = str(output_dir.joinpath(filename))
+    encode_profile names one of encode_profiles.ENCODE_PROFILES, and targets
+    the outputs to make from encode_profiles.OUTPUT_TARGETS. All of them come
+    from one ffmpeg run, so the accompaniment is decoded and delayed once and
+    the subtitles are rendered once. Return each target's path.
+    """
+    profile = get_encode_profile(encode_profile)
+    targets = get_output_targets(targets)
+    paths = {
+        name: output_dir.joinpath(output_filename)
+        for name, output_filename in output_filenames(filename, list(targets)).items()
+    }
     audio_delay_ms = int(audio_delay * 1000)  # milliseconds
     video_metadata = get_metadata_args(metadata)
-    subtitle_arg = f"ass={ass_path}:fontsdir={str(fonts_dir)}"
-    ffmpeg_cmd = [
-        "ffmpeg",
-        # Describe a video stream that is a black background
-        "-f",
-        "lavfi",
-        "-i",
-        f"color=c=0x{background_color[1:]}:s=1280x720:r=20",
-        # Use accompaniment track as audio
-        "-i",
-        str(audio_path),
-        # Set audio delay if needed
+    on_progress = None
+    if progress:
+        try:
+            duration = audio_duration(audio_path) + audio_delay
+        except (sp.CalledProcessError, ValueError):
+            duration = None
+        on_progress = render_progress_reporter(progress, duration)
+    sizes = [target.size for target in targets.values() if target.size]
+    with subtitles_file(subtitles) as ass_path:
+        inputs = []
+        graph = []
+        video_labels = iter([])
+        if sizes:
+            # Describe a video stream that is a plain background, at the
+            # largest size
+            inputs = background_args(background_color, max(sizes), profile.fps)
+            # Add subtitles
+            chains, labels = subtitle_filters(
+                f"ass={ass_path}:fontsdir={str(fonts_dir)}", sizes
+            )
+            graph += chains
+            video_labels = iter(labels)
+        # Set audio delay if needed, and give each output a copy
         # https://ffmpeg.org/ffmpeg-filters.html#adelay
-        "-af",
-        f"adelay=delays={audio_delay_ms}:all=1",
-        # Re-encode audio as mp3
-        "-c:a",
-        "libmp3lame",
-        # Add subtitles
-        "-vf",
-        subtitle_arg,
-        # End encoding after the shortest stream
-        "-shortest",
-        # Overwrite files without asking
-        "-y",
-        *video_metadata,
-        # Output path of video
-        video_path,
-    ]
-    subprocess_call(ffmpeg_cmd)
-    return True
+        audio_input = 1 if sizes else 0
+        graph.append(
+            f"[{audio_input}:a]adelay=delays={audio_delay_ms}:all=1,asplit={len(targets)}"
+            + "".join(f"[a{i}]" for i in range(len(targets)))
+        )
+        outputs = []
+        for i, (name, target) in enumerate(targets.items()):
+            if target.size:
+                outputs += [
+                    "-map",
+                    next(video_labels),
+                    *profile.video_args(),
+                    # End encoding after the shortest stream
+                    "-shortest",
+                ]
+            outputs += [
+                "-map",
+                f"[a{i}]",
+                # Re-encode audio as mp3
+                *AUDIO_CODEC,
+                *video_metadata,
+                str(paths[name]),
+            ]
+        ffmpeg_cmd = [
+            "ffmpeg",
+            *inputs,
+            # Use accompaniment track as audio
+            "-i",
+            str(audio_path),
+            "-filter_complex",
+            ";".join(graph),
+            # Overwrite files without asking
+            "-y",
+            *outputs,
+        ]
+        subprocess_call(ffmpeg_cmd, on_progress=on_progress, cancelled=cancelled)
+    return paths
+
+
+def encode_audio(
+    audio_path: Path,
+    output_path: Path,
+    audio_delay: float = 0.0,
+    cancelled: Callable[[], bool] | None = None,
+) -> Path:
+    """Encode the accompaniment for the video, delayed by audio_delay seconds."""
+    audio_delay_ms = int(audio_delay * 1000)  # milliseconds
+    subprocess_call(
+        [
+            "ffmpeg",
+            "-i",
+            str(audio_path),
+            "-af",
+            f"adelay=delays={audio_delay_ms}:all=1",
+            *AUDIO_CODEC,
+            "-y",
+            str(output_path),
+        ],
+        cancelled=cancelled,
+    )
+    return output_path
+
+
+def burn_subtitles(
+    subtitles: str,
+    outputs: dict[Path, tuple[int, int]],
+    duration: float,
+    fonts_dir: Path,
+    background_color: str = "#000000",
+    encode_profile: str | None = None,
+    progress: Callable[..., None] | None = None,
+    cancelled: Callable[[], bool] | None = None,
+) -> list[Path]:
+    """Render duration seconds of subtitles on a plain background, without
+    audio, to each path in outputs at its size. The subtitles are rendered once."""
+    profile = get_encode_profile(encode_profile)
+    on_progress = render_progress_reporter(progress, duration) if progress else None
+    sizes = list(outputs.values())
+    with subtitles_file(subtitles) as ass_path:
+        chains, labels = subtitle_filters(
+            f"ass={ass_path}:fontsdir={str(fonts_dir)}", sizes
+        )
+        output_args = []
+        for label, path in zip(labels, outputs):
+            output_args += [
+                "-map",
+                label,
+                *profile.video_args(),
+                "-t",
+                f"{duration:.3f}",
+                str(path),
+            ]
+        subprocess_call(
+            [
+                "ffmpeg",
+                *background_args(background_color, max(sizes), profile.fps),
+                "-filter_complex",
+                ";".join(chains),
+                "-y",
+                *output_args,
+            ],
+            on_progress=on_progress,
+            cancelled=cancelled,
+        )
+    return list(outputs)
+
+
+def mux(
+    video_path: Path | None,
+    audio_path: Path,
+    output_path: Path,
+    metadata: dict = {},
+    cancelled: Callable[[], bool] | None = None,
+) -> Path:
+    """Combine a video-only and an audio-only file without re-encoding either.
+    Without video_path, only the audio is copied, to tag it with metadata."""
+    inputs = ["-i", str(audio_path)]
+    maps = ["-map", "0:a"]
+    if video_path:
+        inputs = ["-i", str(video_path), *inputs]
+        maps = ["-map", "0:v", "-map", "1:a"]
+    subprocess_call(
+        [
+            "ffmpeg",
+            *inputs,
+            *maps,
+            "-c",
+            "copy",
+            "-shortest",
+            "-y",
+            *get_metadata_args(metadata),
+            str(output_path),
+        ],
+        cancelled=cancelled,
+    )
+    return output_path
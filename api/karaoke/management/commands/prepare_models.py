@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from karaoke import music_separation, warmup
+
+
+class Command(BaseCommand):
+    help = (
+        "Verify the separation models, download any that are missing, and warm them up"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--model",
+            action="append",
+            dest="models",
+            choices=music_separation.AVAILABLE_MODELS,
+            help="Model to prepare (default: every available model)",
+        )
+        parser.add_argument(
+            "--no-fetch",
+            action="store_false",
+            dest="fetch",
+            help="Fail instead of downloading missing models",
+        )
+        parser.add_argument(
+            "--no-ort",
+            action="store_false",
+            dest="convert",
+            help="Don't make the ORT format copies that let workers share models",
+        )
+        parser.add_argument(
+            "--no-warm-up",
+            action="store_false",
+            dest="warm",
+            help="Only verify the models, without loading them",
+        )
+
+    def handle(
+        self, *args, models=None, fetch=True, warm=True, convert=True, **options
+    ):
+        ready = warmup.prepare_models(models, fetch=fetch, warm=warm, convert=convert)
+        for model_name, report in warmup.readiness()["models"].items():
+            if "error" in report:
+                self.stderr.write(f"{model_name}: {report['error']}")
+            elif "warmUpSeconds" in report:
+                self.stdout.write(f"{model_name}: ready in {report['warmUpSeconds']}s")
+            else:
+                self.stdout.write(f"{model_name}: verified")
+        if not ready:
+            raise CommandError("Some models aren't ready")
@@ -0,0 +1,151 @@
+"""
+Per-process pool of loaded separation models.
+
+Loading a model means reading the weights and building an ONNX Runtime session,
+which is a large fixed cost compared to separating a short song. The pool keeps
+loaded separators around between requests so that cost is only paid once per
+model per process.
+
+A separator holds per-file state while it is separating, so each one is only
+ever handed to a single thread at a time. If every loaded separator for a model
+is busy, another one is loaded for the caller.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PooledSeparator:
+    model_name: str
+    separator: Any
+    size_bytes: int
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class SeparatorPool:
+    """
+    Thread-safe pool of loaded separators, keyed by model name.
+
+    `loader` builds a ready-to-use separator for a model name, and
+    `size_estimator` returns roughly how many bytes of memory one costs.
+    Idle separators are dropped once they have been unused for `idle_timeout`
+    seconds, or least-recently-used first when the pool grows past
+    `memory_budget_bytes`. A value of 0 disables either limit.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[str], Any],
+        size_estimator: Callable[[str], int] = lambda model_name: 0,
+        memory_budget_bytes: int = 0,
+        idle_timeout: float = 0,
+    ):
+        self._loader = loader
+        self._size_estimator = size_estimator
+        self.memory_budget_bytes = memory_budget_bytes
+        self.idle_timeout = idle_timeout
+
+        self._lock = threading.Lock()
+        self._idle: list[PooledSeparator] = []
+        self._busy_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def checkout(self, model_name: str) -> Iterator[Any]:
+        """Borrow a loaded separator for model_name, loading one if needed."""
+        entry = self._take_idle(model_name)
+        if entry is None:
+            entry = self._load(model_name)
+        try:
+            yield entry.separator
+        finally:
+            self._release(entry)
+
+    def preload(self, model_names: list[str]) -> None:
+        """Load one separator for each model that doesn't have one idle yet."""
+        for model_name in model_names:
+            with self._lock:
+                loaded = any(e.model_name == model_name for e in self._idle)
+            if not loaded:
+                with self.checkout(model_name):
+                    pass
+
+    def evict_idle(self) -> int:
+        """Drop separators that have been idle too long. Return how many were dropped."""
+        with self._lock:
+            return len(self._evict_locked())
+
+    def clear(self) -> None:
+        """Drop every idle separator."""
+        with self._lock:
+            self._idle.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "idle": len(self._idle),
+                "idle_bytes": sum(e.size_bytes for e in self._idle),
+                "busy_bytes": self._busy_bytes,
+            }
+
+    def _take_idle(self, model_name: str) -> PooledSeparator | None:
+        with self._lock:
+            self._evict_locked()
+            # Prefer the most recently used separator, its pages are most likely resident
+            for entry in reversed(self._idle):
+                if entry.model_name == model_name:
+                    self._idle.remove(entry)
+                    self._busy_bytes += entry.size_bytes
+                    self.hits += 1
+                    return entry
+            self.misses += 1
+            return None
+
+    def _load(self, model_name: str) -> PooledSeparator:
+        # Loading takes seconds, so it happens outside the lock
+        start = time.perf_counter()
+        separator = self._loader(model_name)
+        entry = PooledSeparator(
+            model_name=model_name,
+            separator=separator,
+            size_bytes=self._size_estimator(model_name),
+        )
+        logger.info(
+            f"Loaded separator for {model_name} in {time.perf_counter() - start:.2f}s"
+        )
+        with self._lock:
+            self._busy_bytes += entry.size_bytes
+        return entry
+
+    def _release(self, entry: PooledSeparator) -> None:
+        entry.last_used = time.monotonic()
+        with self._lock:
+            self._busy_bytes -= entry.size_bytes
+            self._idle.append(entry)
+            evicted = self._evict_locked()
+        for e in evicted:
+            logger.info(f"Evicted idle separator for {e.model_name}")
+
+    def _evict_locked(self) -> list[PooledSeparator]:
+        evicted = []
+        if self.idle_timeout:
+            cutoff = time.monotonic() - self.idle_timeout
+            evicted = [e for e in self._idle if e.last_used < cutoff]
+            self._idle = [e for e in self._idle if e.last_used >= cutoff]
+        if self.memory_budget_bytes:
+            # _idle is kept in release order, so the front is least recently used
+            total = self._busy_bytes + sum(e.size_bytes for e in self._idle)
+            while self._idle and total > self.memory_budget_bytes:
+                entry = self._idle.pop(0)
+                total -= entry.size_bytes
+                evicted.append(entry)
+        return evicted
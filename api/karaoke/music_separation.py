@@ -1,5 +1,14 @@
 import logging
+import threading
+import time
 from pathlib import Path
+from typing import Callable
+
+from django.conf import settings
+from helpers import metrics
+
+from . import onnx_threads, shared_models
+from .model_pool import SeparatorPool
 
 MODELS_DIR = Path.cwd() / "pretrained_models"
 DEFAULT_MODEL = "UVR_MDXNET_KARA_2.onnx"
@@ -10,9 +19,74 @@ AVAILABLE_MODELS = [
     "UVR-MDX-NET-Inst_HQ_3.onnx",  # Removes background vocals
 ]
 
+# audio_separator's defaults, which it only uses if mdx_params isn't given
+MDX_PARAMS = {
+    "hop_length": 1024,
+    "segment_size": 256,
+    "overlap": 0.25,
+    "batch_size": 1,
+    "enable_denoise": False,
+}
+
+_separator_pool: SeparatorPool | None = None
+# Set by load_separator, so split_song can tell whether its checkout loaded a model
+_loads = threading.local()
+
+
+def load_separator(model_name: str):
+    """Build a Separator with model_name loaded and ready to separate."""
+    from audio_separator.separator import Separator
+
+    with metrics.STAGE_SECONDS.time(stage="model_load"):
+        separator = Separator(
+            model_file_dir=MODELS_DIR,
+            mdx_params={
+                **MDX_PARAMS,
+                "batch_size": settings.SEPARATION_BATCH_SIZE,
+            },
+        )
+        # configure() builds the session the model runs with
+        shared_models.defer_sessions()
+        separator.load_model(model_name)
+        onnx_threads.configure(separator)
+    _loads.loaded = True
+    return separator
+
+
+def model_size(model_name: str) -> int:
+    """Approximate memory cost of a loaded model, which is dominated by its weights."""
+    model_path = MODELS_DIR / model_name
+    return model_path.stat().st_size if model_path.exists() else 0
+
+
+def get_separator_pool() -> SeparatorPool:
+    """Return this process's pool of loaded separators."""
+    global _separator_pool
+    if _separator_pool is None:
+        _separator_pool = SeparatorPool(
+            loader=load_separator,
+            size_estimator=model_size,
+            memory_budget_bytes=settings.SEPARATOR_POOL_MEMORY_MB * 1024 * 1024,
+            idle_timeout=settings.SEPARATOR_POOL_IDLE_SECONDS,
+        )
+    return _separator_pool
+
+
+def set_output_dir(separator, output_dir: Path) -> None:
+    """Point a loaded separator at a new output directory.
+
+    The architecture-specific model instance copies output_dir when the model is
+    loaded, so both need updating when a pooled separator is reused.
+    """
+    separator.output_dir = str(output_dir)
+    separator.model_instance.output_dir = str(output_dir)
+
 
 def split_song(
-    songfile: Path, song_dir: Path, model_name: str = DEFAULT_MODEL
+    songfile: Path,
+    song_dir: Path,
+    model_name: str = DEFAULT_MODEL,
+    progress: Callable[..., None] | None = None,
 ) -> tuple[Path, Path]:
     """
     Split song into instrumental and vocal tracks.
@@ -34,14 +108,23 @@ def split_song(
             f"Model {model_name} not found. Available models: {AVAILABLE_MODELS}"
         )
 
-    separator = Separator(
-        output_dir=str(song_dir),
-        model_file_dir=MODELS_DIR,
-    )
-
-    separator.load_model(model_name)
-
-    tracks = separator.separate(str(songfile))
+    load_start = time.perf_counter()
+    _loads.loaded = False
+    with get_separator_pool().checkout(model_name) as separator:
+        metrics.cache_lookup("models", hit=not _loads.loaded)
+        if progress:
+            progress(
+                "model_loaded",
+                model=model_name,
+                seconds=round(time.perf_counter() - load_start, 2),
+            )
+            progress("separation", percent=0)
+        set_output_dir(separator, song_dir)
+        with metrics.SEPARATIONS_RUNNING.track_in_progress():
+            with metrics.STAGE_SECONDS.time(stage="separation"):
+                tracks = separator.separate(str(songfile))
+    if progress:
+        progress("separation", percent=100)
 
     # The order of tracks in the output is not consistent, sadly
     if model_name in ["UVR_MDXNET_KARA_2.onnx", "UVR-MDX-NET-Inst_HQ_3.onnx"]:
@@ -54,3 +137,19 @@ def split_song(
     accompaniment_path = song_dir / accompaniment_filename
     vocals_path = song_dir / vocals_filename
     return accompaniment_path, vocals_path
+
+
+def split_song_auto(
+    songfile: Path,
+    song_dir: Path,
+    model_name: str = DEFAULT_MODEL,
+    progress: Callable[..., None] | None = None,
+) -> tuple[Path, Path]:
+    """Split song, separating windows in parallel if it's long enough to benefit."""
+    from . import chunked_separation
+
+    if chunked_separation.should_chunk(songfile):
+        return chunked_separation.split_song_chunked(
+            songfile, song_dir, model_name=model_name, progress=progress
+        )
+    return split_song(songfile, song_dir, model_name=model_name, progress=progress)
@@ -0,0 +1,157 @@
+"""
+Thread counts and core pinning for separation inference.
+
+Left alone, every ONNX Runtime session starts one intra-op thread per core, so
+a few separations at once run many times more threads than there are cores
+and all of them crawl. Here each loaded separator gets a session with a fixed
+number of threads, by default the cores divided between the separations that
+admission control lets run at once.
+
+With SEPARATION_PIN_CORES, each loaded separator also reserves a block of
+cores of its own, host-wide, and its intra-op threads are pinned to it. The
+reservation is a lock file under ADMISSION_DIR, held until the separator is
+dropped from the pool. When every block is taken the session runs unpinned.
+"""
+import fcntl
+import logging
+import os
+import weakref
+from dataclasses import dataclass
+from pathlib import Path
+
+from django.conf import settings
+
+from . import shared_models
+
+# Separations sharing this process's cores, when it isn't the admission limit.
+# Chunked separation workers set it to the number of workers.
+_concurrency: int | None = None
+
+
+@dataclass
+class ThreadPolicy:
+    intra_op_threads: int
+    inter_op_threads: int = 1
+    # Logical CPUs to pin intra-op threads to, if any
+    cores: list[int] | None = None
+
+
+def set_concurrency(concurrency: int) -> None:
+    """Share this process's cores between concurrency separations."""
+    global _concurrency
+    _concurrency = concurrency
+
+
+def separation_concurrency() -> int:
+    if _concurrency:
+        return _concurrency
+    from helpers import admission
+
+    return admission.get_limiter(admission.SEPARATION).limit
+
+
+def thread_policy() -> ThreadPolicy:
+    """The thread counts settings ask for, or an even share of the cores."""
+    cores = len(os.sched_getaffinity(0))
+    intra_op_threads = settings.SEPARATION_INTRA_OP_THREADS or max(
+        1, cores // separation_concurrency()
+    )
+    return ThreadPolicy(
+        intra_op_threads=intra_op_threads,
+        inter_op_threads=settings.SEPARATION_INTER_OP_THREADS,
+    )
+
+
+def core_blocks(cores: list[int], size: int) -> list[list[int]]:
+    """Split cores into whole blocks of size cores."""
+    return [cores[i : i + size] for i in range(0, len(cores) - size + 1, size)]
+
+
+def reserve_cores(owner: object, size: int, directory: Path) -> list[int] | None:
+    """Reserve a block of size cores for as long as owner lives. Return the
+    cores, or None if every block is taken."""
+    directory.mkdir(parents=True, exist_ok=True)
+    for block in core_blocks(sorted(os.sched_getaffinity(0)), size):
+        path = directory / f"cores-{block[0]}-{block[-1]}.lock"
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        weakref.finalize(owner, os.close, fd)
+        return block
+    return None
+
+
+def session_options(policy: ThreadPolicy, concurrency: int = 1):
+    """ONNX Runtime session options for policy."""
+    import onnxruntime as ort
+
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = policy.intra_op_threads
+    options.inter_op_num_threads = policy.inter_op_threads
+    options.execution_mode = (
+        ort.ExecutionMode.ORT_SEQUENTIAL
+        if policy.inter_op_threads == 1
+        else ort.ExecutionMode.ORT_PARALLEL
+    )
+    options.log_severity_level = 3
+    if concurrency > 1:
+        # Spinning threads waste cores other separations could use
+        options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+    if policy.cores and policy.intra_op_threads > 1:
+        # One entry per pool thread; the calling thread is the intra-op
+        # thread left over. ONNX Runtime counts processors from 1.
+        options.add_session_config_entry(
+            "session.intra_op_thread_affinities",
+            ";".join(str(core + 1) for core in policy.cores[1:]),
+        )
+    return options
+
+
+def configure(separator) -> ThreadPolicy | None:
+    """Rebuild a loaded separator's inference session with a thread policy.
+
+    Only ONNX models run through audio_separator's own session, and only those
+    are rebuilt. Return the policy applied, or None if the model was left as is.
+    """
+    model = separator.model_instance
+    model_path = str(getattr(model, "model_path", ""))
+    # Models whose segment size differs from the ONNX graph's run converted to
+    # torch instead, without a session to rebuild
+    runs_session = getattr(model, "segment_size", None) == getattr(model, "dim_t", None)
+    if not model_path.endswith(".onnx") or not runs_session:
+        return None
+    import onnxruntime as ort
+
+    policy = thread_policy()
+    concurrency = separation_concurrency()
+    if settings.SEPARATION_PIN_CORES:
+        policy.cores = reserve_cores(
+            separator, policy.intra_op_threads, Path(settings.ADMISSION_DIR)
+        )
+        if policy.cores is None:
+            logging.warning("No free block of cores to pin the separator to")
+    providers = getattr(model, "onnx_execution_provider", None) or getattr(
+        separator, "onnx_execution_provider", None
+    )
+    options = session_options(policy, concurrency)
+    session = ort.InferenceSession(
+        shared_models.session_source(model_path, options),
+        sess_options=options,
+        providers=providers,
+    )
+    model.model_run = lambda spek: session.run(None, {"input": spek.cpu().numpy()})[0]
+    try:
+        import torch
+
+        # torch does the STFTs around inference, with a pool of its own
+        torch.set_num_threads(policy.intra_op_threads)
+    except ModuleNotFoundError:
+        pass
+    logging.info(
+        f"Separator uses {policy.intra_op_threads} intra-op and "
+        f"{policy.inter_op_threads} inter-op threads, pinned to {policy.cores}"
+    )
+    return policy
@@ -0,0 +1,311 @@
+"""
+Separation and rendering as a pipeline of stages with reusable outputs.
+
+Rendering a video runs these stages:
+
+    ingest          the uploaded song
+    separate        accompaniment and vocals
+    encode_audio    the delayed accompaniment, encoded for the video
+    burn_subtitles  the subtitles rendered on a plain background, without audio
+    mux             the video with its audio
+
+A render can make several output targets at once, as named in
+encode_profiles.OUTPUT_TARGETS. The subtitles are still burned in one ffmpeg
+run, at every target's size, and the audio is encoded once and muxed into
+each, so only the cheap mux work grows with the number of targets.
+
+The views then package the result in a zip. Every stage output is stored
+as an artifact whose id is a hash of the stage's inputs, so a stage whose
+inputs haven't changed is never run twice. Fixing a lyric only reruns
+burn_subtitles and mux, which copies the stored audio without encoding it
+again, and a client that already separated a song can render
+from the separation's id instead of uploading the song again.
+"""
+import hashlib
+import json
+import logging
+import re
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+from django.conf import settings
+from helpers import metrics
+
+from . import make_karaoke_video, music_separation
+from .disk_cache import DiskCache, hash_file, link_or_copy
+from .encode_profiles import OUTPUT_TARGETS, get_output_targets
+
+ARTIFACT_ID_RE = re.compile(r"^[a-z_]+-[0-9a-f]{64}$")
+# Bump to invalidate stored artifacts when a stage's output format changes
+STAGE_VERSION = 1
+
+ACCOMPANIMENT = "accompaniment.wav"
+VOCALS = "vocals.wav"
+AUDIO = "audio.mp3"
+
+_artifact_store: DiskCache | None = None
+
+
+def get_artifact_store() -> DiskCache | None:
+    """Return the on-disk store of pipeline artifacts, or None if it's turned off."""
+    global _artifact_store
+    if _artifact_store is None and settings.ARTIFACTS_MAX_MB:
+        _artifact_store = DiskCache(
+            settings.ARTIFACTS_DIR,
+            max_bytes=settings.ARTIFACTS_MAX_MB * 1024 * 1024,
+        )
+    return _artifact_store
+
+
+class ArtifactMissing(LookupError):
+    """Raised when an artifact a request names was evicted, or never stored."""
+
+
+def check_artifact_id(id: str, stage: str) -> None:
+    """Raise ValueError unless id is the id of an artifact stage made."""
+    if not ARTIFACT_ID_RE.match(id) or not id.startswith(f"{stage}-"):
+        raise ValueError(f"{id} isn't the id of a {stage} artifact")
+
+
+def artifact_exists(id: str, stage: str, store: DiskCache | None = None) -> bool:
+    """Whether store, by default the artifact store, holds the artifact id."""
+    check_artifact_id(id, stage)
+    store = store or get_artifact_store()
+    return store is not None and (store.root / id).is_dir()
+
+
+def artifact_id(stage: str, *inputs) -> str:
+    """Return the id of the artifact stage makes from inputs."""
+    key = json.dumps([STAGE_VERSION, stage, *inputs], sort_keys=True)
+    return f"{stage}-{hashlib.sha256(key.encode('utf8')).hexdigest()}"
+
+
+def video_file(target: str) -> str:
+    """The name of target's video, without audio, in a burn_subtitles artifact."""
+    return f"video-{target}.mp4"
+
+
+def output_file(target: str) -> str:
+    """The name of target's finished output in a mux artifact."""
+    return f"karaoke-{target}{OUTPUT_TARGETS[target].suffix}"
+
+
+@dataclass(frozen=True)
+class Artifact:
+    id: str
+    files: dict[str, Path]
+
+
+class Pipeline:
+    """
+    Runs stages in work_dir, reusing artifacts from store. progress, if given,
+    is told about each stage as it finishes. Once cancelled() returns True, the
+    running ffmpeg stage is killed and no further stage starts.
+    """
+
+    def __init__(
+        self,
+        work_dir: Path,
+        store: DiskCache | None = None,
+        progress: Callable[..., None] | None = None,
+        cancelled: Callable[[], bool] | None = None,
+    ):
+        self.work_dir = Path(work_dir)
+        # None when the store is turned off, so every stage runs
+        self.store = store or get_artifact_store()
+        self.progress = progress
+        self.cancelled = cancelled
+
+    def load(self, id: str, stage: str) -> Artifact | None:
+        """Return the stored artifact id, or None if it isn't stored.
+
+        Raise ValueError if id isn't the id of an artifact stage made.
+        """
+        check_artifact_id(id, stage)
+        if self.store is None:
+            return None
+        files = self.store.fetch(id, self._stage_dir(stage))
+        return Artifact(id, files) if files else None
+
+    def ingest(self, songfile: Path) -> Artifact:
+        song = Artifact(
+            f"ingest-{hash_file(songfile)}", {f"song{songfile.suffix}": songfile}
+        )
+        if self.store and self.store.get(song.id) is None:
+            self.store.put(song.id, song.files)
+        self._report("ingest", song.id)
+        return song
+
+    def separate(self, song: Artifact, model_name: str | None = None) -> Artifact:
+        model_name = model_name or music_separation.DEFAULT_MODEL
+        (songfile,) = song.files.values()
+
+        def build(out_dir: Path) -> dict[str, Path]:
+            accompaniment_path, vocals_path = music_separation.split_song_auto(
+                link_or_copy(songfile, out_dir / songfile.name),
+                out_dir,
+                model_name=model_name,
+                progress=self.progress,
+            )
+            files = {ACCOMPANIMENT: accompaniment_path}
+            # The separator doesn't write stems that are silent
+            if vocals_path.exists():
+                files[VOCALS] = vocals_path
+            return files
+
+        return self._stage("separate", [song.id, model_name], build)
+
+    def encode_audio(self, separation: Artifact, audio_delay: float = 0.0) -> Artifact:
+        return self.encode_accompaniment(separation.files[ACCOMPANIMENT], audio_delay)
+
+    def encode_accompaniment(
+        self, accompaniment: Path, audio_delay: float = 0.0
+    ) -> Artifact:
+        """Encode accompaniment delayed by audio_delay, to be copied into videos as is.
+
+        It's stored by the accompaniment's contents rather than where it came
+        from, so any render of the same audio with the same delay reuses it.
+        """
+        return self._stage(
+            "encode_audio",
+            [
+                hash_file(accompaniment),
+                round(audio_delay, 3),
+                make_karaoke_video.AUDIO_CODEC,
+            ],
+            lambda out_dir: {
+                AUDIO: make_karaoke_video.encode_audio(
+                    accompaniment,
+                    out_dir / AUDIO,
+                    audio_delay,
+                    cancelled=self.cancelled,
+                )
+            },
+        )
+
+    def burn_subtitles(
+        self,
+        subtitles: str,
+        duration: float,
+        background_color: str = "#000000",
+        encode_profile: str | None = None,
+        targets: list[str] | None = None,
+    ) -> Artifact:
+        """Burn the subtitles into a video for each of targets that has video."""
+        sizes = {
+            name: target.size
+            for name, target in get_output_targets(targets).items()
+            if target.size
+        }
+        subtitles_hash = hashlib.sha256(subtitles.encode("utf8")).hexdigest()
+
+        def build(out_dir: Path) -> dict[str, Path]:
+            outputs = {out_dir / video_file(name): size for name, size in sizes.items()}
+            make_karaoke_video.burn_subtitles(
+                subtitles,
+                outputs,
+                duration,
+                fonts_dir=settings.BASE_DIR / "assets" / "fonts",
+                background_color=background_color,
+                encode_profile=encode_profile,
+                progress=self.progress,
+                cancelled=self.cancelled,
+            )
+            return {path.name: path for path in outputs}
+
+        return self._stage(
+            "burn_subtitles",
+            [
+                subtitles_hash,
+                round(duration, 3),
+                background_color,
+                encode_profile,
+                list(sizes),
+            ],
+            build,
+        )
+
+    def mux(
+        self,
+        video: Artifact | None,
+        audio: Artifact,
+        metadata: dict = {},
+        targets: list[str] | None = None,
+    ) -> Artifact:
+        """Make each of targets from its video in video, if it has any, and the audio."""
+        targets = get_output_targets(targets)
+
+        def build(out_dir: Path) -> dict[str, Path]:
+            files = {}
+            for name, target in targets.items():
+                files[output_file(name)] = make_karaoke_video.mux(
+                    video.files[video_file(name)] if target.size else None,
+                    audio.files[AUDIO],
+                    out_dir / output_file(name),
+                    metadata,
+                    cancelled=self.cancelled,
+                )
+            return files
+
+        return self._stage(
+            "mux",
+            [video.id if video else None, audio.id, metadata, list(targets)],
+            build,
+        )
+
+    def render(
+        self,
+        separation: Artifact,
+        subtitles: str,
+        audio_delay: float = 0.0,
+        metadata: dict = {},
+        background_color: str = "#000000",
+        encode_profile: str | None = None,
+        targets: list[str] | None = None,
+    ) -> Artifact:
+        """Run every stage after separation. Return the finished outputs, as
+        named by output_file()."""
+        audio = self.encode_audio(separation, audio_delay)
+        video = None
+        if any(target.size for target in get_output_targets(targets).values()):
+            duration = make_karaoke_video.audio_duration(audio.files[AUDIO])
+            video = self.burn_subtitles(
+                subtitles, duration, background_color, encode_profile, targets
+            )
+        return self.mux(video, audio, metadata, targets)
+
+    def _stage(
+        self,
+        stage: str,
+        inputs: list,
+        build: Callable[[Path], dict[str, Path]],
+    ) -> Artifact:
+        """Return the stored output of stage for inputs, building and storing it if needed."""
+        id = artifact_id(stage, *inputs)
+        out_dir = self._stage_dir(stage)
+        files = None
+        if self.store:
+            files = self.store.fetch(id, out_dir)
+            metrics.cache_lookup("artifacts", hit=bool(files))
+        if files:
+            logging.info(f"Reusing {id}")
+            self._report(stage, id, cached=True)
+            return Artifact(id, files)
+        if self.cancelled and self.cancelled():
+            raise make_karaoke_video.ProcessCancelled(f"Cancelled before {stage}")
+        with metrics.STAGE_SECONDS.time(stage=stage):
+            files = build(out_dir)
+        if self.store:
+            self.store.put(id, files)
+        self._report(stage, id)
+        return Artifact(id, files)
+
+    def _stage_dir(self, stage: str) -> Path:
+        # A fresh dir every time, so files linked from the store never get overwritten
+        return Path(tempfile.mkdtemp(prefix=f"{stage}-", dir=self.work_dir))
+
+    def _report(self, stage: str, id: str, cached: bool = False) -> None:
+        if self.progress:
+            self.progress(stage, artifact=id, cached=cached)
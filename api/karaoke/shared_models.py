@@ -0,0 +1,170 @@
+"""
+Share separation model weights between gunicorn worker processes.
+
+Each worker that loads a model holds its own copy of the weights, so memory
+grows with WORKER_COUNT. With PRELOAD_MODELS, gunicorn's master process reads
+the models into memory before it forks the workers and freezes its objects out
+of the garbage collector. The workers then share those pages copy-on-write.
+
+ONNX Runtime only runs off the caller's buffer, instead of copying the weights
+into its own, for models in its ORT format. So only models with an ORT format
+copy next to the .onnx file are shared. `manage.py prepare_models` makes them
+with convert_to_ort(), and the image runs it while it's built.
+
+audio_separator builds a session from the .onnx file as it loads a model,
+which onnx_threads.configure() then replaces. defer_sessions() keeps that
+first session from being built at all, so workers never hold a private copy
+of the weights, even briefly.
+
+memory_usage() and report_memory() show what each process actually holds, and
+benchmarks/shared_models.py compares workers with and without preloading.
+"""
+import logging
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+from helpers import metrics
+
+from . import music_separation
+
+# ORT format models read before the workers were forked, by .onnx file name
+_preloaded: dict[str, bytes] = {}
+_defer_lock = threading.Lock()
+_deferring = False
+
+
+def ort_path(model_path: Path) -> Path:
+    return model_path.with_suffix(".ort")
+
+
+def convert_to_ort(model_path: Path) -> Path:
+    """Save an ORT format copy of the ONNX model at model_path next to it. Return its path."""
+    import onnxruntime as ort
+
+    path = ort_path(model_path)
+    # Named for this conversion alone, as several workers may convert at once
+    with tempfile.NamedTemporaryFile(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".part", delete=False
+    ) as f:
+        part_path = Path(f.name)
+    options = ort.SessionOptions()
+    # Unlike ORT_ENABLE_ALL, these optimizations don't depend on the CPU, so a
+    # copy made while building the image suits whichever host runs it
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    options.optimized_model_filepath = str(part_path)
+    options.add_session_config_entry("session.save_model_format", "ORT")
+    try:
+        ort.InferenceSession(
+            str(model_path), sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        os.replace(part_path, path)
+    finally:
+        part_path.unlink(missing_ok=True)
+    return path
+
+
+def preload(model_names: list[str] | None = None) -> int:
+    """Read the ORT format copy of each model into memory. Return the bytes read."""
+    total = 0
+    for model_name in model_names or music_separation.AVAILABLE_MODELS:
+        path = ort_path(music_separation.MODELS_DIR / model_name)
+        if not path.exists():
+            logging.info(
+                f"{model_name} has no ORT format copy, so workers load their own"
+            )
+            continue
+        _preloaded[model_name] = path.read_bytes()
+        total += len(_preloaded[model_name])
+    return total
+
+
+def session_source(model_path: str, options) -> str | bytes:
+    """What to build model_path's inference session from: the preloaded model,
+    with options set to run off its buffer, or else the path."""
+    model = _preloaded.get(Path(model_path).name)
+    if model is None:
+        return model_path
+    options.add_session_config_entry("session.use_ort_model_bytes_directly", "1")
+    options.add_session_config_entry(
+        "session.use_ort_model_bytes_for_initializers", "1"
+    )
+    # Prepacked weights are copies in each worker's own memory
+    options.add_session_config_entry("session.disable_prepacking", "1")
+    return model
+
+
+class _DeferredSession:
+    """
+    Stands in for an inference session audio_separator builds while loading a
+    model. onnx_threads.configure() replaces it before it's used, so it's only
+    built for real if something runs it anyway.
+    """
+
+    def __init__(self, session_class, *args, **kwargs):
+        self._build = lambda: session_class(*args, **kwargs)
+        self._session = None
+
+    def __getattr__(self, name):
+        if self._session is None:
+            self._session = self._build()
+        return getattr(self._session, name)
+
+
+def defer_sessions() -> None:
+    """Make audio_separator's MDX models build their inference session only when it's used."""
+    global _deferring
+    with _defer_lock:
+        if _deferring:
+            return
+        try:
+            from audio_separator.separator.architectures import mdx_separator
+
+            real_ort = mdx_separator.ort
+        except (ImportError, AttributeError):
+            logging.warning("This audio_separator's sessions can't be deferred")
+            return
+
+        class DeferringOrt:
+            def __getattr__(self, name):
+                return getattr(real_ort, name)
+
+            def InferenceSession(self, *args, **kwargs):
+                return _DeferredSession(real_ort.InferenceSession, *args, **kwargs)
+
+        mdx_separator.ort = DeferringOrt()
+        _deferring = True
+
+
+def memory_usage(pid: int | str = "self") -> dict[str, int]:
+    """A process's resident, proportional and shared memory, in bytes."""
+    fields = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if value.strip().endswith("kB"):
+                fields[name] = int(value.split()[0]) * 1024
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+    }
+
+
+def report_memory(when: str, export: bool = True) -> None:
+    """Log this process's memory, and unless export is False, export it as a metric."""
+    try:
+        usage = memory_usage()
+    except OSError:
+        # Not Linux
+        return
+    if export:
+        for kind, amount in usage.items():
+            metrics.MEMORY_BYTES.set(amount, kind=kind)
+    logging.info(
+        f"Process {os.getpid()} {when}: "
+        + ", ".join(
+            f"{kind} {amount / 2**20:.0f} MiB" for kind, amount in usage.items()
+        )
+    )
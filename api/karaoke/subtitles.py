@@ -0,0 +1,602 @@
+"""
+Karaoke subtitles in ASS format, laid out from lyrics and their timings.
+
+A port of frontend/lib/timing.ts and adjustments.ts that writes the same file
+the browser does, so videos can be rendered without one. Lyrics are split into
+segments by the same markup: line breaks end lines, blank lines end screens,
+and underscores and slashes split lines into segments. Timings are
+[seconds, marker] events, as saved in timings.json.
+
+Where the frontend builds an object per screen, line and segment, a Layout
+keeps an array per attribute, so each adjustment (count-ins, the title screen,
+staggered lines, instrumental screens) is arithmetic over the whole song at
+once. The arithmetic follows the frontend's step for step, so times round the
+same way in both.
+"""
+import enum
+import math
+import re
+from dataclasses import dataclass, field
+
+import numpy as np
+
+SEGMENT_START = 1
+SEGMENT_END = 2
+
+VIDEO_HEIGHT = 320
+TITLE_SCREEN_DURATION = 4.0
+INSTRUMENTAL_SCREEN_THRESHOLD = 8.0
+FIRST_SCREEN_QUICK_START_THRESHOLD = 1.0
+SCREEN_QUICK_START_THRESHOLD = 2.0
+COUNT_IN_THRESHOLD = 5.0
+COUNT_IN_DURATION = 2.0
+
+COUNT_IN_TEXT = "*** "
+INSTRUMENTAL_TEXT = "|" * 34
+
+# A segment is text up to a line break, slash or underscore, or the end of
+# the lyrics. Line breaks right after one belong to it.
+_SEGMENT = re.compile(r"[^\n/_]*(?:[\n/_]|\Z)\n*")
+
+
+class VerticalAlignment(enum.IntEnum):
+    TOP = 0
+    MIDDLE = 1
+    BOTTOM = 2
+
+
+Color = tuple[int, int, int]
+
+
+@dataclass
+class KaraokeOptions:
+    add_count_ins: bool = True
+    add_instrumental_screens: bool = True
+    add_staggered_lines: bool = True
+    vertical_alignment: VerticalAlignment = VerticalAlignment.MIDDLE
+    font_name: str = "Arial Narrow"
+    font_size: float = 20
+    background_color: Color = (0, 0, 0)
+    primary_color: Color = (255, 0, 255)
+    secondary_color: Color = (0, 255, 255)
+
+    @classmethod
+    def from_dict(cls, options: dict) -> "KaraokeOptions":
+        """Read the frontend's video options. Raise ValueError if they're invalid."""
+        defaults = cls()
+        font = options.get("font", {})
+        color = options.get("color", {})
+        try:
+            return cls(
+                add_count_ins=bool(options.get("addCountIns", defaults.add_count_ins)),
+                add_instrumental_screens=bool(
+                    options.get(
+                        "addInstrumentalScreens", defaults.add_instrumental_screens
+                    )
+                ),
+                add_staggered_lines=bool(
+                    options.get("addStaggeredLines", defaults.add_staggered_lines)
+                ),
+                vertical_alignment=VerticalAlignment(
+                    options.get("verticalAlignment", defaults.vertical_alignment)
+                ),
+                font_name=str(font.get("name", defaults.font_name)),
+                font_size=float(font.get("size", defaults.font_size)),
+                background_color=parse_color(
+                    color.get("background", defaults.background_color)
+                ),
+                primary_color=parse_color(color.get("primary", defaults.primary_color)),
+                secondary_color=parse_color(
+                    color.get("secondary", defaults.secondary_color)
+                ),
+            )
+        except (AttributeError, KeyError, TypeError) as e:
+            raise ValueError(f"Invalid video options: {e}") from e
+
+
+def parse_color(color: str | dict | Color) -> Color:
+    """Read a color given as "#RRGGBB", {"red": .., "green": .., "blue": ..} or (r, g, b)."""
+    if isinstance(color, str):
+        if not re.fullmatch(r"#[0-9a-fA-F]{6}", color):
+            raise ValueError(f"Invalid color: {color}")
+        return tuple(int(color[i : i + 2], 16) for i in (1, 3, 5))
+    if isinstance(color, dict):
+        color = (color["red"], color["green"], color["blue"])
+    return tuple(int(channel) for channel in color)
+
+
+def parse_segments(lyrics: str) -> list[str]:
+    """Split marked up lyrics into segments, each with the line breaks that follow it."""
+    return [
+        match.replace("/", "").replace("_", " ")
+        for match in _SEGMENT.findall(lyrics)
+        if match
+    ]
+
+
+@dataclass
+class Layout:
+    """The screens of a song, as arrays of segment, line and screen attributes.
+
+    Lines are spans of segments and screens are spans of lines, given by their
+    first and last indexes. NaN stands for the frontend's unset values.
+    """
+
+    options: KaraokeOptions
+    title: str
+    artist: str
+    # Segments
+    text: list[str]
+    start: np.ndarray
+    end: np.ndarray
+    # Lines
+    line_first: np.ndarray
+    line_last: np.ndarray
+    line_screen: np.ndarray
+    # Screens
+    screen_first: np.ndarray
+    screen_last: np.ndarray
+    screen_start: np.ndarray
+    # Audio delay needed to keep the song in time with the subtitles
+    audio_delay: float = 0.0
+    # Times to show and hide lines, if not with the rest of their screen
+    display_start: np.ndarray = field(init=False)
+    display_end: np.ndarray = field(init=False)
+    fade_in: np.ndarray = field(init=False)
+    fade_out: np.ndarray = field(init=False)
+    # Start of a count-in before the first segment of each screen
+    count_in: np.ndarray = field(init=False)
+    first_line_margin: np.ndarray = field(init=False)
+    # Instrumental screens shown before each screen
+    instrumental_start: np.ndarray = field(init=False)
+    instrumental_end: np.ndarray = field(init=False)
+
+    def __post_init__(self):
+        lines = len(self.line_first)
+        screens = len(self.screen_first)
+        self.display_start = np.full(lines, np.nan)
+        self.display_end = np.full(lines, np.nan)
+        self.fade_in = np.zeros(lines)
+        self.fade_out = np.zeros(lines)
+        self.count_in = np.full(screens, np.nan)
+        self.first_line_margin = np.full(screens, np.nan)
+        self.instrumental_start = np.full(screens, np.nan)
+        self.instrumental_end = np.full(screens, np.nan)
+
+    @property
+    def line_start(self) -> np.ndarray:
+        """When each line starts animating, count-ins included."""
+        line_start = self.start[self.line_first]
+        heads = self.screen_first
+        line_start[heads] = np.where(
+            np.isnan(self.count_in), line_start[heads], self.count_in
+        )
+        return line_start
+
+    @property
+    def line_end(self) -> np.ndarray:
+        return self.end[self.line_last]
+
+    @property
+    def screen_end(self) -> np.ndarray:
+        return self.end[self.line_last[self.screen_last]]
+
+    @property
+    def line_count(self) -> np.ndarray:
+        return self.screen_last - self.screen_first + 1
+
+    def shift(self, seconds: float) -> None:
+        """Move every time later by seconds."""
+        for times in (self.start, self.end, self.count_in, self.screen_start):
+            times += seconds
+
+    def add_quick_start_count_in(self) -> None:
+        """Count in, and delay the audio for it, if the song starts with singing."""
+        first_start = self.start[0]
+        if first_start > FIRST_SCREEN_QUICK_START_THRESHOLD:
+            return
+        added = COUNT_IN_DURATION - first_start
+        first_screen_start = self.screen_start[0]
+        self.shift(added)
+        self.screen_start[0] = first_screen_start
+        self.audio_delay += added
+        self.count_in[0] = 0.0
+
+    def add_screen_count_ins(self) -> None:
+        """Count in to screens that start after a long wait."""
+        first_start = self.line_start[self.screen_first]
+        previous_end = np.r_[0.0, self.screen_end[:-1]]
+        waited = first_start - previous_end > COUNT_IN_THRESHOLD
+        self.count_in[waited] = first_start[waited] - COUNT_IN_DURATION
+
+    def add_title_screen(self) -> None:
+        """Make room for the title screen: over the intro if it's long enough,
+        or else by delaying everything, audio included."""
+        intro = self.line_start[0]
+        if intro > TITLE_SCREEN_DURATION:
+            start = self.screen_start[0]
+            self.screen_start[0] = _js_or(start, 0) + TITLE_SCREEN_DURATION
+            self.first_line_margin[0] = np.nan
+        else:
+            self.audio_delay += TITLE_SCREEN_DURATION
+            self.shift(TITLE_SCREEN_DURATION)
+
+    def display_quick_lines_early(self) -> None:
+        """When a screen follows right on, hide the first lines of the one before
+        as its next line is sung, and show the first lines of the next in their place.
+        """
+        line_start = self.line_start
+        line_end = self.line_end
+        line_count = self.line_count
+        # The last screen has no screen after it
+        quick = ~(
+            line_start[self.screen_first[1:]] - self.screen_end[:-1]
+            > SCREEN_QUICK_START_THRESHOLD
+        ) & (line_count[:-1] >= 2)
+        screens = np.flatnonzero(quick)
+        early = np.minimum(2, line_count[screens] - 1)
+        after = self.screen_first[screens] + early
+        sung = line_end[after] - line_start[after]
+        removal = line_start[after] + sung * 0.5
+        display = line_start[after] + sung * 0.75
+        fade = (display - removal) / 2
+        for offset in (0, 1):
+            removed = early > offset
+            lines = self.screen_first[screens[removed]] + offset
+            self.display_end[lines] = removal[removed]
+            self.fade_out[lines] = fade[removed]
+            shown = removed & (line_count[screens + 1] > offset)
+            lines = self.screen_first[screens[shown] + 1] + offset
+            self.display_start[lines] = display[shown]
+            self.fade_in[lines] = fade[shown]
+        # Move the next screen's first lines up if they would cover the lines
+        # still showing. Each screen's margin can depend on the one before it.
+        tops = _js_round(
+            self.first_line_y(VerticalAlignment.MIDDLE, self.options.font_size)
+        ).tolist()
+        for screen in screens.tolist():
+            top = self.first_line_margin[screen]
+            top = tops[screen] if np.isnan(top) else _js_round(top)
+            if top < tops[screen + 1]:
+                self.first_line_margin[screen + 1] = top
+
+    def add_instrumental_screens(self) -> None:
+        """Fill long gaps between screens, the title screen included, with instrumental screens."""
+        first_start = self.line_start[self.screen_first]
+        previous_end = np.r_[TITLE_SCREEN_DURATION, self.screen_end[:-1]]
+        gap = first_start - previous_end
+        long = ~(gap < INSTRUMENTAL_SCREEN_THRESHOLD)
+        self.instrumental_start[long] = previous_end[long]
+        self.instrumental_end[long] = previous_end[long] + gap[long]
+        self.screen_start[long] = _js_or(self.screen_start[long], 0) + gap[long]
+        self.first_line_margin[long] = np.nan
+
+    def first_line_y(
+        self, alignment: VerticalAlignment, font_size: float, line_count=None
+    ) -> np.ndarray:
+        """The top of each screen's first line, unrounded."""
+        if line_count is None:
+            line_count = self.line_count
+            custom = self.first_line_margin
+        else:
+            custom = np.full(len(line_count), np.nan)
+        line_height = font_size * 1.5
+        if alignment == VerticalAlignment.TOP:
+            margin = np.full(len(line_count), line_height)
+        elif alignment == VerticalAlignment.MIDDLE:
+            margin = VIDEO_HEIGHT / 2 - (line_count * line_height / 2)
+        else:
+            margin = VIDEO_HEIGHT - ((line_count + 1) * line_height)
+        return np.where(np.isnan(custom), margin, custom)
+
+    def to_ass(self) -> str:
+        """Render the layout as an ASS file."""
+        options = self.options
+        line_height = options.font_size * 1.5
+        style = {
+            "Name": "Default",
+            "Fontname": options.font_name,
+            "Fontsize": options.font_size,
+            "PrimaryColour": _ass_color(options.primary_color),
+            "SecondaryColour": _ass_color(options.secondary_color),
+            "OutlineColour": _ass_color(options.background_color),
+            "BackColour": _ass_color((0, 0, 0)),
+            "Bold": -1,
+            "Italic": 0,
+            "Underline": 0,
+            "StrikeOut": 0,
+            "ScaleX": 100,
+            "ScaleY": 100,
+            "Spacing": 0,
+            "Angle": 0,
+            "BorderStyle": 1,
+            "Outline": 1,
+            "Shadow": 0,
+            "Alignment": 8,
+            "MarginL": 0,
+            "MarginR": 0,
+            "MarginV": 0,
+            "Encoding": 0,
+        }
+        header = (
+            "[Script Info]\n"
+            "; Script generated by The Tüül - https://the-tuul.com\n"
+            "\n"
+            "[V4+ Styles]\n"
+            f"Format: {', '.join(style)}\n"
+            f"Style: {','.join(_js_str(value) for value in style.values())}\n"
+            "\n"
+            "[Events]\n"
+            "Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text\n"
+        )
+
+        # The title screen: the title, then the artist, two seconds each
+        half = TITLE_SCREEN_DURATION / 2
+        title_top = self.first_line_y(
+            options.vertical_alignment, options.font_size, np.array([2])
+        )[0]
+        title_events = [
+            _event(
+                0.0,
+                TITLE_SCREEN_DURATION,
+                _js_round(title_top + i * line_height),
+                f"{{\\k{_centiseconds(start)}}}{{\\kf{_centiseconds(end - start)}}}{text}",
+            )
+            for i, (text, start, end) in enumerate(
+                [(self.title, 0.0, half), (self.artist, half, TITLE_SCREEN_DURATION)]
+            )
+        ]
+
+        instrumental_top = _js_round(
+            self.first_line_y(
+                options.vertical_alignment, options.font_size, np.array([1])
+            )[0]
+        )
+        has_instrumental = ~np.isnan(self.instrumental_start)
+        instrumental_events = dict(
+            zip(
+                np.flatnonzero(has_instrumental).tolist(),
+                _events(
+                    self.instrumental_start[has_instrumental],
+                    self.instrumental_end[has_instrumental],
+                    np.full(has_instrumental.sum(), instrumental_top),
+                    [
+                        f"{{\\k0}}{{\\kf{duration}}}{INSTRUMENTAL_TEXT}"
+                        for duration in _floor_centiseconds(
+                            self.instrumental_end[has_instrumental]
+                            - self.instrumental_start[has_instrumental]
+                        )
+                    ],
+                ),
+            )
+        )
+
+        line_events = self._line_events(line_height)
+        body = []
+        for screen, (first, last) in enumerate(
+            zip(self.screen_first.tolist(), self.screen_last.tolist())
+        ):
+            if screen in instrumental_events:
+                body.append(instrumental_events[screen])
+            body.extend(line_events[first : last + 1])
+        return header + "".join(event + "\n" for event in title_events + body)
+
+    def _line_events(self, line_height: float) -> list[str]:
+        screen = self.line_screen
+        line_start = self.line_start
+        screen_start = self.screen_start[screen]
+        screen_end = self.screen_end[screen]
+        if (
+            np.isnan(line_start).any()
+            or np.isnan(screen_start).any()
+            or np.isnan(screen_end).any()
+        ):
+            raise ValueError("Timings are missing for some lyrics")
+        display_start = _js_or(self.display_start, screen_start)
+        display_end = _js_or(self.display_end, screen_end)
+        delays = np.maximum(_floor_centiseconds(line_start - display_start), 0)
+        line_in_screen = np.arange(len(screen)) - self.screen_first[screen]
+        tops = self.first_line_y(
+            self.options.vertical_alignment, self.options.font_size
+        )
+        margins = _js_round(tops[screen] + line_in_screen * line_height)
+
+        # Each segment animates for its duration, after an empty one for any
+        # gap since the segment before it in the line
+        durations = _floor_centiseconds(self.end - self.start).tolist()
+        gap_durations = _floor_centiseconds(self.start[1:] - self.end[:-1]).tolist()
+        has_gap = (self.end[:-1] < self.start[1:]).tolist()
+        continues_line = np.ones(len(self.start), dtype=bool)
+        continues_line[self.line_first] = False
+        continues_line = continues_line.tolist()
+        pieces = [
+            (
+                f"{{\\kf{gap_durations[i - 1]}}}"
+                if continues_line[i] and has_gap[i - 1]
+                else ""
+            )
+            + f"{{\\kf{duration}}}{text}"
+            for i, (duration, text) in enumerate(zip(durations, self.text))
+        ]
+        has_count_in = ~np.isnan(self.count_in)
+        count_in_lines = self.screen_first[has_count_in]
+        count_ins = dict(
+            zip(
+                count_in_lines.tolist(),
+                (
+                    f"{{\\kf{duration}}}{COUNT_IN_TEXT}"
+                    for duration in _floor_centiseconds(
+                        self.start[self.line_first[count_in_lines]]
+                        - self.count_in[has_count_in]
+                    )
+                ),
+            )
+        )
+
+        fade_in = np.floor(self.fade_in * 1000).astype(np.int64).tolist()
+        fade_out = np.floor(self.fade_out * 1000).astype(np.int64).tolist()
+        fades = ((self.fade_in != 0) | (self.fade_out != 0)).tolist()
+        texts = [
+            (f"{{\\fad({fade_in[line]},{fade_out[line]})}}" if fades[line] else "")
+            + f"{{\\k{delay}}}"
+            + count_ins.get(line, "")
+            + "".join(pieces[first : last + 1])
+            for line, (delay, first, last) in enumerate(
+                zip(delays.tolist(), self.line_first.tolist(), self.line_last.tolist())
+            )
+        ]
+        return _events(display_start, display_end, margins, texts)
+
+
+def compile_timings(
+    lyrics: str,
+    events: list[list[float]],
+    song_duration: float,
+    title: str,
+    artist: str,
+    options: KaraokeOptions,
+) -> Layout:
+    """Lay out the lyrics' screens as they were timed, before any adjustments."""
+    texts = parse_segments(lyrics)
+    try:
+        events = np.asarray(events, dtype=float).reshape(-1, 2)
+    except TypeError as e:
+        raise ValueError(f"Invalid timings: {e}") from e
+    # Each event belongs to the segment started last, and starts past the
+    # last segment are ignored
+    segment = np.cumsum(events[:, 1] == SEGMENT_START) - 1
+    in_lyrics = (segment >= 0) & (segment < len(texts))
+    starts = in_lyrics & (events[:, 1] == SEGMENT_START)
+    ends = in_lyrics & (events[:, 1] == SEGMENT_END)
+    start = events[starts, 0]
+    if not len(start):
+        raise ValueError("There are no timings for the lyrics")
+    texts = texts[: len(start)]
+    end = np.full(len(start), np.nan)
+    # The last end of a segment counts
+    ended, last = np.unique(segment[ends][::-1], return_index=True)
+    end[ended] = events[ends, 0][::-1][last]
+    # Segments without an end end as the next one starts, or with the song.
+    # Like the frontend, an end at 0 counts as none.
+    unset = np.isnan(end) | (end == 0)
+    end = np.where(unset, np.r_[start[1:], song_duration], end)
+
+    ends_line = np.array([text.endswith("\n") for text in texts])
+    ends_screen = np.array([text.endswith("\n\n") for text in texts])
+    line_first = np.flatnonzero(np.r_[True, ends_line[:-1]])
+    line_last = np.r_[line_first[1:] - 1, len(texts) - 1]
+    line_ends_screen = ends_screen[line_last]
+    line_screen = np.r_[0, np.cumsum(line_ends_screen[:-1])]
+    screen_first = np.flatnonzero(np.r_[True, line_ends_screen[:-1]])
+    screen_last = np.r_[screen_first[1:] - 1, len(line_first) - 1]
+    screen_end = end[line_last[screen_last]]
+    return Layout(
+        options=options,
+        title=title,
+        artist=artist,
+        text=texts,
+        start=start,
+        end=end,
+        line_first=line_first,
+        line_last=line_last,
+        line_screen=line_screen,
+        screen_first=screen_first,
+        screen_last=screen_last,
+        screen_start=np.r_[0.0, screen_end[:-1]],
+    )
+
+
+def create_layout(
+    lyrics: str,
+    events: list[list[float]],
+    song_duration: float,
+    title: str,
+    artist: str,
+    options: KaraokeOptions,
+) -> Layout:
+    """Lay out the lyrics' screens with the adjustments options ask for."""
+    layout = compile_timings(lyrics, events, song_duration, title, artist, options)
+    if options.add_count_ins:
+        layout.add_quick_start_count_in()
+        layout.add_screen_count_ins()
+    layout.add_title_screen()
+    if options.add_staggered_lines:
+        layout.display_quick_lines_early()
+    if options.add_instrumental_screens:
+        layout.add_instrumental_screens()
+    return layout
+
+
+def create_ass_file(
+    lyrics: str,
+    events: list[list[float]],
+    song_duration: float,
+    title: str,
+    artist: str,
+    options: KaraokeOptions,
+) -> str:
+    return create_layout(lyrics, events, song_duration, title, artist, options).to_ass()
+
+
+def timecodes(seconds: np.ndarray) -> list[str]:
+    """Format times as H:MM:SS.cc, rounding hundredths like the frontend does."""
+    hours = np.floor(seconds / 3600).astype(np.int64).tolist()
+    minutes = np.floor(seconds / 60 % 60).astype(np.int64).tolist()
+    whole_seconds = np.floor(seconds % 60).astype(np.int64).tolist()
+    # Rounded hundredths of 1.00 show as .00, without carrying
+    hundredths = (
+        np.floor((seconds - np.floor(seconds)) * 100 + 0.5).astype(np.int64) % 100
+    ).tolist()
+    return [
+        f"{h}:{m:02}:{s:02}.{c:02}"
+        for h, m, s, c in zip(hours, minutes, whole_seconds, hundredths)
+    ]
+
+
+def _events(
+    starts: np.ndarray, ends: np.ndarray, margins: np.ndarray, texts: list[str]
+) -> list[str]:
+    return [
+        f"Dialogue: 0,{start},{end},Default,Singer,0,0,{margin},,{text}"
+        for start, end, margin, text in zip(
+            timecodes(np.asarray(starts, dtype=float)),
+            timecodes(np.asarray(ends, dtype=float)),
+            np.asarray(margins).tolist(),
+            texts,
+        )
+    ]
+
+
+def _event(start: float, end: float, margin: int, text: str) -> str:
+    return _events(np.array([start]), np.array([end]), np.array([margin]), [text])[0]
+
+
+def _floor_centiseconds(seconds: np.ndarray) -> np.ndarray:
+    return np.floor(seconds * 100).astype(np.int64)
+
+
+def _centiseconds(seconds: float) -> int:
+    return math.floor(seconds * 100)
+
+
+def _js_round(values):
+    """Round halves up, like Math.round."""
+    return np.floor(np.asarray(values) + 0.5).astype(np.int64)
+
+
+def _js_or(values, default):
+    """values, or default where values are unset, 0 or NaN, like JavaScript's ||."""
+    values = np.asarray(values, dtype=float)
+    return np.where(np.isnan(values) | (values == 0), default, values)
+
+
+def _js_str(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _ass_color(color: Color, alpha: int = 0) -> str:
+    # ASS colors are &HAABBGGRR, and alpha 0 is opaque
+    red, green, blue = color
+    return f"&H{alpha:02X}{blue:02X}{green:02X}{red:02X}"
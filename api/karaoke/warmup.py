@@ -0,0 +1,187 @@
+"""
+Make sure separation models are on disk, intact and loaded before users arrive.
+
+The image only ships the models' metadata, so without this the first request
+after a deploy downloads the weights and loads the model. Here every model in
+AVAILABLE_MODELS is checked against the lists in download_checks.json,
+downloaded if it's missing, verified against the hashes in
+mdx_model_data.json, given the ORT format copy that lets gunicorn workers
+share its weights (see shared_models.py), and warmed up by separating a
+second of quiet noise, which leaves the loaded model in the separator pool.
+
+`manage.py prepare_models` does this once, e.g. while building an image, and
+with WARM_UP_ON_BOOT each gunicorn worker does it in the background as it
+starts (see gunicorn.conf.py). readiness() reports how far it got, for the
+health endpoint. The default model is prepared first, and once it's ready so
+is the server, even if another model fails.
+"""
+import hashlib
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
+import numpy as np
+
+from . import music_separation, shared_models
+from .chunked_separation import SAMPLE_RATE, write_wav
+
+MODEL_REPO_URL = (
+    "https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/"
+)
+DOWNLOAD_CHECKS = "download_checks.json"
+MODEL_DATA = "mdx_model_data.json"
+WARM_UP_SECONDS = 1.0
+
+IDLE = "idle"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+
+_status = {"state": IDLE, "models": {}}
+_status_lock = threading.Lock()
+
+
+class ModelError(Exception):
+    """Raised when a model can't be found, fetched or verified."""
+
+
+def listed_models(models_dir: Path) -> set[str]:
+    """Return the MDX model files download_checks.json knows about."""
+    checks = json.loads((models_dir / DOWNLOAD_CHECKS).read_text())
+    return {
+        filename
+        for key in ("mdx_download_list", "mdx_download_vip_list")
+        for filename in checks.get(key, {}).values()
+        if isinstance(filename, str)
+    }
+
+
+def model_hash(path: Path) -> str:
+    """Hash a model the way audio_separator does: the MD5 of its last 10MB."""
+    with path.open("rb") as f:
+        try:
+            f.seek(-10000 * 1024, 2)
+        except OSError:
+            # Smaller than 10MB
+            f.seek(0)
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def verify_model(model_path: Path) -> None:
+    """Raise ModelError unless model_path is a known, intact MDX model."""
+    models_dir = model_path.parent
+    if model_path.name not in listed_models(models_dir):
+        raise ModelError(f"{model_path.name} isn't in {DOWNLOAD_CHECKS}")
+    if not model_path.exists():
+        raise ModelError(f"{model_path.name} hasn't been downloaded")
+    _check_hash(model_path, models_dir)
+
+
+def _check_hash(path: Path, models_dir: Path) -> None:
+    known_hashes = json.loads((models_dir / MODEL_DATA).read_text())
+    if model_hash(path) not in known_hashes:
+        raise ModelError(f"{path.name} doesn't match any hash in {MODEL_DATA}")
+
+
+def fetch_model(model_path: Path) -> None:
+    """Download a model next to where it belongs, verify it, then move it into place."""
+    url = MODEL_REPO_URL + model_path.name
+    logging.info(f"Downloading {url}")
+    with tempfile.NamedTemporaryFile(
+        dir=model_path.parent, prefix=f".{model_path.name}.", delete=False
+    ) as f:
+        part_path = Path(f.name)
+        try:
+            with urllib.request.urlopen(url) as response:
+                shutil.copyfileobj(response, f)
+        except OSError as e:
+            part_path.unlink(missing_ok=True)
+            raise ModelError(f"Couldn't download {model_path.name}: {e}") from e
+    try:
+        _check_hash(part_path, model_path.parent)
+        part_path.rename(model_path)
+    finally:
+        part_path.unlink(missing_ok=True)
+
+
+def warm_up(model_name: str) -> float:
+    """Separate a moment of quiet noise, loading the model into the pool. Return the seconds it took."""
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(prefix="warm-up-") as song_dir:
+        noise = np.random.default_rng(0).normal(
+            0, 0.01, (int(WARM_UP_SECONDS * SAMPLE_RATE), 2)
+        )
+        songfile = write_wav(Path(song_dir) / "warm-up.wav", noise.astype(np.float32))
+        music_separation.split_song(songfile, Path(song_dir), model_name=model_name)
+    return time.perf_counter() - start
+
+
+def prepare_models(
+    model_names: list[str] | None = None,
+    fetch: bool = True,
+    warm: bool = True,
+    convert: bool = True,
+) -> bool:
+    """Verify, fetch if needed, convert to ORT format if needed, and warm up
+    each model. Return whether all are ready."""
+    model_names = model_names or music_separation.AVAILABLE_MODELS
+    # Most requests use the default model, so readiness waits only for it
+    model_names = sorted(
+        model_names, key=lambda name: name != music_separation.DEFAULT_MODEL
+    )
+    _set_state(WARMING)
+    ready = True
+    for model_name in model_names:
+        model_path = music_separation.MODELS_DIR / model_name
+        report = {}
+        try:
+            try:
+                verify_model(model_path)
+            except ModelError:
+                if not fetch or model_path.exists():
+                    raise
+                fetch_model(model_path)
+            report["verified"] = True
+            if convert:
+                if not shared_models.ort_path(model_path).exists():
+                    shared_models.convert_to_ort(model_path)
+                report["ortCopy"] = True
+            if warm:
+                report["warmUpSeconds"] = round(warm_up(model_name), 2)
+        except ModelError as e:
+            logging.warning(str(e))
+            report["error"] = str(e)
+            ready = False
+        except Exception as e:
+            logging.exception(f"Warming up {model_name} failed")
+            report["error"] = str(e)
+            ready = False
+        with _status_lock:
+            _status["models"][model_name] = report
+    _set_state(READY if ready else FAILED)
+    return ready
+
+
+def readiness() -> dict:
+    """How far preparing the models got. Ready if the default model is ready,
+    or if preparing finished or never started."""
+    with _status_lock:
+        default_report = _status["models"].get(music_separation.DEFAULT_MODEL)
+        return {
+            "ready": _status["state"] in (IDLE, READY)
+            or (default_report is not None and "error" not in default_report),
+            "state": _status["state"],
+            "models": {
+                name: dict(report) for name, report in _status["models"].items()
+            },
+        }
+
+
+def _set_state(state: str) -> None:
+    with _status_lock:
+        _status["state"] = state
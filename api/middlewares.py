@@ -1,4 +1,7 @@
 import logging
+import time
+
+from helpers import metrics
 
 
 class SharedArrayBufferHeadersMiddleware:
@@ -17,3 +20,41 @@ class SharedArrayBufferHeadersMiddleware:
         response["Cross-Origin-Resource-Policy"] = "same-site"
 
         return response
+
+
+class MetricsMiddleware:
+    """
+    Records how long each view takes and how many bytes it receives and sends.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        view = match.url_name if match and match.url_name else "other"
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, view=view)
+        metrics.REQUEST_BYTES.inc(
+            int(request.META.get("CONTENT_LENGTH") or 0), view=view
+        )
+
+        if response.has_header("Content-Length"):
+            # Leaves FileResponse alone, so servers can still use sendfile
+            metrics.RESPONSE_BYTES.inc(int(response["Content-Length"]), view=view)
+        elif response.streaming:
+            response.streaming_content = self._counted(response.streaming_content, view)
+        else:
+            metrics.RESPONSE_BYTES.inc(len(response.content), view=view)
+        return response
+
+    @staticmethod
+    def _counted(content, view: str):
+        sent = 0
+        try:
+            for chunk in content:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            metrics.RESPONSE_BYTES.inc(sent, view=view)
@@ -11,6 +11,8 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
 import os
+import tempfile
+import warnings
 from pathlib import Path
 
 import structlog
@@ -40,12 +42,14 @@ INSTALLED_APPS = [
     "webpack_loader",
     "corsheaders",
     "django_structlog",
+    "karaoke",
 ]
 
 MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "middlewares.SharedArrayBufferHeadersMiddleware",
+    "middlewares.MetricsMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -203,6 +207,169 @@ WEBPACK_LOADER = {
     }
 }
 
+# Separation models
+# Loaded models are kept in a per-process pool. Idle models are dropped after
+# SEPARATOR_POOL_IDLE_SECONDS, or when the pool grows past SEPARATOR_POOL_MEMORY_MB.
+# 0 disables either limit.
+
+SEPARATOR_POOL_MEMORY_MB = int(os.getenv("SEPARATOR_POOL_MEMORY_MB", 0))
+SEPARATOR_POOL_IDLE_SECONDS = int(os.getenv("SEPARATOR_POOL_IDLE_SECONDS", 1800))
+
+# Separation threads
+# Each loaded model's ONNX Runtime session runs SEPARATION_INTRA_OP_THREADS
+# threads within an operator and SEPARATION_INTER_OP_THREADS across operators.
+# 0 intra-op threads shares the cores evenly between the separations admission
+# control lets run at once. With SEPARATION_PIN_CORES, each loaded model's
+# threads are pinned to a block of cores no other model uses.
+
+SEPARATION_INTRA_OP_THREADS = int(os.getenv("SEPARATION_INTRA_OP_THREADS", 0))
+SEPARATION_INTER_OP_THREADS = int(os.getenv("SEPARATION_INTER_OP_THREADS", 1))
+SEPARATION_PIN_CORES = os.getenv("SEPARATION_PIN_CORES", "False") == "True"
+# Segments of audio run through the model at once. Larger batches make better
+# use of the cores, mostly when batch separation packs several songs together,
+# and each segment in a batch holds a few tens of MB more while it runs. 1
+# turns batching off.
+SEPARATION_BATCH_SIZE = int(os.getenv("SEPARATION_BATCH_SIZE", 4))
+
+# Pipeline artifacts
+# The output of every separation and rendering stage is kept in ARTIFACTS_DIR,
+# keyed by a hash of the stage's inputs, so later requests can reuse it. The
+# least recently used artifacts are removed once there are more than
+# ARTIFACTS_MAX_MB of them. Set ARTIFACTS_MAX_MB to 0 to turn the store off,
+# which also turns off rendering from a separationId. On Cloud Run the temp dir
+# is held in memory, so the store counts against the instance's memory limit.
+# STEM_CACHE_DIR and STEM_CACHE_MAX_MB are the old names of these settings.
+
+for old_name, new_name in [
+    ("STEM_CACHE_DIR", "ARTIFACTS_DIR"),
+    ("STEM_CACHE_MAX_MB", "ARTIFACTS_MAX_MB"),
+]:
+    if old_name in os.environ:
+        warnings.warn(
+            f"{old_name} is deprecated, set {new_name} instead", FutureWarning
+        )
+
+ARTIFACTS_DIR = Path(
+    os.getenv("ARTIFACTS_DIR")
+    or os.getenv("STEM_CACHE_DIR")
+    or Path(tempfile.gettempdir()) / "the_tuul" / "artifacts"
+)
+ARTIFACTS_MAX_MB = int(
+    os.getenv("ARTIFACTS_MAX_MB") or os.getenv("STEM_CACHE_MAX_MB") or 512
+)
+
+# Songs at least CHUNKED_SEPARATION_MIN_SECONDS long are separated in windows
+# of CHUNKED_SEPARATION_WINDOW_SECONDS, overlapping by
+# CHUNKED_SEPARATION_OVERLAP_SECONDS, on CHUNKED_SEPARATION_WORKERS processes.
+# Fewer than 2 workers disables chunked separation.
+CHUNKED_SEPARATION_WORKERS = int(
+    os.getenv("CHUNKED_SEPARATION_WORKERS", (os.cpu_count() or 1) // 2)
+)
+CHUNKED_SEPARATION_MIN_SECONDS = int(os.getenv("CHUNKED_SEPARATION_MIN_SECONDS", 600))
+CHUNKED_SEPARATION_WINDOW_SECONDS = int(
+    os.getenv("CHUNKED_SEPARATION_WINDOW_SECONDS", 120)
+)
+CHUNKED_SEPARATION_OVERLAP_SECONDS = int(
+    os.getenv("CHUNKED_SEPARATION_OVERLAP_SECONDS", 10)
+)
+
+# Background jobs
+# Separation and rendering can also run as jobs on a pool of JOB_WORKERS threads
+# per process. At most JOB_QUEUE_SIZE more jobs wait for a free worker. Job
+# directories are deleted JOB_TTL_SECONDS after the job finishes.
+
+JOBS_DIR = Path(
+    os.getenv("JOBS_DIR", Path(tempfile.gettempdir()) / "the_tuul" / "jobs")
+)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", 16))
+JOB_TTL_SECONDS = int(os.getenv("JOB_TTL_SECONDS", 3600))
+
+# Uploads
+# Uploads bigger than FILE_UPLOAD_MAX_MEMORY_SIZE are spooled to
+# FILE_UPLOAD_TEMP_DIR and then moved into a working dir under the temp dir or
+# JOBS_DIR. Keep them on the same filesystem so the move is a rename rather
+# than a copy.
+
+FILE_UPLOAD_TEMP_DIR = os.getenv("FILE_UPLOAD_TEMP_DIR") or None
+
+# YouTube downloads
+# Downloaded streams and metadata are cached by video id for
+# YOUTUBE_CACHE_TTL_SECONDS, up to YOUTUBE_CACHE_MAX_MB. Set
+# YOUTUBE_CACHE_MAX_MB to 0 to disable the cache.
+
+YOUTUBE_CACHE_DIR = Path(
+    os.getenv("YOUTUBE_CACHE_DIR", Path(tempfile.gettempdir()) / "the_tuul" / "youtube")
+)
+YOUTUBE_CACHE_MAX_MB = int(os.getenv("YOUTUBE_CACHE_MAX_MB", 2048))
+YOUTUBE_CACHE_TTL_SECONDS = int(os.getenv("YOUTUBE_CACHE_TTL_SECONDS", 24 * 3600))
+
+# Progress events
+# Clients can follow a request or job's progress as server-sent events. Events
+# are kept in PROGRESS_DIR for PROGRESS_TTL_SECONDS. A progress stream closes
+# after PROGRESS_STREAM_TIMEOUT_SECONDS without a new event. Each open stream
+# holds one of its worker's WORKER_THREADS threads, and separating a song
+# without chunks reports no progress between start and end, so keep this short.
+# Clients that follow long work can poll /progress/<id>?since=<offset> instead.
+
+PROGRESS_DIR = Path(
+    os.getenv("PROGRESS_DIR", Path(tempfile.gettempdir()) / "the_tuul" / "progress")
+)
+PROGRESS_TTL_SECONDS = int(os.getenv("PROGRESS_TTL_SECONDS", 3600))
+PROGRESS_STREAM_TIMEOUT_SECONDS = int(os.getenv("PROGRESS_STREAM_TIMEOUT_SECONDS", 60))
+
+# ffmpeg limits
+# ffmpeg is killed after FFMPEG_TIMEOUT_SECONDS of wall-clock time or
+# FFMPEG_CPU_SECONDS of CPU time (0 for no limit), and runs at niceness
+# FFMPEG_NICE so encodes don't starve request handling.
+
+FFMPEG_TIMEOUT_SECONDS = int(os.getenv("FFMPEG_TIMEOUT_SECONDS", 1800))
+FFMPEG_CPU_SECONDS = int(os.getenv("FFMPEG_CPU_SECONDS", 0))
+FFMPEG_NICE = int(os.getenv("FFMPEG_NICE", 10))
+
+# Admission control
+# At most this many separations, renders and YouTube downloads run at once on
+# this host, across all worker processes. 0 picks a limit from the cores and
+# memory available. Up to ADMISSION_QUEUE_SIZE more requests, of any kind,
+# wait up to ADMISSION_QUEUE_TIMEOUT_SECONDS for a turn, and the rest get 429.
+# Each gunicorn worker serves WORKER_THREADS requests at once, and working or
+# waiting requests hold a thread each, so a worker admits at most
+# ADMISSION_RESERVED_THREADS fewer of them. The reserved threads answer health
+# checks, progress and job polling.
+
+ADMISSION_LIMITS = {
+    "separation": int(os.getenv("SEPARATION_CONCURRENCY", 0)),
+    "render": int(os.getenv("RENDER_CONCURRENCY", 0)),
+    "youtube": int(os.getenv("YOUTUBE_CONCURRENCY", 0)),
+}
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", 2))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = int(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", 120))
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", 8))
+ADMISSION_RESERVED_THREADS = int(os.getenv("ADMISSION_RESERVED_THREADS", 3))
+ADMISSION_DIR = Path(
+    os.getenv("ADMISSION_DIR", Path(tempfile.gettempdir()) / "the_tuul" / "admission")
+)
+
+# Metrics
+# Each process writes its metrics to METRICS_DIR, and /metrics adds them up in
+# Prometheus text format. Empty METRICS_DIR when the server starts, or counts
+# from earlier runs carry over.
+
+METRICS_DIR = Path(
+    os.getenv("METRICS_DIR", Path(tempfile.gettempdir()) / "the_tuul" / "metrics")
+)
+
+# Model warm-up
+# With WARM_UP_ON_BOOT, each server process verifies the models, downloads
+# any that are missing and loads them in the background as it starts, and
+# /health answers 503 until the default model is ready. With PRELOAD_MODELS,
+# gunicorn's master process fetches the models and reads their ORT format
+# copies before forking, so the workers share the weights' memory (see
+# karaoke/shared_models.py).
+
+WARM_UP_ON_BOOT = os.getenv("WARM_UP_ON_BOOT", "False") == "True"
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "False") == "True"
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
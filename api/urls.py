@@ -22,8 +22,29 @@ import views
 urlpatterns = [
     path("", views.Index.as_view()),
     path("separate_track", views.SeparateTrack.as_view(), name="separate_track"),
+    path("separate_tracks", views.SeparateTracks.as_view(), name="separate_tracks"),
     path("generate_video", views.GenerateVideo.as_view(), name="generate_video"),
     path("download_video", views.DownloadYouTubeVideo.as_view(), name="download_video"),
+    path(
+        "jobs/separate_track",
+        views.SeparateTrackJob.as_view(),
+        name="separate_track_job",
+    ),
+    path(
+        "jobs/download_video",
+        views.DownloadYouTubeVideoJob.as_view(),
+        name="download_video_job",
+    ),
+    path(
+        "jobs/generate_video",
+        views.GenerateVideoJob.as_view(),
+        name="generate_video_job",
+    ),
+    path("jobs/<str:job_id>", views.JobStatus.as_view(), name="job_status"),
+    path("jobs/<str:job_id>/result", views.JobResult.as_view(), name="job_result"),
+    path("progress/<str:progress_id>", views.Progress.as_view(), name="progress"),
+    path("metrics", views.Metrics.as_view(), name="metrics"),
+    path("health", views.Health.as_view(), name="health"),
     path("log_error", views.LogError.as_view(), name="log_error"),
     # path("admin/", admin.site.urls),
 ]
@@ -1,41 +1,127 @@
-import io
 import json
 import tempfile
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
-from typing import Tuple
-import zipfile
+from typing import Callable, Iterable, Iterator
 
 import structlog
 import pytubefix as pytube
 
-from django.core.files.storage import FileSystemStorage
-from django.http import FileResponse, StreamingHttpResponse
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header
 from django.core.files import File
+from django.urls import reverse
+from django.views import View
 from django.views.generic.base import TemplateView
 from rest_framework.response import Response
 from rest_framework.request import Request
 from rest_framework.views import APIView
 from rest_framework import status
 
-from karaoke import make_karaoke_video
-from karaoke import music_separation
-from helpers import youtube_helper
+from karaoke import audio_encoding, batch_separation
+from karaoke import encode_profiles
+from karaoke import make_karaoke_video, warmup
+from karaoke.music_separation import AVAILABLE_MODELS, DEFAULT_MODEL
+from karaoke.make_karaoke_video import ProcessCancelled
+from karaoke.pipeline import (
+    ACCOMPANIMENT,
+    VOCALS,
+    Artifact,
+    ArtifactMissing,
+    Pipeline,
+    artifact_exists,
+    get_artifact_store,
+)
+from karaoke.subtitles import KaraokeOptions, Layout, compile_timings, create_layout
+from helpers import admission, metrics, progress, youtube_helper, zipstream
+from helpers.disconnect import client_disconnected
+from helpers.file_response import file_response
+from helpers.jobs import DONE, Job, QueueFull, get_job_manager
+from helpers.progress import ProgressReporter
+from helpers.uploads import store_upload
+from helpers.zipstream import ZipMember
 
 logger = structlog.get_logger(__name__)
 
 
-def streamed_response(file_path: Path) -> StreamingHttpResponse:
-    """Return a streaming response for the given file path."""
-    f = file_path.open("rb")
+class ClosingIterator:
+    """Iterate over content, calling on_close when the response is closed.
 
-    def streaming_content():
-        while True:
-            data = f.read(1024 * 1024)
-            if not data:
-                break
-            yield data
+    Django closes a response's content once the server is done with it, even if
+    streaming never started, so this is a reliable place to clean up.
+    """
+
+    def __init__(self, content: Iterable[bytes], on_close: Callable[[], None]):
+        self._content = iter(content)
+        self._on_close = on_close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> bytes:
+        return next(self._content)
+
+    def close(self) -> None:
+        try:
+            if hasattr(self._content, "close"):
+                self._content.close()
+        finally:
+            self._on_close()
 
-    return StreamingHttpResponse(streaming_content=streaming_content())
+
+def streamed_zip_response(
+    members: Iterable[ZipMember],
+    filename: str,
+    on_close: Callable[[], None] = lambda: None,
+) -> StreamingHttpResponse:
+    """Return a response that zips members while it streams them.
+
+    The zip only exists as it's sent, so a byte range of it can't be served
+    again later. Clients that need to resume a download use the job API,
+    whose results are files on disk served with Range support.
+    """
+    response = StreamingHttpResponse(
+        ClosingIterator(zipstream.stream_zip(members), on_close),
+        content_type="application/zip",
+    )
+    response["Content-Disposition"] = content_disposition_header(True, filename)
+    response["Accept-Ranges"] = "none"
+    return response
+
+
+@contextmanager
+def response_temp_dir() -> Iterator[tempfile.TemporaryDirectory]:
+    """Create a temp dir for files a streamed response reads from.
+
+    The dir is removed if the view raises. Otherwise the view must arrange for
+    the response to remove it, e.g. with on_close=temp_dir.cleanup.
+    """
+    temp_dir = tempfile.TemporaryDirectory()
+    try:
+        yield temp_dir
+    except BaseException:
+        temp_dir.cleanup()
+        raise
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def overloaded_response(error: admission.Overloaded) -> Response:
+    return Response(
+        {"error": str(error)},
+        status=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
+
+def client_gone_response() -> HttpResponse:
+    """Response for a request whose client hung up, so its work was stopped."""
+    logger.info("client_disconnected")
+    # Nobody receives this; 499 is nginx's status for a closed connection
+    return HttpResponse(status=499)
 
 
 class Index(TemplateView):
@@ -44,42 +130,203 @@ class Index(TemplateView):
 
 class SeparateTrack(APIView):
     def post(self, request: Request, format: str | None = None) -> Response:
-        """Return a zip containing vocal and accompaniment splits of songFile"""
+        """Return a zip containing vocal and accompaniment splits of songFile
+
+        outputFormat picks the stems' format (wav, flac, opus, aac or mp3) and
+        bitrate the bitrate of lossy formats. With stems=accompaniment only the
+        accompaniment is returned. Progress is reported to progressId, if given.
+        """
         song_file = request.data.get("songFile")
-        model_name = request.data.get("modelName")
+        try:
+            model_name = self.get_model_name(request)
+            output_options = self.get_output_options(request)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         logger.info(
             "separate_tracks",
             song_size=len(song_file),
             model_name=model_name,
+            **output_options,
         )
-        with tempfile.TemporaryDirectory() as song_files_dir:
-            song_files_dir_path = Path(song_files_dir)
-            song_file_path = self.setup_song_files_dir(song_files_dir, song_file)
-            accompaniment_path, vocal_path = music_separation.split_song(
-                song_file_path, song_files_dir_path, model_name=model_name
-            )
-            zip_path = song_files_dir_path / "split_song.zip"
-            with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
-                zip_file.write(
-                    accompaniment_path,
-                    "accompaniment.wav",
+        reporter = get_request_reporter(request)
+        try:
+            with (
+                admission.get_limiter(admission.SEPARATION).admit(),
+                response_temp_dir() as song_files_dir,
+                progress.tracking(reporter),
+            ):
+                song_files_dir_path = Path(song_files_dir.name)
+                song_file_path = self.setup_song_files_dir(
+                    song_files_dir.name, song_file
+                )
+                if reporter:
+                    reporter("upload_stored")
+                separation, members = self.separate(
+                    song_file_path,
+                    song_files_dir_path,
+                    model_name,
+                    progress=reporter,
+                    cancelled=client_disconnected(request),
+                    **output_options,
                 )
-                zip_file.write(
-                    vocal_path,
-                    "vocals.wav",
+                response = streamed_zip_response(
+                    members, "split_song.zip", on_close=song_files_dir.cleanup
                 )
+                if get_artifact_store() is not None:
+                    # Lets the client render a video from these stems without
+                    # uploading the song again
+                    response["X-Separation-Id"] = separation.id
+                return response
+        except admission.Overloaded as e:
+            return overloaded_response(e)
+        except ProcessCancelled:
+            return client_gone_response()
+
+    def get_model_name(self, request: Request) -> str:
+        """Read and validate the requested model. Raise ValueError if it's unknown."""
+        model_name = request.data.get("modelName") or DEFAULT_MODEL
+        if model_name not in AVAILABLE_MODELS:
+            raise ValueError(
+                f"Model {model_name} not found. Available models: {AVAILABLE_MODELS}"
+            )
+        return model_name
 
-            logger.info("zip_complete", path=zip_path)
-            return streamed_response(zip_path)
+    def get_output_options(self, request: Request) -> dict:
+        """Read and validate the requested stem format. Raise ValueError if it's invalid."""
+        output_format = request.data.get("outputFormat", "wav")
+        bitrate = request.data.get("bitrate") or None
+        stems = request.data.get("stems", "all")
+        audio_encoding.get_stem_format(output_format, bitrate)
+        if stems not in ("all", "accompaniment"):
+            raise ValueError(f"stems must be all or accompaniment, not {stems}")
+        return {"output_format": output_format, "bitrate": bitrate, "stems": stems}
+
+    def separate(
+        self,
+        song_file_path: Path,
+        song_files_dir: Path,
+        model_name: str | None,
+        output_format: str = "wav",
+        bitrate: str | None = None,
+        stems: str = "all",
+        progress: ProgressReporter | None = None,
+        cancelled: Callable[[], bool] | None = None,
+    ) -> tuple[Artifact, list[ZipMember]]:
+        """Split the song and encode the stems. Return the separation and the stems to zip."""
+        pipeline = Pipeline(song_files_dir, progress=progress, cancelled=cancelled)
+        separation = pipeline.separate(pipeline.ingest(song_file_path), model_name)
+        stem_paths = [separation.files[ACCOMPANIMENT]]
+        if stems == "all" and VOCALS in separation.files:
+            stem_paths.append(separation.files[VOCALS])
+        stem_paths = audio_encoding.encode_stems(
+            stem_paths, output_format, bitrate, cancelled
+        )
+        if progress and output_format != "wav":
+            progress("encoded", output_format=output_format)
+        names = ["accompaniment", "vocals"]
+        return separation, [
+            (f"{name}{path.suffix}", path) for name, path in zip(names, stem_paths)
+        ]
 
     def setup_song_files_dir(self, files_dir: str, song_file: File) -> Path:
-        """Copy song file to the temp dir.
+        """Move song file to the temp dir.
 
         Return song file path.
         """
-        fs = FileSystemStorage(files_dir)
-        song_file_name = fs.save(song_file.name, content=song_file)
-        return Path(fs.location, song_file_name)
+        return store_upload(song_file, files_dir)
+
+
+class SeparateTracks(SeparateTrack):
+    """Separate many songs with one model, streaming each song's stems as it's done."""
+
+    def post(self, request: Request, format: str | None = None) -> Response:
+        """Return a zip with a folder of stems for each of songFiles.
+
+        Takes the same options as /separate_track. A song that can't be
+        separated gets an error.txt instead of stems, without failing the rest,
+        and results.json at the end lists how each song went.
+        """
+        song_files = request.FILES.getlist("songFiles")
+        if not song_files:
+            return Response(
+                {"error": "No songFiles provided."}, status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            model_name = self.get_model_name(request)
+            output_options = self.get_output_options(request)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        logger.info(
+            "separate_tracks_batch",
+            songs=len(song_files),
+            model_name=model_name,
+            **output_options,
+        )
+        # The songs are separated while the response streams, so the slot and
+        # the temp dir are released when the response is closed
+        resources = ExitStack()
+        try:
+            resources.enter_context(admission.get_limiter(admission.SEPARATION).admit())
+            work_dir = Path(resources.enter_context(tempfile.TemporaryDirectory()))
+            (work_dir / "uploads").mkdir()
+            song_paths = [
+                store_upload(song_file, work_dir / "uploads", f"{i}-{song_file.name}")
+                for i, song_file in enumerate(song_files)
+            ]
+        except admission.Overloaded as e:
+            resources.close()
+            return overloaded_response(e)
+        except BaseException:
+            resources.close()
+            raise
+        members = self.batch_members(
+            [song_file.name for song_file in song_files],
+            song_paths,
+            work_dir,
+            model_name,
+            **output_options,
+        )
+        return streamed_zip_response(
+            members, "split_songs.zip", on_close=resources.close
+        )
+
+    def batch_members(
+        self,
+        names: list[str],
+        song_paths: list[Path],
+        work_dir: Path,
+        model_name: str,
+        output_format: str = "wav",
+        bitrate: str | None = None,
+        stems: str = "all",
+    ) -> Iterator[ZipMember]:
+        """Separate the songs, yielding each song's stems as soon as they're ready."""
+        results = []
+        for result in batch_separation.split_songs(
+            song_paths, work_dir / "stems", model_name
+        ):
+            folder = f"{result.index + 1:03}-{Path(names[result.index]).stem}"
+            entry = {"song": names[result.index], "folder": folder}
+            stem_paths = []
+            if result.error is None:
+                stem_paths = [result.accompaniment]
+                if stems == "all":
+                    stem_paths.append(result.vocals)
+                try:
+                    stem_paths = audio_encoding.encode_stems(
+                        stem_paths, output_format, bitrate
+                    )
+                except IOError as e:
+                    result.error = f"Couldn't encode the stems: {e}"
+            if result.error:
+                entry["error"] = result.error
+                yield f"{folder}/error.txt", result.error.encode("utf8")
+            else:
+                for name, path in zip(["accompaniment", "vocals"], stem_paths):
+                    yield f"{folder}/{name}{path.suffix}", path
+            results.append((result.index, entry))
+        summary = [entry for _, entry in sorted(results)]
+        yield "results.json", json.dumps(summary).encode("utf8")
 
 
 class DownloadYouTubeVideo(APIView):
@@ -88,49 +335,213 @@ class DownloadYouTubeVideo(APIView):
     """
 
     def get(self, request: Request, format: str | None = None) -> Response:
-        """Return a zip containing vocal and accompaniment splits of songFile, and song metadata"""
+        """Return a zip containing the audio and video streams, and song metadata
+
+        mode is audio for no video, or the maximum video resolution such as
+        480p. It defaults to 1080p. The zip is streamed as it's made, so an
+        interrupted download can't be resumed; /jobs/download_video makes one
+        that can.
+        """
         youtube_url = request.query_params.get("url")
+        mode = request.query_params.get("mode", youtube_helper.DEFAULT_MODE)
         logger.info(
             "download_youtube_video",
             youtube_url=youtube_url,
             request=request.query_params,
         )
+        try:
+            self.validate_download_options(youtube_url, mode)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            with (
+                admission.get_limiter(admission.YOUTUBE).admit(),
+                response_temp_dir() as song_files_dir,
+            ):
+                members = self.download(youtube_url, Path(song_files_dir.name), mode)
+                return streamed_zip_response(
+                    members, "youtube_video.zip", on_close=song_files_dir.cleanup
+                )
+        except admission.Overloaded as e:
+            return overloaded_response(e)
+
+    def validate_download_options(self, youtube_url: str | None, mode: str) -> None:
+        """Raise ValueError if the url is missing or mode is invalid."""
         if not youtube_url:
-            return Response({"error": "No url provided."})
-        with tempfile.TemporaryDirectory() as song_files_dir:
-            song_files_dir_path = Path(song_files_dir)
+            raise ValueError("No url provided.")
+        youtube_helper.max_height(mode)
+
+    def download(
+        self, youtube_url: str, song_files_dir: Path, mode: str
+    ) -> list[ZipMember]:
+        """Download the video's streams to song_files_dir. Return the files to zip."""
+        metadata, audio_path, video_path = youtube_helper.get_youtube_streams(
+            youtube_url, song_files_dir, mode
+        )
+        logger.info("metadata", metadata=metadata)
+        members = [("audio.mp4", audio_path)]
+        if video_path:
+            members.append(("video.mp4", video_path))
+        members.append(("metadata.json", json.dumps(metadata).encode("utf8")))
+        return members
 
-            metadata, audio_path, video_path = youtube_helper.get_youtube_streams(
-                youtube_url, song_files_dir_path
-            )
-            logger.info("metadata", metadata=metadata)
-            (song_files_dir_path / "metadata.json").write_text(json.dumps(metadata))
-            zip_path = song_files_dir_path / "youtube_video.zip"
-            with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
-                zip_file.write(
-                    audio_path,
-                    "audio.mp4",
-                )
-                zip_file.write(
-                    video_path,
-                    "video.mp4",
-                )
-                zip_file.write(song_files_dir_path / "metadata.json", "metadata.json")
 
-            logger.info("zip_complete", path=zip_path)
-            return streamed_response(zip_path)
+class RenderFailed(Exception):
+    pass
 
 
 class GenerateVideo(APIView):
     def post(self, request: Request, format=None) -> Response:
+        """Render a karaoke video. Progress is reported to progressId, if given.
+
+        encodeProfile picks the video encoding settings: standard (the
+        default), fast-preview, balanced or archive. targets lists the outputs
+        to render, from 720p, 1080p and mp3, as a list or separated by commas.
+        They're all rendered together and zipped with the project. Instead of
+        songFile, separationId can name an earlier separation, as returned in
+        /separate_track's X-Separation-Id header.
+        Without subtitles, they're laid out from lyrics and timings as the
+        frontend would, with its videoOptions, and audioDelay is ignored.
+        """
+        song_file = request.data.get("songFile")
+        try:
+            self.validate_render_options(request)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        reporter = get_request_reporter(request)
+        try:
+            with (
+                admission.get_limiter(self.admission_kind(request)).admit(),
+                response_temp_dir() as song_files_dir,
+                progress.tracking(reporter),
+            ):
+                song_files_dir_path = Path(song_files_dir.name)
+                args = self.get_render_args(request, song_file, song_files_dir_path)
+                if reporter:
+                    reporter("upload_stored")
+                self.render(
+                    args, progress=reporter, cancelled=client_disconnected(request)
+                )
+                song_name = args["output_filename"]
+                return streamed_zip_response(
+                    self.project_members(
+                        args, song_files_dir_path, self.project_texts(request, args)
+                    ),
+                    f"{song_name}.zip",
+                    on_close=song_files_dir.cleanup,
+                )
+        except RenderFailed as e:
+            logger.error(str(e))
+            return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        except ArtifactMissing as e:
+            # Evicted since the request was validated
+            return Response({"error": str(e)}, status=status.HTTP_410_GONE)
+        except admission.Overloaded as e:
+            return overloaded_response(e)
+        except ProcessCancelled:
+            return client_gone_response()
+
+    def admission_kind(self, request: Request) -> str:
+        # Separation costs far more than rendering, so a render that has to
+        # separate the song first counts as a separation
+        if request.data.get("separationId"):
+            return admission.RENDER
+        return admission.SEPARATION
+
+    def render(
+        self,
+        args: dict,
+        progress: ProgressReporter | None = None,
+        cancelled: Callable[[], bool] | None = None,
+    ) -> None:
+        """Run make_karaoke_video with args. Raise RenderFailed if it fails, or
+        ArtifactMissing if its separation isn't stored anymore."""
+        rendered = make_karaoke_video.run(
+            **args, progress=progress, cancelled=cancelled
+        )
+        if not rendered:
+            raise RenderFailed("Rendering the video failed.")
+
+    def validate_render_options(self, request: Request) -> None:
+        """Raise ValueError if the requested render options are invalid."""
+        encode_profiles.get_encode_profile(request.data.get("encodeProfile") or None)
+        encode_profiles.get_output_targets(self.requested_targets(request))
+        separation_id = request.data.get("separationId")
+        if separation_id:
+            if not artifact_exists(separation_id, "separate"):
+                raise ValueError(f"Separation {separation_id} isn't available anymore")
+        elif not request.data.get("songFile"):
+            raise ValueError("Either songFile or separationId is required")
+        if not request.data.get("subtitles"):
+            lyrics, timings, options = self.subtitle_inputs(request)
+            compile_timings(lyrics, timings, 0.0, "", "", options)
+
+    def requested_targets(self, request: Request) -> list[str] | None:
+        if hasattr(request.data, "getlist"):
+            # A form can repeat the field instead of separating with commas
+            targets = ",".join(request.data.getlist("targets"))
+        else:
+            targets = request.data.get("targets")
+        if isinstance(targets, str):
+            targets = [target.strip() for target in targets.split(",")]
+        return [target for target in targets if target] if targets else None
+
+    def subtitle_inputs(self, request: Request) -> tuple[str, list, KaraokeOptions]:
+        """Return the lyrics, timings and video options to lay out subtitles with.
+        Raise ValueError if they're missing or invalid."""
+        lyrics = request.data.get("lyrics")
+        timings = request.data.get("timings")
+        if not lyrics or not timings:
+            raise ValueError("Either subtitles or lyrics and timings are required")
+        video_options = request.data.get("videoOptions") or {}
+        try:
+            if isinstance(timings, str):
+                timings = json.loads(timings)
+            if isinstance(video_options, str):
+                video_options = json.loads(video_options)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON: {e}") from e
+        if not isinstance(timings, list) or not all(
+            isinstance(timing, list)
+            and len(timing) == 2
+            and all(_is_number(value) for value in timing)
+            for timing in timings
+        ):
+            raise ValueError("timings must be a list of [seconds, marker] pairs")
+        return lyrics, timings, KaraokeOptions.from_dict(video_options)
+
+    def lay_out_subtitles(self, request: Request, songfile: Path | None) -> Layout:
+        """Lay out subtitles for a request that didn't send its own."""
+        lyrics, timings, options = self.subtitle_inputs(request)
+        # The last segment lasts until the end of the song if it isn't ended
+        if request.data.get("songDuration"):
+            song_duration = float(request.data.get("songDuration"))
+        elif songfile:
+            song_duration = make_karaoke_video.audio_duration(songfile)
+        else:
+            song_duration = max(timing[0] for timing in timings)
+        return create_layout(
+            lyrics,
+            timings,
+            song_duration,
+            request.data.get("songTitle", "Unknown Title"),
+            request.data.get("songArtist", "Unknown Artist"),
+            options,
+        )
+
+    def get_render_args(
+        self, request: Request, song_file: File, song_files_dir: Path
+    ) -> dict:
+        """Copy the request's inputs to song_files_dir. Return arguments for make_karaoke_video.run."""
         lyrics: str = request.data.get("lyrics")
         timings: str = request.data.get("timings")
-        song_file = request.data.get("songFile")
         song_artist: str = request.data.get("songArtist", "Unknown Artist")
         song_title: str = request.data.get("songTitle", "Unknown Title")
         subtitles: str = request.data.get("subtitles")
         audio_delay: float = float(request.data.get("audioDelay", 0.0))
         background_color: str = request.data.get("backgroundColor", "#000000")
+        encode_profile: str | None = request.data.get("encodeProfile") or None
+        separation_id: str | None = request.data.get("separationId") or None
 
         logger.info(
             "generate_video",
@@ -139,67 +550,60 @@ class GenerateVideo(APIView):
             song_artist=song_artist,
             song_title=song_title,
             subtitles=subtitles,
-            song_size=len(song_file),
+            song_size=len(song_file) if song_file else None,
+            separation_id=separation_id,
         )
 
-        with tempfile.TemporaryDirectory() as song_files_dir:
-            zip_path = None
-            video_filename = self.get_output_filename(song_artist, song_title)
-            [song_path, lyrics_path, timings_path] = self.setup_song_files_dir(
-                song_files_dir, song_file, lyrics, timings
-            )
-            success = make_karaoke_video.run(
-                lyricsfile=lyrics_path,
-                songfile=song_path,
-                timingsfile=timings_path,
-                lyric_subtitles=subtitles,
-                output_filename=video_filename,
-                audio_delay=audio_delay,
-                metadata={"title": song_title, "artist": song_artist},
-                background_color=background_color,
-            )
-            if success:
-                zip_path = self.zip_project(
-                    song_name=video_filename, song_files_dir=Path(song_files_dir)
-                )
-            if zip_path:
-                response = FileResponse(zip_path.open("rb"), as_attachment=True)
-                return response
-            else:
-                logger.error("No zip path for some reason.")
-
-    def zip_project(self, song_name: str, song_files_dir: Path) -> Path:
-        include_files = [
-            song_name,
-            "lyrics.txt",
-            "subtitles.ass",
-            "timings.json",
-        ]
-        zip_path = song_files_dir.joinpath(f"{song_name}.zip")
-        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for entry in song_files_dir.glob("*"):
-                if entry.name in include_files:
-                    zip_file.write(entry, entry.relative_to(song_files_dir))
-        logger.info(f"Zipped to: {zip_path}")
-        return zip_path
+        songfile = store_upload(song_file, song_files_dir) if song_file else None
+        if not subtitles:
+            layout = self.lay_out_subtitles(request, songfile)
+            subtitles = layout.to_ass()
+            audio_delay = float(layout.audio_delay)
 
-    def setup_song_files_dir(
-        self, files_dir, song_file, lyrics, timings
-    ) -> tuple[Path, ...]:
-        """Copy song components to the temp dir.
+        video_filename = self.get_output_filename(song_artist, song_title)
+        return dict(
+            songfile=songfile,
+            separation_id=separation_id,
+            output_dir=song_files_dir,
+            lyric_subtitles=subtitles,
+            output_filename=video_filename,
+            audio_delay=audio_delay,
+            metadata={"title": song_title, "artist": song_artist},
+            background_color=background_color,
+            encode_profile=encode_profile,
+            targets=self.requested_targets(request),
+        )
 
-        Return component paths.
-        """
-        fs = FileSystemStorage(files_dir)
-        song_file_name = fs.save(song_file.name, content=song_file)
-        lyrics_file_name = fs.save("lyrics.txt", io.StringIO(lyrics))
-        timings_file_name = fs.save("timings.json", io.StringIO(timings))
-        return tuple(
-            map(
-                lambda p: Path(fs.location, p),
-                [song_file_name, lyrics_file_name, timings_file_name],
-            )
+    def project_texts(self, request: Request, args: dict) -> dict[str, str]:
+        """Return the project's text files by name. They're zipped from memory."""
+        texts = {
+            "lyrics.txt": request.data.get("lyrics"),
+            "subtitles.ass": args["lyric_subtitles"],
+            "timings.json": request.data.get("timings"),
+        }
+        return {name: text for name, text in texts.items() if text is not None}
+
+    def project_members(
+        self, args: dict, song_files_dir: Path, texts: dict[str, str]
+    ) -> list[ZipMember]:
+        filenames = make_karaoke_video.output_filenames(
+            args["output_filename"], args["targets"]
+        )
+        members: list[ZipMember] = [
+            (filename, song_files_dir / filename) for filename in filenames.values()
+        ]
+        members += [(name, text.encode("utf8")) for name, text in texts.items()]
+        return members
+
+    def zip_project(
+        self, args: dict, song_files_dir: Path, texts: dict[str, str]
+    ) -> Path:
+        zip_path = zipstream.write_zip(
+            self.project_members(args, song_files_dir, texts),
+            song_files_dir.joinpath(f"{args['output_filename']}.zip"),
         )
+        logger.info(f"Zipped to: {zip_path}")
+        return zip_path
 
     def get_output_filename(self, artist: str, title: str) -> str:
         if artist and title:
@@ -207,6 +611,242 @@ class GenerateVideo(APIView):
         return "karaoke.mp4"
 
 
+class SeparateTrackJob(SeparateTrack):
+    """Start separating songFile in the background. Return the job's status."""
+
+    def post(self, request: Request, format: str | None = None) -> Response:
+        song_file = request.data.get("songFile")
+        try:
+            model_name = self.get_model_name(request)
+            output_options = self.get_output_options(request)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        logger.info(
+            "separate_tracks_job",
+            song_size=len(song_file),
+            model_name=model_name,
+            **output_options,
+        )
+
+        def prepare(job_dir: Path, reporter: ProgressReporter) -> Callable[[], Path]:
+            song_file_path = self.setup_song_files_dir(job_dir, song_file)
+            reporter("upload_stored")
+
+            def work() -> Path:
+                with admission.get_limiter(admission.SEPARATION).admit(queue=False):
+                    _, members = self.separate(
+                        song_file_path,
+                        job_dir,
+                        model_name,
+                        progress=reporter,
+                        **output_options,
+                    )
+                return zipstream.write_zip(members, job_dir / "split_song.zip")
+
+            return work
+
+        return start_job(request, "separate_track", prepare)
+
+
+class DownloadYouTubeVideoJob(DownloadYouTubeVideo):
+    """Start downloading a YouTube video in the background. Return the job's status.
+
+    Takes url and mode like /download_video. The zip is written to disk, so
+    /jobs/<id>/result can resume an interrupted download.
+    """
+
+    def post(self, request: Request, format: str | None = None) -> Response:
+        youtube_url = request.data.get("url")
+        mode = request.data.get("mode") or youtube_helper.DEFAULT_MODE
+        try:
+            self.validate_download_options(youtube_url, mode)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        logger.info("download_youtube_video_job", youtube_url=youtube_url, mode=mode)
+
+        def prepare(job_dir: Path, reporter: ProgressReporter) -> Callable[[], Path]:
+            def work() -> Path:
+                with admission.get_limiter(admission.YOUTUBE).admit(queue=False):
+                    members = self.download(youtube_url, job_dir, mode)
+                return zipstream.write_zip(members, job_dir / "youtube_video.zip")
+
+            return work
+
+        return start_job(request, "download_video", prepare)
+
+
+class GenerateVideoJob(GenerateVideo):
+    """Start rendering a video in the background. Return the job's status."""
+
+    def post(self, request: Request, format=None) -> Response:
+        song_file = request.data.get("songFile")
+        try:
+            self.validate_render_options(request)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        def prepare(job_dir: Path, reporter: ProgressReporter) -> Callable[[], Path]:
+            args = self.get_render_args(request, song_file, job_dir)
+            texts = self.project_texts(request, args)
+            reporter("upload_stored")
+
+            kind = self.admission_kind(request)
+
+            def work() -> Path:
+                with admission.get_limiter(kind).admit(queue=False):
+                    self.render(args, progress=reporter)
+                return self.zip_project(args, job_dir, texts)
+
+            return work
+
+        return start_job(request, "generate_video", prepare)
+
+
+def start_job(
+    request: Request,
+    kind: str,
+    prepare: Callable[[Path, ProgressReporter], Callable[[], Path]],
+) -> Response:
+    """Create a job and run it in the background.
+
+    prepare(job_dir, reporter) copies the job's inputs into job_dir and returns
+    the work to run. Uploaded files only live as long as the request, so prepare
+    runs before this returns. The job reports progress to a channel named after
+    its id.
+    """
+    jobs = get_job_manager()
+    try:
+        job = jobs.create(kind)
+    except QueueFull:
+        return Response(
+            {"error": "Too many jobs in progress, try again later."},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+    reporter = progress.get_reporter(job.id)
+    try:
+        work = prepare(jobs.job_dir(job), reporter)
+    except Exception:
+        jobs.abandon(job)
+        raise
+
+    def tracked_work() -> Path:
+        with progress.tracking(reporter):
+            return work()
+
+    jobs.start(job, tracked_work)
+    return Response(job_status(request, job), status=status.HTTP_202_ACCEPTED)
+
+
+def job_status(request: Request, job: Job) -> dict:
+    status_url = reverse("job_status", args=[job.id])
+    result = {
+        "jobId": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "statusUrl": request.build_absolute_uri(status_url),
+        "progressUrl": request.build_absolute_uri(reverse("progress", args=[job.id])),
+    }
+    if job.status == DONE:
+        result["resultUrl"] = request.build_absolute_uri(
+            reverse("job_result", args=[job.id])
+        )
+    if job.error:
+        result["error"] = job.error
+    return result
+
+
+class JobStatus(APIView):
+    def get(self, request: Request, job_id: str, format=None) -> Response:
+        job = get_job_manager().get(job_id)
+        if job is None:
+            return Response({"error": "No such job."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(job_status(request, job))
+
+
+class JobResult(APIView):
+    def get(self, request: Request, job_id: str, format=None) -> Response:
+        jobs = get_job_manager()
+        job = jobs.get(job_id)
+        if job is None:
+            return Response({"error": "No such job."}, status=status.HTTP_404_NOT_FOUND)
+        result_path = jobs.result_path(job)
+        if result_path is None:
+            return Response(job_status(request, job), status=status.HTTP_409_CONFLICT)
+        return file_response(request, result_path)
+
+
+def get_request_reporter(request: Request) -> ProgressReporter | None:
+    """Return a reporter for the request's progressId, if it has one."""
+    progress_id = request.data.get("progressId") or request.query_params.get(
+        "progressId"
+    )
+    return progress.get_reporter(progress_id)
+
+
+class Progress(View):
+    """Stream a request or job's progress as server-sent events.
+
+    A client picks a random progressId, opens this stream and then sends the
+    request with the same progressId. Jobs report progress under their job id.
+    This is a plain Django view because DRF's content negotiation would refuse
+    EventSource's Accept: text/event-stream.
+
+    The stream holds a server thread while it's open. With ?since=<offset>
+    the events after offset are returned as JSON straight away instead, with
+    the offset to poll from next; start from 0.
+    """
+
+    def get(self, request: HttpRequest, progress_id: str) -> HttpResponse:
+        try:
+            path = progress.channel_path(progress_id)
+        except ValueError:
+            return JsonResponse(
+                {"error": "Invalid progress id."}, status=status.HTTP_400_BAD_REQUEST
+            )
+        if "since" in request.GET:
+            try:
+                offset = max(0, int(request.GET["since"]))
+            except ValueError:
+                return JsonResponse(
+                    {"error": "since must be an offset."},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+            events, offset = progress.read_events(path, offset)
+            return JsonResponse(
+                {
+                    "events": events,
+                    "next": offset,
+                    "finished": progress.finished(events),
+                }
+            )
+        response = StreamingHttpResponse(
+            progress.server_sent_events(path, settings.PROGRESS_STREAM_TIMEOUT_SECONDS),
+            content_type="text/event-stream",
+        )
+        response["Cache-Control"] = "no-cache"
+        # Stop nginx from buffering the stream
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+
+class Metrics(View):
+    """Serve every worker's metrics in Prometheus text format."""
+
+    def get(self, request: HttpRequest) -> HttpResponse:
+        return HttpResponse(
+            metrics.REGISTRY.collect(),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+
+class Health(View):
+    """Report whether the models are ready, so traffic waits for warm-up."""
+
+    def get(self, request: HttpRequest) -> JsonResponse:
+        readiness = warmup.readiness()
+        return JsonResponse(readiness, status=200 if readiness["ready"] else 503)
+
+
 class LogError(APIView):
     """Log client errors"""
 
@@ -0,0 +1,121 @@
+"""
+Compare single-pass separation with chunked separation on 1..N processes.
+
+Reports wall-clock time per worker count and how closely the chunked
+accompaniment matches the single-pass one, as a signal-to-noise ratio.
+
+    python benchmarks/chunked_separation.py --seconds 900 --workers 1 2 4 8
+"""
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import click
+
+from common import make_song, setup_django, timer
+
+
+def snr_db(reference, estimate) -> float:
+    import numpy as np
+
+    length = min(len(reference), len(estimate))
+    reference, estimate = reference[:length], estimate[:length]
+    noise = np.sum((reference - estimate) ** 2)
+    return float(10 * np.log10(np.sum(reference**2) / max(noise, 1e-12)))
+
+
+@click.command()
+@click.option("--song", type=click.Path(exists=True, path_type=Path))
+@click.option("--seconds", default=600.0, help="Length of the synthetic song")
+@click.option("--model", default=None, help="Model file name")
+@click.option(
+    "--workers",
+    "-w",
+    multiple=True,
+    type=int,
+    help="Worker counts to try (default: powers of two up to the core count)",
+)
+@click.option("--window", default=120.0, help="Window length in seconds")
+@click.option("--overlap", default=10.0, help="Window overlap in seconds")
+@click.option(
+    "--min-snr", default=30.0, help="Fail if chunked output is worse than this, in dB"
+)
+@click.option("--output", type=click.Path(path_type=Path), help="Write results as JSON")
+def main(song, seconds, model, workers, window, overlap, min_snr, output):
+    setup_django()
+    from karaoke import chunked_separation, music_separation
+
+    model = model or music_separation.DEFAULT_MODEL
+    cores = os.cpu_count() or 1
+    workers = workers or [n for n in (1, 2, 4, 8, 16, 32, 64) if n <= cores]
+    work_dir = Path(tempfile.mkdtemp(prefix="bench-chunked-"))
+    song = song or make_song(work_dir / "song.wav", seconds)
+    results = {"song": str(song), "model": model, "cores": cores, "runs": []}
+
+    def fresh_dir(name: str) -> Path:
+        path = work_dir / name
+        shutil.rmtree(path, ignore_errors=True)
+        path.mkdir()
+        return path
+
+    def single_pass(name: str):
+        song_copy = shutil.copy(song, fresh_dir(name) / song.name)
+        return music_separation.split_song(Path(song_copy), work_dir / name, model)
+
+    # The first pass loads the model; time the second
+    single_pass("warmup")
+    run = {"mode": "single"}
+    with timer(run, "seconds"):
+        reference_path, _ = single_pass("single")
+    results["runs"].append(run)
+    reference = chunked_separation.read_wav(reference_path)
+    click.echo(f"single pass: {run['seconds']}s")
+
+    try:
+        for count in workers:
+            with ProcessPoolExecutor(
+                max_workers=count,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=chunked_separation._init_worker,
+            ) as executor:
+                kwargs = dict(
+                    model_name=model,
+                    window_seconds=window,
+                    overlap_seconds=overlap,
+                    executor=executor,
+                )
+                chunked_separation.split_song_chunked(
+                    song, fresh_dir("warmup"), **kwargs
+                )
+                run = {"mode": "chunked", "workers": count}
+                with timer(run, "seconds"):
+                    accompaniment_path, _ = chunked_separation.split_song_chunked(
+                        song, fresh_dir(f"chunked-{count}"), **kwargs
+                    )
+            run["speedup"] = round(results["runs"][0]["seconds"] / run["seconds"], 2)
+            run["snr_db"] = round(
+                snr_db(reference, chunked_separation.read_wav(accompaniment_path)), 1
+            )
+            results["runs"].append(run)
+            click.echo(
+                f"{count} workers: {run['seconds']}s, {run['speedup']}x, "
+                f"SNR {run['snr_db']} dB"
+            )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if output:
+        output.write_text(json.dumps(results, indent=2))
+    worst = min(run["snr_db"] for run in results["runs"][1:])
+    if worst < min_snr:
+        raise click.ClickException(
+            f"Chunked output SNR {worst} dB is below {min_snr} dB"
+        )
+
+
+if __name__ == "__main__":
+    main()
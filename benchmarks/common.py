@@ -0,0 +1,123 @@
+"""
+Helpers shared by the benchmark scripts.
+
+Benchmarks run against the code in api/, so they need it on sys.path and
+Django configured, just like manage.py.
+"""
+import os
+import resource
+import sys
+import time
+import wave
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+API_DIR = Path(__file__).resolve().parent.parent / "api"
+
+
+def setup_django() -> None:
+    sys.path.insert(0, str(API_DIR))
+    # Models and assets are looked up relative to the api dir
+    os.chdir(API_DIR)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+    import django
+
+    django.setup()
+
+
+def make_song(path: Path, seconds: float, sample_rate: int = 44100) -> Path:
+    """Write a synthetic stereo song: a chord for the band and a wandering tone for the singer."""
+    import numpy as np
+
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    band = sum(np.sin(2 * np.pi * f * t) for f in (110, 220, 277, 330)) / 8
+    melody = np.sin(2 * np.pi * (440 + 40 * np.sin(2 * np.pi * 0.5 * t)) * t) / 4
+    noise = np.random.default_rng(0).normal(0, 0.01, t.shape)
+    left = band + melody + noise
+    right = band + 0.8 * melody + noise
+    pcm = (np.stack([left, right], axis=1) * 32767).astype("<i2")
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm.tobytes())
+    return path
+
+
+@contextmanager
+def timer(results: dict, name: str) -> Iterator[None]:
+    """Record the wall-clock seconds the block takes as results[name]."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        results[name] = round(time.perf_counter() - start, 3)
+
+
+def _read_peak_rss() -> int:
+    """Return this process's peak resident memory in bytes."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux but bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+@contextmanager
+def peak_rss(results: dict, name: str) -> Iterator[None]:
+    """Record the peak resident memory during the block, in MiB, as results[name].
+
+    On Linux the peak is reset first so it covers just the block. Elsewhere it
+    is the peak of the whole process so far.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+    try:
+        yield
+    finally:
+        results[name] = round(_read_peak_rss() / 1024 / 1024, 1)
+
+
+ASS_HEADER = """[Script Info]
+ScriptType: v4.00+
+PlayResX: 1280
+PlayResY: 720
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Arial Narrow,48,&H00FFFFFF,&H0000FFFF,&H00000000,&H00000000,0,0,0,0,100,100,0,0,1,2,0,5,10,10,10,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+
+def ass_time(seconds: float) -> str:
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours}:{minutes:02}:{seconds:05.2f}"
+
+
+def make_subtitles(seconds: float, line_seconds: float = 4.0) -> str:
+    """Return karaoke subtitles with a line of highlighted words every line_seconds."""
+    words = ["la"] * 8
+    word_cs = int(line_seconds * 100 / len(words))
+    events = []
+    start = 0.0
+    while start + line_seconds <= seconds:
+        text = "".join(f"{{\\k{word_cs}}}{word} " for word in words)
+        events.append(
+            f"Dialogue: 0,{ass_time(start)},{ass_time(start + line_seconds)},"
+            f"Default,,0,0,0,,{text.strip()}"
+        )
+        start += line_seconds
+    return ASS_HEADER + "\n".join(events) + "\n"
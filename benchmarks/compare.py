@@ -0,0 +1,61 @@
+"""
+Compare two benchmark suite results, e.g. from before and after a change.
+
+    python benchmarks/compare.py before.json after.json --max-slowdown 1.2
+
+Prints each stage's time and peak memory in both runs and fails if any stage
+got slower than --max-slowdown times its earlier time.
+"""
+import json
+from pathlib import Path
+
+import click
+
+# Stages quicker than this are too noisy to judge
+MIN_SECONDS = 0.05
+
+
+def by_stage(results: dict) -> dict[tuple, dict]:
+    return {
+        (stage["stage"], stage["seconds_of_audio"]): stage
+        for stage in results["stages"]
+        if "skipped" not in stage
+    }
+
+
+@click.command()
+@click.argument("before", type=click.Path(exists=True, path_type=Path))
+@click.argument("after", type=click.Path(exists=True, path_type=Path))
+@click.option(
+    "--max-slowdown", default=1.2, help="Fail if a stage is this many times slower"
+)
+def main(before, after, max_slowdown):
+    before_results = json.loads(before.read_text())
+    after_results = json.loads(after.read_text())
+    click.echo(
+        f"before: {before_results.get('commit')}  after: {after_results.get('commit')}"
+    )
+    if before_results.get("model") != after_results.get("model"):
+        click.echo("Warning: the runs used different separation models")
+
+    before_stages = by_stage(before_results)
+    slower = []
+    for key, stage in by_stage(after_results).items():
+        old = before_stages.get(key)
+        if old is None:
+            continue
+        name, seconds_of_audio = key
+        ratio = stage["seconds"] / max(old["seconds"], 1e-9)
+        click.echo(
+            f"{name:>20} {seconds_of_audio or '':>6}: "
+            f"{old['seconds']:8.3f}s -> {stage['seconds']:8.3f}s ({ratio:5.2f}x)  "
+            f"{old['peak_rss_mb']:8.1f} -> {stage['peak_rss_mb']:8.1f} MiB"
+        )
+        if ratio > max_slowdown and stage["seconds"] >= MIN_SECONDS:
+            slower.append(f"{name} ({seconds_of_audio}s of audio): {ratio:.2f}x")
+    if slower:
+        raise click.ClickException("Slower than before:\n" + "\n".join(slower))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Compare video encode profiles on a reference song.
+
+Reports encode time and output size for each profile in
+karaoke.encode_profiles. Without --song, a synthetic song and lyrics are used.
+
+    python benchmarks/encode_profiles.py --seconds 240 --output encode.json
+"""
+import json
+import shutil
+import tempfile
+from pathlib import Path
+
+import click
+
+from common import make_song, make_subtitles, setup_django, timer
+
+
+@click.command()
+@click.option("--song", type=click.Path(exists=True, path_type=Path))
+@click.option(
+    "--subtitles", type=click.Path(exists=True, path_type=Path), help="ASS file"
+)
+@click.option("--seconds", default=240.0, help="Length of the synthetic song")
+@click.option(
+    "--profile",
+    "-p",
+    "profiles",
+    multiple=True,
+    help="Profiles to try (default: all of them)",
+)
+@click.option("--output", type=click.Path(path_type=Path), help="Write results as JSON")
+def main(song, subtitles, seconds, profiles, output):
+    setup_django()
+    from django.conf import settings
+
+    from karaoke import make_karaoke_video
+    from karaoke.encode_profiles import ENCODE_PROFILES
+
+    profiles = profiles or list(ENCODE_PROFILES)
+    work_dir = Path(tempfile.mkdtemp(prefix="bench-encode-"))
+    song = song or make_song(work_dir / "song.wav", seconds)
+    subtitles = subtitles.read_text() if subtitles else make_subtitles(seconds)
+    results = {"song": str(song), "runs": []}
+
+    try:
+        for name in profiles:
+            run = {"profile": name, **vars(ENCODE_PROFILES[name])}
+            output_dir = work_dir / name
+            output_dir.mkdir()
+            with timer(run, "seconds"):
+                make_karaoke_video.create_video(
+                    song,
+                    subtitles,
+                    output_dir=output_dir,
+                    fonts_dir=settings.BASE_DIR / "assets" / "fonts",
+                    encode_profile=name,
+                )
+            run["bytes"] = (output_dir / "karaoke.mp4").stat().st_size
+            results["runs"].append(run)
+            click.echo(
+                f"{name}: {run['seconds']}s, {run['bytes'] / 1024 / 1024:.1f} MiB"
+            )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if output:
+        output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
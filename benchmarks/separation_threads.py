@@ -0,0 +1,123 @@
+"""
+Compare separation thread settings by throughput and single-song latency.
+
+For each number of concurrent separations and each intra-op thread count,
+separates --songs songs and reports songs per hour and the median time per
+song. More threads per song lowers latency, more songs at once raises
+throughput, and the best split differs by machine type.
+
+    python benchmarks/separation_threads.py -c 1 -c 2 -c 4 -t 0 -t 2 --pin
+"""
+import gc
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import click
+
+from common import make_song, setup_django, timer
+
+
+@click.command()
+@click.option("--song", type=click.Path(exists=True, path_type=Path))
+@click.option("--seconds", default=180.0, help="Length of the synthetic song")
+@click.option("--model", default=None, help="Model file name")
+@click.option(
+    "--concurrency",
+    "-c",
+    "concurrencies",
+    multiple=True,
+    type=int,
+    help="Separations at once (default: powers of two up to the core count)",
+)
+@click.option(
+    "--threads",
+    "-t",
+    "thread_counts",
+    multiple=True,
+    type=int,
+    help="Intra-op threads per separation; 0 shares the cores (default: 0)",
+)
+@click.option(
+    "--pin/--no-pin", default=False, help="Pin each separation to its own cores"
+)
+@click.option(
+    "--songs", default=0, help="Songs per setting (default: twice the concurrency)"
+)
+@click.option("--output", type=click.Path(path_type=Path), help="Write results as JSON")
+def main(song, seconds, model, concurrencies, thread_counts, pin, songs, output):
+    setup_django()
+    from django.conf import settings
+
+    from karaoke import music_separation, onnx_threads
+
+    try:
+        import audio_separator  # noqa: F401
+    except ModuleNotFoundError:
+        raise click.ClickException("This benchmark needs audio-separator installed")
+
+    model = model or music_separation.DEFAULT_MODEL
+    cores = len(os.sched_getaffinity(0))
+    concurrencies = concurrencies or [n for n in (1, 2, 4, 8, 16, 32) if n <= cores]
+    thread_counts = thread_counts or [0]
+    work_dir = Path(tempfile.mkdtemp(prefix="bench-threads-"))
+    song = song or make_song(work_dir / "song.wav", seconds)
+    results = {
+        "song": str(song),
+        "model": model,
+        "cores": cores,
+        "pin": pin,
+        "runs": [],
+    }
+    pool = music_separation.get_separator_pool()
+    settings.SEPARATION_PIN_CORES = pin
+
+    def separate(_) -> float:
+        song_dir = Path(tempfile.mkdtemp(dir=work_dir))
+        start = time.perf_counter()
+        music_separation.split_song(song, song_dir, model)
+        seconds = time.perf_counter() - start
+        shutil.rmtree(song_dir, ignore_errors=True)
+        return seconds
+
+    try:
+        for concurrency in concurrencies:
+            for threads in thread_counts:
+                settings.SEPARATION_INTRA_OP_THREADS = threads
+                onnx_threads.set_concurrency(concurrency)
+                # Drop separators built with other settings, and their cores
+                pool.clear()
+                gc.collect()
+                count = songs or 2 * concurrency
+                with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                    # Load one separator per concurrent separation first
+                    list(executor.map(separate, range(concurrency)))
+                    run = {
+                        "concurrency": concurrency,
+                        "threads": onnx_threads.thread_policy().intra_op_threads,
+                        "songs": count,
+                    }
+                    with timer(run, "seconds"):
+                        latencies = list(executor.map(separate, range(count)))
+                run["songs_per_hour"] = round(count / run["seconds"] * 3600, 1)
+                run["median_latency"] = round(statistics.median(latencies), 3)
+                results["runs"].append(run)
+                click.echo(
+                    f"{concurrency:>3} at once, {run['threads']:>3} threads: "
+                    f"{run['songs_per_hour']:8.1f} songs/hour, "
+                    f"{run['median_latency']:7.2f}s per song"
+                )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if output:
+        output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Compare the memory gunicorn-style workers hold with and without PRELOAD_MODELS.
+
+Forks --workers processes the way gunicorn does, once from a parent that hasn't
+read the model and once from one that has preloaded its ORT format copy. Each
+worker separates a song, and while they're all still alive the benchmark reads
+every worker's resident (rss), proportional (pss) and shared memory. The
+saving from sharing the weights shows as a lower total pss.
+
+    python benchmarks/shared_models.py -w 4 --output memory.json
+"""
+import gc
+import json
+import os
+import shutil
+import signal
+import statistics
+import tempfile
+from pathlib import Path
+
+import click
+
+from common import make_song, setup_django
+
+
+def run_workers(workers: int, song: Path, model: str, work_dir: Path) -> list[dict]:
+    """Fork the workers, separate a song in each, and return each one's memory."""
+    from karaoke import music_separation, shared_models
+
+    pids = []
+    ready_read, ready_write = os.pipe()
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            try:
+                song_dir = Path(tempfile.mkdtemp(dir=work_dir))
+                music_separation.split_song(song, song_dir, model)
+                os.write(ready_write, b"1")
+                signal.pause()
+            finally:
+                os._exit(1)
+        pids.append(pid)
+    os.close(ready_write)
+    try:
+        # Every worker is measured while all of them hold their model, as PSS
+        # divides shared pages between the processes that map them
+        for _ in range(workers):
+            if not os.read(ready_read, 1):
+                raise click.ClickException("A worker exited before it separated")
+        return [shared_models.memory_usage(pid) for pid in pids]
+    finally:
+        os.close(ready_read)
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+
+
+@click.command()
+@click.option("--song", type=click.Path(exists=True, path_type=Path))
+@click.option("--seconds", default=30.0, help="Length of the synthetic song")
+@click.option("--model", default=None, help="Model file name")
+@click.option("--workers", "-w", default=2, help="Worker processes to fork")
+@click.option("--output", type=click.Path(path_type=Path), help="Write results as JSON")
+def main(song, seconds, model, workers, output):
+    setup_django()
+    from karaoke import music_separation, shared_models
+
+    try:
+        import audio_separator  # noqa: F401
+        import onnxruntime  # noqa: F401
+    except ModuleNotFoundError:
+        raise click.ClickException(
+            "This benchmark needs audio-separator and onnxruntime installed"
+        )
+
+    model = model or music_separation.DEFAULT_MODEL
+    model_path = music_separation.MODELS_DIR / model
+    if not model_path.exists():
+        raise click.ClickException(f"Run manage.py prepare_models to fetch {model}")
+    if not shared_models.ort_path(model_path).exists():
+        shared_models.convert_to_ort(model_path)
+    work_dir = Path(tempfile.mkdtemp(prefix="bench-shared-"))
+    song = song or make_song(work_dir / "song.wav", seconds)
+    results = {"song": str(song), "model": model, "workers": workers, "runs": []}
+
+    try:
+        for preload in (False, True):
+            if preload:
+                shared_models.preload([model])
+                gc.freeze()
+            usages = run_workers(workers, song, model, work_dir)
+            run = {"preload": preload}
+            for kind in ("rss", "pss", "shared"):
+                amounts = [usage[kind] / 2**20 for usage in usages]
+                run[f"median_{kind}_mib"] = round(statistics.median(amounts), 1)
+            run["total_pss_mib"] = round(sum(u["pss"] for u in usages) / 2**20, 1)
+            results["runs"].append(run)
+            click.echo(
+                f"{'preloaded' if preload else 'separate ':>9}: "
+                f"{run['median_rss_mib']:7.1f} MiB rss, "
+                f"{run['median_shared_mib']:7.1f} MiB shared per worker, "
+                f"{run['total_pss_mib']:8.1f} MiB pss in all"
+            )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if output:
+        output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
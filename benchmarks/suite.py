@@ -0,0 +1,236 @@
+"""
+Time the API's hot paths on synthetic songs, entirely offline.
+
+For each song length this times writing the upload, separation, audio and
+video encoding, zipping, and streaming the response, and records the peak
+memory of each stage. Loading the model is timed once. Without audio-separator
+or the model's weights, a stub separator stands in for the model so that
+everything around separation can still be measured. Stages that need ffmpeg
+are skipped when it isn't installed.
+
+    python benchmarks/suite.py -s 30 -s 180 --output before.json
+    python benchmarks/compare.py before.json after.json
+"""
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable
+
+import click
+
+from common import make_song, make_subtitles, peak_rss, setup_django, timer
+
+
+class StubSeparator:
+    """Stands in for audio_separator's Separator. Splits the mix into its mid
+    and side channels, which costs about as much I/O as a real model."""
+
+    def __init__(self):
+        self.output_dir = "."
+        self.model_instance = SimpleNamespace(output_dir=".")
+
+    def separate(self, path: str) -> list[str]:
+        from karaoke.chunked_separation import read_wav, write_wav
+
+        samples = read_wav(Path(path))
+        mid = samples.mean(axis=1, keepdims=True).repeat(2, axis=1)
+        stem = Path(path).stem
+        names = [f"{stem}_(Vocals).wav", f"{stem}_(Instrumental).wav"]
+        write_wav(Path(self.output_dir) / names[0], mid)
+        write_wav(Path(self.output_dir) / names[1], samples - mid)
+        # Vocals come first, as they do for the default model
+        return names
+
+
+def real_model_available(model_name: str) -> bool:
+    from karaoke import music_separation
+
+    try:
+        import audio_separator  # noqa: F401
+    except ModuleNotFoundError:
+        return False
+    return (music_separation.MODELS_DIR / model_name).exists()
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option(
+    "--seconds",
+    "-s",
+    "lengths",
+    multiple=True,
+    type=float,
+    help="Song lengths to try (default: 30, 120 and 300)",
+)
+@click.option("--model", default=None, help="Model file name")
+@click.option(
+    "--stub/--no-stub", default=None, help="Force the stub separator on or off"
+)
+@click.option("--repeat", default=3, help="Runs per stage; the fastest is reported")
+@click.option("--output", type=click.Path(path_type=Path), help="Write results as JSON")
+def main(lengths, model, stub, repeat, output):
+    commit = git_commit()
+    setup_django()
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import RequestFactory
+
+    import views
+    from helpers import zipstream
+    from helpers.file_response import file_response
+    from helpers.uploads import store_upload
+    from karaoke import make_karaoke_video, music_separation
+
+    lengths = lengths or [30.0, 120.0, 300.0]
+    model = model or music_separation.DEFAULT_MODEL
+    if stub is None:
+        stub = not real_model_available(model)
+    has_ffmpeg = shutil.which("ffmpeg") is not None
+    fonts_dir = Path("assets") / "fonts"
+    results = {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cores": os.cpu_count(),
+        "model": "stub" if stub else model,
+        "repeat": repeat,
+        "stages": [],
+    }
+
+    def measure(stage: str, seconds_of_audio: float | None, work: Callable):
+        """Run work repeat times. Record its fastest time and highest peak memory."""
+        runs = []
+        value = None
+        for _ in range(repeat):
+            run = {}
+            with peak_rss(run, "peak_rss_mb"), timer(run, "seconds"):
+                value = work()
+            runs.append(run)
+        entry = {
+            "stage": stage,
+            "seconds_of_audio": seconds_of_audio,
+            "seconds": min(run["seconds"] for run in runs),
+            "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+        }
+        results["stages"].append(entry)
+        click.echo(
+            f"{stage:>20} {seconds_of_audio or '':>6}: {entry['seconds']:8.3f}s "
+            f"{entry['peak_rss_mb']:8.1f} MiB"
+        )
+        return value
+
+    def skip(stage: str, seconds_of_audio: float | None, reason: str) -> None:
+        results["stages"].append(
+            {"stage": stage, "seconds_of_audio": seconds_of_audio, "skipped": reason}
+        )
+        click.echo(f"{stage:>20} {seconds_of_audio or '':>6}: skipped, {reason}")
+
+    def fresh_dir(*parts: str) -> Path:
+        path = work_dir.joinpath(*parts)
+        shutil.rmtree(path, ignore_errors=True)
+        path.mkdir(parents=True)
+        return path
+
+    work_dir = Path(tempfile.mkdtemp(prefix="bench-suite-"))
+    try:
+        if stub:
+            separator = measure("model_load", None, StubSeparator)
+        else:
+            pool = music_separation.get_separator_pool()
+
+            def load():
+                pool.clear()
+                pool.preload([model])
+
+            measure("model_load", None, load)
+
+        for seconds in lengths:
+            song = make_song(work_dir / f"song-{seconds:g}.wav", seconds)
+            song_bytes = song.read_bytes()
+
+            def write_upload():
+                upload = SimpleUploadedFile(song.name, song_bytes)
+                return store_upload(upload, fresh_dir("upload"))
+
+            upload_path = measure("upload_write", seconds, write_upload)
+
+            def separate():
+                song_dir = fresh_dir("separate")
+                if not stub:
+                    return music_separation.split_song(upload_path, song_dir, model)
+                music_separation.set_output_dir(separator, song_dir)
+                vocals, accompaniment = separator.separate(str(upload_path))
+                return song_dir / accompaniment, song_dir / vocals
+
+            accompaniment_path, vocals_path = measure("separation", seconds, separate)
+            members = [
+                ("accompaniment.wav", accompaniment_path),
+                ("vocals.wav", vocals_path),
+            ]
+
+            if has_ffmpeg:
+                measure(
+                    "encode_audio",
+                    seconds,
+                    lambda: make_karaoke_video.encode_audio(
+                        accompaniment_path, fresh_dir("audio") / "audio.mp3"
+                    ),
+                )
+                subtitles = make_subtitles(seconds)
+
+                def encode_video():
+                    output_dir = fresh_dir("video")
+                    make_karaoke_video.create_video(
+                        accompaniment_path, subtitles, output_dir, fonts_dir
+                    )
+                    return output_dir / "karaoke.mp4"
+
+                video_path = measure("encode_video", seconds, encode_video)
+                members.append(("karaoke.mp4", video_path))
+            else:
+                skip("encode_audio", seconds, "ffmpeg not found")
+                skip("encode_video", seconds, "ffmpeg not found")
+
+            zip_path = measure(
+                "zip",
+                seconds,
+                lambda: zipstream.write_zip(members, fresh_dir("zip") / "song.zip"),
+            )
+
+            def stream_zip():
+                response = views.streamed_zip_response(members, "song.zip")
+                size = sum(len(chunk) for chunk in response)
+                response.close()
+                return size
+
+            measure("stream_zip_response", seconds, stream_zip)
+
+            def stream_file():
+                request = RequestFactory().get("/", HTTP_RANGE="bytes=0-")
+                response = file_response(request, zip_path)
+                size = sum(len(chunk) for chunk in response)
+                response.close()
+                return size
+
+            measure("file_response", seconds, stream_file)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if output:
+        output.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import threading
+import time
+
+import pytest
+
+from helpers.admission import (
+    RENDER,
+    SEPARATION,
+    YOUTUBE,
+    Limiter,
+    Overloaded,
+    auto_limit,
+)
+
+GIB = 1024 * 1024 * 1024
+
+
+def test_full_queue_is_rejected(tmp_path):
+    limiter = Limiter(tmp_path, SEPARATION, limit=1, queue_size=0, queue_timeout=10)
+    with limiter.admit():
+        with pytest.raises(Overloaded) as error:
+            with limiter.admit():
+                pass
+    assert error.value.retry_after >= 1
+    # The slot is free again
+    with limiter.admit():
+        pass
+
+
+def test_queued_request_gets_freed_slot(tmp_path):
+    limiter = Limiter(tmp_path, SEPARATION, limit=1, queue_size=1, queue_timeout=10)
+    admitted = threading.Event()
+
+    def queued():
+        with limiter.admit():
+            admitted.set()
+
+    with limiter.admit():
+        thread = threading.Thread(target=queued)
+        thread.start()
+        time.sleep(0.3)
+        assert not admitted.is_set()
+        # The queue holds one request, so a third is turned away
+        with pytest.raises(Overloaded):
+            with limiter.admit():
+                pass
+    thread.join(5)
+    assert admitted.is_set()
+
+
+def test_queue_times_out(tmp_path):
+    limiter = Limiter(tmp_path, SEPARATION, limit=1, queue_size=1, queue_timeout=0.2)
+    with limiter.admit():
+        with pytest.raises(Overloaded):
+            with limiter.admit():
+                pass
+
+
+def test_queue_is_shared_between_kinds(tmp_path):
+    separation = Limiter(tmp_path, SEPARATION, limit=1, queue_size=1, queue_timeout=1)
+    render = Limiter(tmp_path, RENDER, limit=1, queue_size=1, queue_timeout=1)
+    queued = threading.Event()
+
+    def queue_separation():
+        queued.set()
+        with pytest.raises(Overloaded):
+            with separation.admit():
+                pass
+
+    with separation.admit(), render.admit():
+        thread = threading.Thread(target=queue_separation)
+        thread.start()
+        queued.wait(5)
+        time.sleep(0.2)
+        # The separation waiting for a slot took the only queue place
+        with pytest.raises(Overloaded):
+            with render.admit():
+                pass
+        thread.join(5)
+
+
+def test_requests_leave_threads_free(tmp_path):
+    threads = threading.Semaphore(1)
+    separation = Limiter(
+        tmp_path, SEPARATION, limit=2, queue_size=0, queue_timeout=10, threads=threads
+    )
+    youtube = Limiter(
+        tmp_path, YOUTUBE, limit=2, queue_size=0, queue_timeout=10, threads=threads
+    )
+    with separation.admit():
+        # Slots are free, but this process has no request threads to spare
+        with pytest.raises(Overloaded):
+            with youtube.admit():
+                pass
+        # Background jobs don't run on request threads
+        with youtube.admit(queue=False):
+            pass
+    with youtube.admit():
+        pass
+
+
+def test_slots_are_shared_between_limiters(tmp_path):
+    # Like the same limiter in two worker processes
+    first = Limiter(tmp_path, SEPARATION, limit=1, queue_size=0, queue_timeout=10)
+    second = Limiter(tmp_path, SEPARATION, limit=1, queue_size=0, queue_timeout=10)
+    with first.admit():
+        with pytest.raises(Overloaded):
+            with second.admit():
+                pass
+
+
+def test_auto_limit():
+    assert auto_limit(SEPARATION, cores=16, memory=64 * GIB) == 4
+    assert auto_limit(SEPARATION, cores=16, memory=4 * GIB) == 2
+    assert auto_limit(SEPARATION, cores=2, memory=1 * GIB) == 1
+    assert auto_limit(YOUTUBE, cores=4, memory=64 * GIB) == 8
@@ -0,0 +1,43 @@
+import pytest
+
+from helpers.file_response import FileRange, parse_range
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        ("bytes=0-99", (0, 99)),
+        ("bytes=100-", (100, 999)),
+        ("bytes=-100", (900, 999)),
+        ("bytes=900-5000", (900, 999)),
+        ("bytes=-5000", (0, 999)),
+        ("bytes=0-1,5-6", None),
+        ("items=0-1", None),
+        ("bytes=-", None),
+    ],
+)
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=10-5", "bytes=-0"])
+def test_parse_unsatisfiable_range(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 1000)
+
+
+def test_file_range_reads_only_its_range(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(bytes(range(100)))
+    closed = []
+
+    f = path.open("rb")
+    file_range = FileRange(f, 10, 5, on_close=lambda: closed.append(True))
+
+    assert f.tell() == 10
+    assert file_range.read(3) == bytes([10, 11, 12])
+    assert file_range.read() == bytes([13, 14])
+    assert file_range.read() == b""
+    file_range.close()
+    assert f.closed
+    assert closed == [True]
@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+from helpers.jobs import DONE, FAILED, JobManager, QueueFull
+
+
+def wait_for(jobs: JobManager, job_id: str):
+    for _ in range(100):
+        job = jobs.get(job_id)
+        if job.finished:
+            return job
+        time.sleep(0.01)
+    raise TimeoutError(job_id)
+
+
+def test_job_result(tmp_path):
+    jobs = JobManager(tmp_path, max_workers=1, max_queued=0, ttl=60)
+    job = jobs.create("test")
+    result = jobs.job_dir(job) / "result.txt"
+
+    def work():
+        result.write_text("done")
+        return result
+
+    jobs.start(job, work)
+    job = wait_for(jobs, job.id)
+    assert job.status == DONE
+    assert jobs.result_path(job) == result
+    assert jobs.pending() == 0
+
+
+def test_job_failure(tmp_path):
+    jobs = JobManager(tmp_path, max_workers=1, max_queued=0, ttl=60)
+    job = jobs.create("test")
+
+    def work():
+        raise ValueError("nope")
+
+    jobs.start(job, work)
+    job = wait_for(jobs, job.id)
+    assert job.status == FAILED
+    assert job.error == "nope"
+    assert jobs.result_path(job) is None
+
+
+def test_queue_full(tmp_path):
+    jobs = JobManager(tmp_path, max_workers=1, max_queued=1, ttl=60)
+    jobs.create("test")
+    jobs.create("test")
+    with pytest.raises(QueueFull):
+        jobs.create("test")
+
+
+def test_expire_finished_jobs(tmp_path):
+    jobs = JobManager(tmp_path, max_workers=1, max_queued=0, ttl=0)
+    job = jobs.create("test")
+    jobs.start(job, lambda: jobs.job_dir(job) / "job.json")
+    wait_for(jobs, job.id)
+    time.sleep(0.01)
+    jobs.expire()
+    assert jobs.get(job.id) is None
+
+
+def test_expire_tolerates_jobs_deleted_meanwhile(tmp_path, monkeypatch):
+    jobs = JobManager(tmp_path, max_workers=1, max_queued=0, ttl=0)
+    (tmp_path / "half-created").mkdir()
+
+    def get(job_id):
+        # Another worker deletes the job between the listing and the stat
+        (tmp_path / job_id).rmdir()
+
+    monkeypatch.setattr(jobs, "get", get)
+    jobs.expire()
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from helpers.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_histogram_buckets_are_cumulative(tmp_path):
+    registry = Registry(tmp_path)
+    histogram = Histogram(
+        "test_seconds", "Test.", ("stage",), buckets=(1, 5), registry=registry
+    )
+    histogram.observe(0.5, stage="zip")
+    histogram.observe(3, stage="zip")
+    histogram.observe(10, stage="zip")
+    text = registry.collect()
+    assert "# TYPE test_seconds histogram" in text
+    assert 'test_seconds_bucket{stage="zip",le="1.0"} 1' in text
+    assert 'test_seconds_bucket{stage="zip",le="5.0"} 2' in text
+    assert 'test_seconds_bucket{stage="zip",le="+Inf"} 3' in text
+    assert 'test_seconds_sum{stage="zip"} 13.5' in text
+    assert 'test_seconds_count{stage="zip"} 3' in text
+
+
+def test_labels_must_match(tmp_path):
+    counter = Counter("test_total", "Test.", ("cache",), registry=Registry(tmp_path))
+    with pytest.raises(ValueError):
+        counter.inc(view="zip")
+
+
+def test_collect_adds_up_processes(tmp_path):
+    registry = Registry(tmp_path)
+    counter = Counter("test_total", "Test.", registry=registry)
+    gauge = Gauge("test_running", "Test.", registry=registry)
+    counter.inc(2)
+    with gauge.track_in_progress():
+        gauge.inc()
+    # A process that has exited: its counters still count, its gauges don't
+    dead_pid = 2**22 + 1
+    (tmp_path / f"{dead_pid}.json").write_text(
+        json.dumps({"test_total": [[[], 3.0]], "test_running": [[[], 5.0]]})
+    )
+    text = registry.collect()
+    assert "test_total 5.0" in text
+    assert "test_running 1.0" in text
+
+
+def test_values_are_saved_per_process(tmp_path):
+    registry = Registry(tmp_path)
+    counter = Counter("test_total", "Test.", ("cache",), registry=registry)
+    counter.inc(cache="models")
+    # Values are written by the next flush, not by every update
+    assert not list(tmp_path.glob("*.json"))
+    registry.flush()
+    (path,) = tmp_path.glob("*.json")
+    assert json.loads(path.read_text())["test_total"] == [[["models"], 1.0]]
+
+    counter.inc(cache="models")
+    registry.flush()
+    assert json.loads(path.read_text())["test_total"] == [[["models"], 2.0]]
+    registry.clear()
+    assert not tmp_path.exists()
@@ -0,0 +1,87 @@
+import json
+import os
+import time
+
+import pytest
+
+from helpers.progress import (
+    DONE,
+    FAILED,
+    ProgressReporter,
+    expire_channels,
+    finished,
+    follow,
+    read_events,
+    server_sent_events,
+    tracking,
+)
+
+
+def test_follow_stops_when_done(tmp_path):
+    path = tmp_path / "channel.ndjson"
+    reporter = ProgressReporter(path)
+    with tracking(reporter):
+        reporter("separation", percent=50)
+    events = [event for event in follow(path, timeout=1) if event]
+    assert [event["stage"] for event in events] == ["separation", DONE]
+    assert events[0]["percent"] == 50
+
+
+def test_tracking_reports_failure(tmp_path):
+    path = tmp_path / "channel.ndjson"
+    reporter = ProgressReporter(path)
+    with pytest.raises(ValueError):
+        with tracking(reporter):
+            raise ValueError("nope")
+    events = [event for event in follow(path, timeout=1) if event]
+    assert events == [{"stage": FAILED, "time": events[0]["time"], "error": "nope"}]
+
+
+def test_follow_ignores_partial_lines(tmp_path):
+    path = tmp_path / "channel.ndjson"
+    path.write_text(json.dumps({"stage": "render"}) + '\n{"stage": ')
+    events = follow(path, timeout=5)
+    assert next(events) == {"stage": "render"}
+    # The partial line isn't read until it's finished
+    assert next(events) is None
+    with path.open("a") as f:
+        f.write('"done"}\n')
+    assert [event for event in events if event] == [{"stage": DONE}]
+
+
+def test_read_events_from_offset(tmp_path):
+    path = tmp_path / "channel.ndjson"
+    assert read_events(path) == ([], 0)
+    reporter = ProgressReporter(path)
+    reporter("separation", percent=50)
+    events, offset = read_events(path)
+    assert [event["stage"] for event in events] == ["separation"]
+    assert not finished(events)
+    reporter(DONE)
+    events, offset = read_events(path, offset)
+    assert [event["stage"] for event in events] == [DONE]
+    assert finished(events)
+    assert read_events(path, offset) == ([], offset)
+
+
+def test_follow_times_out(tmp_path):
+    assert list(follow(tmp_path / "missing.ndjson", timeout=0)) == []
+
+
+def test_server_sent_events(tmp_path):
+    path = tmp_path / "channel.ndjson"
+    ProgressReporter(path)(DONE)
+    (message,) = server_sent_events(path, timeout=1)
+    assert message.startswith(b"event: done\ndata: {")
+    assert message.endswith(b"}\n\n")
+
+
+def test_expire_channels(tmp_path):
+    old = tmp_path / "old.ndjson"
+    new = tmp_path / "new.ndjson"
+    old.write_text("")
+    new.write_text("")
+    os.utime(old, (time.time() - 100, time.time() - 100))
+    expire_channels(tmp_path, ttl=50)
+    assert not old.exists()
+    assert new.exists()
@@ -0,0 +1,29 @@
+from django.core.files import File
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from helpers.uploads import store_upload
+
+
+class SpooledUpload(File):
+    """Stands in for TemporaryUploadedFile, which needs Django settings."""
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def test_moves_spooled_upload(tmp_path):
+    spooled = tmp_path / "tmp1234.upload.wav"
+    spooled.write_bytes(b"song")
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    with spooled.open("rb") as f:
+        path = store_upload(SpooledUpload(f, name="my song.wav"), dest)
+    assert path == dest / "my_song.wav"
+    assert path.read_bytes() == b"song"
+    assert not spooled.exists()
+
+
+def test_writes_in_memory_upload(tmp_path):
+    path = store_upload(SimpleUploadedFile("../song.mp3", b"song"), tmp_path)
+    assert path == tmp_path / "song.mp3"
+    assert path.read_bytes() == b"song"
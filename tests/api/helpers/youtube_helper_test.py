@@ -4,6 +4,7 @@ import pytest
 import pytubefix
 
 from helpers import youtube_helper
+from karaoke.disk_cache import DiskCache
 
 
 def test_get_youtube_streams():
@@ -20,3 +21,90 @@ def test_assemble_metadata():
     metadata = youtube_helper.assemble_metadata(youtube)
     assert "title" in metadata
     assert metadata["title"] == youtube.title
+
+
+def test_get_youtube_streams_cached(tmp_path, monkeypatch):
+    downloads = []
+
+    def download(youtube_url, song_files_dir, height):
+        downloads.append(height)
+        audio_path = song_files_dir / "audio"
+        audio_path.write_bytes(b"audio")
+        if height is None:
+            return {"title": "Song"}, audio_path, None
+        video_path = song_files_dir / "video"
+        video_path.write_bytes(b"video")
+        return {"title": "Song"}, audio_path, video_path
+
+    cache = DiskCache(tmp_path / "cache")
+    monkeypatch.setattr(youtube_helper, "get_youtube_cache", lambda: cache)
+    monkeypatch.setattr(youtube_helper, "download_youtube_streams", download)
+    url = "https://www.youtube.com/watch?v=jVFIbpZA04I"
+    for name in ["first", "second"]:
+        song_files_dir = tmp_path / name
+        song_files_dir.mkdir()
+        metadata, audio_path, video_path = youtube_helper.get_youtube_streams(
+            url, song_files_dir
+        )
+        assert metadata == {"title": "Song"}
+        assert audio_path.read_bytes() == b"audio"
+        assert video_path == song_files_dir / "video"
+    assert downloads == [1080]
+
+    # Each mode is cached separately
+    _, _, video_path = youtube_helper.get_youtube_streams(url, tmp_path, "audio")
+    assert video_path is None
+    assert downloads == [1080, None]
+
+
+def test_fetch_locks_are_per_key():
+    with youtube_helper._fetch_lock("a-1080p"):
+        # Another video doesn't wait for this one
+        with youtube_helper._fetch_lock("b-1080p"):
+            assert set(youtube_helper._fetch_locks) == {"a-1080p", "b-1080p"}
+    assert youtube_helper._fetch_locks == {}
+
+
+class FakeStream:
+    def __init__(self, subtype="mp4", abr=None, resolution=None, filesize_approx=0):
+        self.subtype = subtype
+        self.abr = abr
+        self.resolution = resolution
+        self.filesize_approx = filesize_approx
+
+
+def test_max_height():
+    assert youtube_helper.max_height("audio") is None
+    assert youtube_helper.max_height("720p") == 720
+    with pytest.raises(ValueError):
+        youtube_helper.max_height("huge")
+    with pytest.raises(ValueError):
+        youtube_helper.max_height("000p")
+
+
+def test_select_audio_stream():
+    low = FakeStream(abr="48kbps")
+    medium = FakeStream(abr="128kbps")
+    high = FakeStream(abr="160kbps")
+    webm = FakeStream(subtype="webm", abr="128kbps")
+    assert youtube_helper.select_audio_stream([high, webm, low, medium]) is medium
+    # Nothing is good enough, so take the best there is
+    assert (
+        youtube_helper.select_audio_stream([low, FakeStream(abr="70kbps")]).abr
+        == "70kbps"
+    )
+
+
+def test_select_video_stream():
+    small_720 = FakeStream(resolution="720p", filesize_approx=10)
+    big_720 = FakeStream(subtype="webm", resolution="720p", filesize_approx=20)
+    stream_480 = FakeStream(resolution="480p", filesize_approx=5)
+    stream_1080 = FakeStream(resolution="1080p", filesize_approx=50)
+    webm_1080 = FakeStream(subtype="webm", resolution="1080p", filesize_approx=30)
+    streams = [big_720, stream_1080, webm_1080, stream_480, small_720]
+    assert youtube_helper.select_video_stream(streams, 720) is small_720
+    # mp4 wins over a smaller stream in another container
+    assert youtube_helper.select_video_stream(streams, 1080) is stream_1080
+    assert youtube_helper.select_video_stream([big_720], 1080) is big_720
+    assert youtube_helper.select_video_stream(streams, 600) is stream_480
+    assert youtube_helper.select_video_stream(streams, 240) is stream_480
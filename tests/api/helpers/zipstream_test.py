@@ -0,0 +1,29 @@
+import io
+import zipfile
+
+from helpers import zipstream
+
+
+def test_stream_zip_round_trip(tmp_path):
+    stem = tmp_path / "stem.wav"
+    stem.write_bytes(b"RIFF" + bytes(range(256)) * 10000)
+    members = [("accompaniment.wav", stem), ("metadata.json", b'{"title": "x"}')]
+
+    archive = b"".join(zipstream.stream_zip(members))
+
+    with zipfile.ZipFile(io.BytesIO(archive)) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.read("accompaniment.wav") == stem.read_bytes()
+        assert zip_file.read("metadata.json") == b'{"title": "x"}'
+        infos = {info.filename: info for info in zip_file.infolist()}
+    assert infos["accompaniment.wav"].compress_type == zipfile.ZIP_STORED
+    assert infos["metadata.json"].compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_stream_zip_yields_before_reading_everything(tmp_path):
+    stem = tmp_path / "video.mp4"
+    stem.write_bytes(b"\0" * (3 * zipstream.CHUNK_SIZE))
+
+    chunks = zipstream.stream_zip([("video.mp4", stem)])
+
+    assert len(next(chunks)) <= zipstream.CHUNK_SIZE + 1024
@@ -0,0 +1,21 @@
+from pathlib import Path
+
+import pytest
+
+from karaoke import audio_encoding
+
+
+def test_get_stem_format_rejects_unknown_format():
+    with pytest.raises(ValueError):
+        audio_encoding.get_stem_format("wma")
+
+
+@pytest.mark.parametrize("bitrate", ["192", "-b:v 1M", "1000000k"])
+def test_get_stem_format_rejects_bad_bitrate(bitrate):
+    with pytest.raises(ValueError):
+        audio_encoding.get_stem_format("opus", bitrate)
+
+
+def test_wav_stems_are_not_reencoded():
+    stems = [Path("accompaniment.wav"), Path("vocals.wav")]
+    assert audio_encoding.encode_stems(stems, "wav") == stems
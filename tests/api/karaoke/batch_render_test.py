@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from karaoke import batch_render, make_karaoke_video, music_separation, pipeline
+
+
+@pytest.fixture
+def songs_dir(tmp_path):
+    for name in ("one", "two", "three"):
+        song_dir = tmp_path / name
+        song_dir.mkdir()
+        (song_dir / "song.mp3").write_bytes(b"audio")
+    (tmp_path / "not a song").mkdir()
+    return tmp_path
+
+
+@pytest.fixture
+def stages(monkeypatch):
+    """Fake separation and rendering. Renders of songs in stages["broken"] fail."""
+    calls = {"separate": [], "render": [], "broken": set()}
+
+    def separate(song_dir, model_name, artifacts_dir):
+        calls["separate"].append(song_dir)
+        return f"separate-{len(calls['separate'])}", 0.5
+
+    def render(song_dir, separation_id, out_dir, encode_profile, artifacts_dir):
+        calls["render"].append(song_dir)
+        if song_dir in calls["broken"]:
+            raise RuntimeError("ffmpeg failed")
+        return f"{song_dir}/video.mp4", 0.25
+
+    monkeypatch.setattr(batch_render, "_separate", separate)
+    monkeypatch.setattr(batch_render, "_render", render)
+    monkeypatch.setattr(pipeline, "artifact_exists", lambda id, stage, store: True)
+    return calls
+
+
+def run(manifest_path, songs_dir):
+    manifest = batch_render.load_manifest(
+        manifest_path, batch_render.find_songs(songs_dir)
+    )
+    return batch_render.render_all(
+        manifest,
+        lambda manifest: batch_render.save_manifest(manifest_path, manifest),
+        songs_dir / batch_render.ARTIFACTS,
+        executor_class=ThreadPoolExecutor,
+    )
+
+
+def test_interrupted_runs_resume(songs_dir, stages):
+    manifest_path = songs_dir / batch_render.MANIFEST
+    stages["broken"].add(str(songs_dir / "two"))
+    assert run(manifest_path, songs_dir) == {"done": 2, "failed": 1}
+    manifest = batch_render.load_manifest(manifest_path)
+    assert set(manifest["songs"]) == {"one", "two", "three"}
+    assert manifest["songs"]["one"]["seconds"] == {"separate": 0.5, "render": 0.25}
+    assert manifest["songs"]["two"]["error"] == "render: ffmpeg failed"
+
+    stages["broken"].clear()
+    assert run(manifest_path, songs_dir) == {"done": 3}
+    # Only the failed render ran again, from its earlier separation
+    assert len(stages["separate"]) == 3
+    assert stages["render"].count(str(songs_dir / "two")) == 2
+    assert len(stages["render"]) == 4
+    assert "error" not in batch_render.load_manifest(manifest_path)["songs"]["two"]
+
+
+def test_output_filename():
+    assert (
+        batch_render.output_filename({"title": "Hey/Ho", "artist": "Band"})
+        == "Band - Hey_Ho [karaoke].mp4"
+    )
+    assert (
+        batch_render.output_filename({"title": "Song", "artist": ""})
+        == "Song [karaoke].mp4"
+    )
+
+
+def test_separations_are_kept_next_to_the_manifest(songs_dir, monkeypatch):
+    separation_id = "separate-" + "0" * 64
+    calls = []
+
+    def separate(song_dir, model_name, artifacts_dir):
+        calls.append(("separate", song_dir))
+        # A real separation stores its artifact there
+        (Path(artifacts_dir) / separation_id).mkdir(parents=True, exist_ok=True)
+        return separation_id, 0.5
+
+    def render(song_dir, separation_id, out_dir, encode_profile, artifacts_dir):
+        calls.append(("render", song_dir))
+        assert artifacts_dir == str(songs_dir / batch_render.ARTIFACTS)
+        raise RuntimeError("ffmpeg failed")
+
+    monkeypatch.setattr(batch_render, "_separate", separate)
+    monkeypatch.setattr(batch_render, "_render", render)
+    manifest_path = songs_dir / batch_render.MANIFEST
+    assert run(manifest_path, songs_dir) == {"failed": 3}
+    calls.clear()
+    run(manifest_path, songs_dir)
+    # The separations were found in the batch's own store, whatever the
+    # server's artifact store holds
+    assert {stage for stage, _ in calls} == {"render"}
+
+
+def test_only_separations_are_kept(songs_dir, monkeypatch):
+    artifacts_dir = songs_dir / batch_render.ARTIFACTS
+
+    def split_song_auto(songfile, song_dir, model_name=None, progress=None):
+        accompaniment = song_dir / "accompaniment.wav"
+        accompaniment.write_bytes(b"accompaniment")
+        return accompaniment, song_dir / "vocals.wav"
+
+    def run(songfile, subtitles, output_filename, output_dir, store, **options):
+        # The render's own stages would be stored here
+        assert store.root != artifacts_dir
+        assert store.get(options["separation_id"]) is not None
+        store.put("mux-video", {output_filename: songs_dir / "one" / "song.mp3"})
+        (output_dir / output_filename).write_bytes(b"video")
+
+    monkeypatch.setattr(music_separation, "split_song_auto", split_song_auto)
+    monkeypatch.setattr(make_karaoke_video, "run", run)
+    (songs_dir / "one" / "subtitles.ass").write_text("[Script Info]")
+    separation_id, _ = batch_render._separate(
+        str(songs_dir / "one"), None, str(artifacts_dir)
+    )
+    video, _ = batch_render._render(
+        str(songs_dir / "one"), separation_id, None, None, str(artifacts_dir)
+    )
+    assert Path(video).read_bytes() == b"video"
+    assert [path.name for path in artifacts_dir.iterdir()] == [separation_id]
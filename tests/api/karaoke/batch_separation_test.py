@@ -0,0 +1,108 @@
+import shutil
+
+import numpy as np
+import pytest
+
+from karaoke import batch_separation, chunked_separation, music_separation
+from karaoke.chunked_separation import SAMPLE_RATE, read_wav, write_wav
+
+
+@pytest.fixture
+def songs(tmp_path):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i, seconds in enumerate([1.0, 2.0, 1.5]):
+        samples = rng.uniform(-0.5, 0.5, (int(seconds * SAMPLE_RATE), 2))
+        paths.append(write_wav(tmp_path / f"song{i}.wav", samples.astype(np.float32)))
+    return paths
+
+
+@pytest.fixture
+def separations(monkeypatch):
+    """Separate by copying the mix to the accompaniment, with silent vocals."""
+    passes = []
+
+    def decode(songfile, pcm_path):
+        if songfile.suffix != ".wav":
+            raise ValueError("not audio")
+        return (read_wav(songfile) * 32768).astype("<i2")
+
+    def split_song(songfile, song_dir, model_name=None):
+        frames = len(read_wav(songfile))
+        passes.append(frames)
+        if frames > 4 * SAMPLE_RATE:
+            raise RuntimeError("too long")
+        accompaniment = song_dir / "accompaniment.wav"
+        shutil.copy(songfile, accompaniment)
+        return accompaniment, song_dir / "vocals.wav"
+
+    monkeypatch.setattr(batch_separation, "decode", decode)
+    monkeypatch.setattr(music_separation, "split_song", split_song)
+    return passes
+
+
+def test_songs_are_cut_back_out_of_a_pack(tmp_path, songs, separations):
+    results = list(
+        batch_separation.split_songs(songs[:2], tmp_path / "out", gap_seconds=0.5)
+    )
+    assert len(separations) == 1
+    assert [result.index for result in results] == [0, 1]
+    for result, song in zip(results, songs):
+        assert result.error is None
+        np.testing.assert_allclose(
+            read_wav(result.accompaniment), read_wav(song), atol=2 / 32768
+        )
+        vocals = read_wav(result.vocals)
+        assert vocals.shape == read_wav(song).shape
+        assert not vocals.any()
+
+
+def test_packs_are_capped(tmp_path, songs, separations):
+    results = list(
+        batch_separation.split_songs(
+            songs, tmp_path / "out", max_pack_seconds=4, gap_seconds=0.5
+        )
+    )
+    assert len(results) == 3
+    assert len(separations) == 2
+
+
+def test_failures_stay_with_their_song(tmp_path, songs, separations):
+    bad = tmp_path / "notes.txt"
+    bad.write_text("not a song")
+    results = {
+        result.index: result
+        for result in batch_separation.split_songs(
+            [songs[0], bad, songs[1], songs[2]], tmp_path / "out", gap_seconds=0.5
+        )
+    }
+    assert "not audio" in results[1].error
+    # The pack of all three songs was too long for the fake separator, so each
+    # song was separated on its own
+    assert all(results[i].error is None for i in (0, 2, 3))
+    assert chunked_separation.SAMPLE_RATE * 4 < separations[0]
+    assert len(separations) == 4
+
+
+def test_song_whose_stems_cant_be_cut_fails_alone(
+    tmp_path, songs, separations, monkeypatch
+):
+    write_stem = batch_separation._write_stem
+
+    def broken_write_stem(stem, output_path, length):
+        if output_path.parent.name == "0":
+            raise OSError("No space left on device")
+        write_stem(stem, output_path, length)
+
+    monkeypatch.setattr(batch_separation, "_write_stem", broken_write_stem)
+    results = list(
+        batch_separation.split_songs(songs[:2], tmp_path / "out", gap_seconds=0.5)
+    )
+    assert len(separations) == 1
+    assert [result.error is None for result in results] == [False, True]
+    assert "No space left" in results[0].error
+    assert results[0].accompaniment is None
+    # The song after it was still cut at the right place
+    np.testing.assert_allclose(
+        read_wav(results[1].accompaniment), read_wav(songs[1]), atol=2 / 32768
+    )
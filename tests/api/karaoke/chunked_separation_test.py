@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from karaoke import chunked_separation
+
+
+@pytest.mark.parametrize("frames", [50, 100, 171, 260, 1000, 1001])
+def test_plan_windows_covers_every_frame(frames):
+    windows = chunked_separation.plan_windows(frames, window=100, overlap=20)
+    assert windows[0][0] == 0
+    assert windows[-1][1] == frames
+    for (_, end), (start, _) in zip(windows, windows[1:]):
+        assert end - start == 20
+
+
+def test_plan_windows_extends_instead_of_short_last_window():
+    windows = chunked_separation.plan_windows(190, window=100, overlap=20)
+    assert windows == [(0, 100), (80, 190)]
+
+
+def test_plan_windows_rejects_overlap_longer_than_half_a_window():
+    with pytest.raises(ValueError):
+        chunked_separation.plan_windows(1000, window=100, overlap=60)
+
+
+def test_stitch_reproduces_unchanged_windows():
+    rng = np.random.default_rng(0)
+    song = rng.uniform(-1, 1, (1000, 2)).astype(np.float32)
+    windows = chunked_separation.plan_windows(len(song), window=300, overlap=50)
+
+    parts = (song[start:end] for start, end in windows)
+    stitched = np.concatenate(list(chunked_separation.stitch(parts, windows)))
+
+    np.testing.assert_allclose(stitched, song, atol=1e-6)
+
+
+def test_stitch_crossfades_overlap():
+    windows = [(0, 6), (2, 8)]
+    parts = [np.zeros((6, 1), np.float32), np.ones((6, 1), np.float32)]
+    stitched = np.concatenate(list(chunked_separation.stitch(parts, windows)))
+    np.testing.assert_allclose(
+        stitched[:, 0], [0, 0, 0.2, 0.4, 0.6, 0.8, 1, 1], atol=1e-6
+    )
@@ -0,0 +1,65 @@
+import os
+from pathlib import Path
+
+from karaoke.disk_cache import DiskCache, hash_file
+
+
+def write(path: Path, size: int) -> Path:
+    path.write_bytes(b"x" * size)
+    return path
+
+
+def test_put_and_fetch(tmp_path):
+    cache = DiskCache(tmp_path / "cache")
+    stem = write(tmp_path / "stem.wav", 10)
+    cache.put("key", {"accompaniment.wav": stem})
+
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    fetched = cache.fetch("key", dest)
+    assert fetched == {"accompaniment.wav": dest / "accompaniment.wav"}
+    assert fetched["accompaniment.wav"].read_bytes() == stem.read_bytes()
+    assert cache.fetch("other", dest) is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 0}
+
+
+def test_put_existing_key_keeps_first_entry(tmp_path):
+    cache = DiskCache(tmp_path / "cache")
+    cache.put("key", {"a": write(tmp_path / "first", 1)})
+    cache.put("key", {"a": write(tmp_path / "second", 2)})
+    assert (cache.get("key") / "a").stat().st_size == 1
+    assert [p.name for p in cache.root.iterdir()] == ["key"]
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(tmp_path / "cache", max_bytes=25)
+    cache.put("old", {"a": write(tmp_path / "old", 10)})
+    cache.put("used", {"a": write(tmp_path / "used", 10)})
+    os.utime(cache.root / "old", (0, 0))
+    os.utime(cache.root / "used", (1, 1))
+    cache.get("used")
+    cache.put("new", {"a": write(tmp_path / "new", 10)})
+    assert cache.get("old") is None
+    assert cache.get("used") is not None
+    assert cache.get("new") is not None
+
+
+def test_hash_file_depends_on_extra(tmp_path):
+    song = write(tmp_path / "song.mp3", 10)
+    assert hash_file(song, "a.onnx") != hash_file(song, "b.onnx")
+    assert hash_file(song, "a.onnx") == hash_file(song, "a.onnx")
+
+
+def test_ttl(tmp_path):
+    cache = DiskCache(tmp_path / "cache", ttl=60)
+    stem = write(tmp_path / "stem.wav", 10)
+    entry = cache.put("key", {"stem.wav": stem})
+    assert cache.get("key") == entry
+    dest = tmp_path / "dest"
+    dest.mkdir()
+    assert list(cache.fetch("key", dest)) == ["stem.wav"]
+
+    old = os.stat(entry / ".created").st_mtime - 120
+    os.utime(entry / ".created", (old, old))
+    assert cache.get("key") is None
+    assert not entry.exists()
@@ -0,0 +1,40 @@
+import pytest
+
+from karaoke.encode_profiles import (
+    DEFAULT_PROFILE,
+    ENCODE_PROFILES,
+    get_encode_profile,
+    get_output_targets,
+)
+
+
+def test_default_profile():
+    assert get_encode_profile() is ENCODE_PROFILES[DEFAULT_PROFILE]
+    # The same settings videos had before there were profiles
+    args = get_encode_profile().video_args()
+    assert args[args.index("-preset") + 1] == "medium"
+    assert args[args.index("-crf") + 1] == "23"
+    assert "-tune" not in args and "-g" not in args
+    assert get_encode_profile().fps == 20
+
+
+def test_unknown_profile():
+    with pytest.raises(ValueError):
+        get_encode_profile("lossless")
+
+
+def test_video_args():
+    args = get_encode_profile("fast-preview").video_args()
+    assert args[args.index("-preset") + 1] == "ultrafast"
+    assert args[args.index("-tune") + 1] == "stillimage"
+    # Keyframe interval is counted in frames
+    assert args[args.index("-g") + 1] == "100"
+
+
+def test_output_targets():
+    assert list(get_output_targets()) == ["720p"]
+    targets = get_output_targets(["mp3", "1080p", "mp3"])
+    assert list(targets) == ["mp3", "1080p"]
+    assert targets["mp3"].size is None
+    with pytest.raises(ValueError):
+        get_output_targets(["4k"])
@@ -0,0 +1,154 @@
+import io
+import time
+from pathlib import Path
+
+import pytest
+
+from karaoke import make_karaoke_video
+from karaoke.make_karaoke_video import (
+    STDERR_LINES,
+    ProcessCancelled,
+    ProcessTimedOut,
+    SubprocessLimits,
+    create_video,
+    output_filenames,
+    parse_progress,
+    read_lines,
+    render_progress_reporter,
+    subprocess_call,
+)
+
+
+def test_parse_progress():
+    output = io.BytesIO(
+        b"frame=20\nout_time_us=1000000\nspeed=2.5x\nprogress=continue\n"
+        b"frame=40\nout_time_us=N/A\nspeed=2.4x\nprogress=end\n"
+    )
+    blocks = list(parse_progress(output))
+    assert [block["frame"] for block in blocks] == ["20", "40"]
+    assert blocks[-1]["progress"] == "end"
+
+
+def test_render_progress_reporter():
+    events = []
+    report = render_progress_reporter(
+        lambda stage, **details: events.append((stage, details)), duration=4.0
+    )
+    report({"frame": "20", "out_time_us": "1000000", "speed": "2.5x"})
+    report({"frame": "40", "out_time_us": "N/A"})
+    assert events == [
+        ("render", {"frame": 20, "seconds": 1.0, "speed": "2.5x", "percent": 25.0}),
+        ("render", {"frame": 40, "seconds": 0.0, "speed": None, "percent": 0.0}),
+    ]
+
+
+def test_read_lines_splits_carriage_returns():
+    stream = io.BytesIO(b"frame=1\rframe=2\rdone\nerror: " + b"x" * 20)
+    assert list(read_lines(stream, max_length=10)) == [
+        b"frame=1",
+        b"frame=2",
+        b"done",
+        b"error: xxx",
+    ]
+
+
+def test_subprocess_call_keeps_last_stderr_lines():
+    script = f"for i in $(seq {STDERR_LINES + 50}); do echo line $i >&2; done; exit 3"
+    with pytest.raises(IOError) as error:
+        subprocess_call(["sh", "-c", script], limits=SubprocessLimits())
+    lines = str(error.value).splitlines()
+    assert len(lines) == STDERR_LINES
+    assert lines[-1] == f"line {STDERR_LINES + 50}"
+
+
+def test_subprocess_call_times_out():
+    start = time.monotonic()
+    with pytest.raises(ProcessTimedOut):
+        subprocess_call(["sleep", "30"], limits=SubprocessLimits(timeout=0.2))
+    assert time.monotonic() - start < 5
+
+
+def test_subprocess_call_cancels():
+    with pytest.raises(ProcessCancelled):
+        subprocess_call(
+            ["sleep", "30"], cancelled=lambda: True, limits=SubprocessLimits()
+        )
+
+
+def test_stuck_ffprobe_times_out(tmp_path, monkeypatch):
+    ffprobe = tmp_path / "ffprobe"
+    ffprobe.write_text("#!/bin/sh\nsleep 30\n")
+    ffprobe.chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmp_path), prepend=":")
+    monkeypatch.setattr(make_karaoke_video, "PROBE_TIMEOUT_SECONDS", 0.2)
+    start = time.monotonic()
+    with pytest.raises(ProcessTimedOut):
+        make_karaoke_video.audio_duration(tmp_path / "song.mp3")
+    assert time.monotonic() - start < 5
+
+
+def test_output_filenames():
+    assert output_filenames("Song [karaoke].mp4") == {"720p": "Song [karaoke].mp4"}
+    assert output_filenames("Song.mp4", ["720p", "1080p", "mp3"]) == {
+        "720p": "Song 720p.mp4",
+        "1080p": "Song 1080p.mp4",
+        "mp3": "Song.mp3",
+    }
+
+
+@pytest.fixture
+def commands(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        make_karaoke_video, "subprocess_call", lambda cmd, **kwargs: calls.append(cmd)
+    )
+    return calls
+
+
+def test_create_video_makes_every_target_in_one_run(commands, tmp_path):
+    paths = create_video(
+        Path("accompaniment.wav"),
+        "subtitles",
+        tmp_path,
+        Path("fonts"),
+        filename="Song.mp4",
+        audio_delay=1.5,
+        targets=["720p", "1080p", "mp3"],
+    )
+    assert paths == {
+        "720p": tmp_path / "Song 720p.mp4",
+        "1080p": tmp_path / "Song 1080p.mp4",
+        "mp3": tmp_path / "Song.mp3",
+    }
+    (cmd,) = commands
+    # The background is made at the largest size, and subtitled once
+    assert "s=1920x1080" in cmd[cmd.index("lavfi") + 2]
+    graph = cmd[cmd.index("-filter_complex") + 1].split(";")
+    assert graph[0].startswith("[0:v]ass=")
+    assert graph[0].endswith(",split=2[s0][s1]")
+    assert graph[1] == "[s0]scale=1280:720[v0]"
+    assert graph[2] == "[1:a]adelay=delays=1500:all=1,asplit=3[a0][a1][a2]"
+
+    # Each output's arguments end with its path
+    outputs = [[]]
+    for arg in cmd[cmd.index("-y") + 1 :]:
+        outputs[-1].append(arg)
+        if arg in {str(path) for path in paths.values()}:
+            outputs.append([])
+    maps = [
+        [args[i + 1] for i, arg in enumerate(args) if arg == "-map"] for args in outputs
+    ]
+    assert maps == [["[v0]", "[a0]"], ["[s1]", "[a1]"], ["[a2]"], []]
+
+
+def test_create_video_audio_only(commands, tmp_path):
+    create_video(
+        Path("accompaniment.wav"), "", tmp_path, Path("fonts"), targets=["mp3"]
+    )
+    (cmd,) = commands
+    assert "lavfi" not in cmd
+    assert (
+        cmd[cmd.index("-filter_complex") + 1]
+        == "[0:a]adelay=delays=0:all=1,asplit=1[a0]"
+    )
+    assert cmd[-1] == str(tmp_path / "karaoke.mp3")
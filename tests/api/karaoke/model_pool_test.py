@@ -0,0 +1,56 @@
+import threading
+
+from karaoke.model_pool import SeparatorPool
+
+
+def make_pool(**kwargs) -> tuple[SeparatorPool, list[str]]:
+    loads = []
+
+    def loader(model_name):
+        loads.append(model_name)
+        return object()
+
+    return SeparatorPool(loader=loader, **kwargs), loads
+
+
+def test_reuses_loaded_separator():
+    pool, loads = make_pool()
+    with pool.checkout("a.onnx") as first:
+        pass
+    with pool.checkout("a.onnx") as second:
+        pass
+    assert first is second
+    assert loads == ["a.onnx"]
+    assert pool.stats()["hits"] == 1
+
+
+def test_concurrent_checkouts_get_separate_instances():
+    pool, loads = make_pool()
+    with pool.checkout("a.onnx") as first:
+        with pool.checkout("a.onnx") as second:
+            assert first is not second
+    assert loads == ["a.onnx", "a.onnx"]
+    assert pool.stats()["idle"] == 2
+
+
+def test_memory_budget_evicts_least_recently_used():
+    pool, loads = make_pool(
+        size_estimator=lambda model_name: 100, memory_budget_bytes=150
+    )
+    with pool.checkout("a.onnx"):
+        pass
+    with pool.checkout("b.onnx"):
+        pass
+    with pool.checkout("a.onnx"):
+        pass
+    assert loads == ["a.onnx", "b.onnx", "a.onnx"]
+    assert pool.stats()["idle"] == 1
+
+
+def test_idle_timeout_evicts():
+    pool, loads = make_pool(idle_timeout=0.001)
+    with pool.checkout("a.onnx"):
+        pass
+    threading.Event().wait(0.01)
+    assert pool.evict_idle() == 1
+    assert pool.stats()["idle"] == 0
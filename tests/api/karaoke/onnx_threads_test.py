@@ -0,0 +1,32 @@
+import gc
+from types import SimpleNamespace
+
+from karaoke.onnx_threads import configure, core_blocks, reserve_cores
+
+
+def test_core_blocks_are_whole():
+    assert core_blocks([0, 1, 2, 3, 4], 2) == [[0, 1], [2, 3]]
+    assert core_blocks([0, 1], 4) == []
+
+
+def test_reserved_cores_are_freed_with_owner(tmp_path, monkeypatch):
+    monkeypatch.setattr("os.sched_getaffinity", lambda pid: {0, 1, 2, 3})
+
+    class Owner:
+        pass
+
+    first, second = Owner(), Owner()
+    assert reserve_cores(first, 2, tmp_path) == [0, 1]
+    assert reserve_cores(second, 2, tmp_path) == [2, 3]
+    assert reserve_cores(Owner(), 2, tmp_path) is None
+    del first
+    gc.collect()
+    assert reserve_cores(Owner(), 2, tmp_path) == [0, 1]
+
+
+def test_only_onnx_sessions_are_rebuilt():
+    separator = SimpleNamespace(
+        model_instance=SimpleNamespace(model_path="model.ckpt", model_run=None)
+    )
+    assert configure(separator) is None
+    assert separator.model_instance.model_run is None
@@ -0,0 +1,210 @@
+from types import SimpleNamespace
+
+import pytest
+
+from karaoke import make_karaoke_video, pipeline as pipeline_module
+from karaoke.disk_cache import DiskCache
+from karaoke.pipeline import (
+    AUDIO,
+    Artifact,
+    Pipeline,
+    artifact_id,
+    check_artifact_id,
+    output_file,
+)
+
+
+@pytest.fixture
+def pipeline(tmp_path):
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    return Pipeline(work_dir, store=DiskCache(tmp_path / "artifacts"))
+
+
+@pytest.fixture
+def encodes(monkeypatch):
+    calls = []
+
+    def encode_audio(audio_path, output_path, audio_delay=0.0, cancelled=None):
+        calls.append(audio_delay)
+        output_path.write_bytes(audio_path.read_bytes() + b" encoded")
+        return output_path
+
+    monkeypatch.setattr(make_karaoke_video, "encode_audio", encode_audio)
+    return calls
+
+
+def test_artifact_id_depends_on_inputs():
+    assert artifact_id("mux", "a", {"title": "x"}) == artifact_id(
+        "mux", "a", {"title": "x"}
+    )
+    assert artifact_id("mux", "a", {"title": "x"}) != artifact_id(
+        "mux", "a", {"title": "y"}
+    )
+    assert artifact_id("mux", "a").startswith("mux-")
+
+
+def test_check_artifact_id():
+    check_artifact_id(artifact_id("separate", "a"), "separate")
+    with pytest.raises(ValueError):
+        check_artifact_id(artifact_id("mux", "a"), "separate")
+    with pytest.raises(ValueError):
+        check_artifact_id("separate-../../etc", "separate")
+
+
+def test_ingest_is_content_addressed(pipeline, tmp_path):
+    first = tmp_path / "first.wav"
+    second = tmp_path / "second.wav"
+    first.write_bytes(b"song")
+    second.write_bytes(b"song")
+    assert pipeline.ingest(first).id == pipeline.ingest(second).id
+
+
+def test_stage_output_is_reused(pipeline, tmp_path, encodes):
+    accompaniment = tmp_path / "accompaniment.wav"
+    accompaniment.write_bytes(b"music")
+    separation = Artifact("separate-" + "0" * 64, {"accompaniment.wav": accompaniment})
+
+    audio = pipeline.encode_audio(separation, audio_delay=1.0)
+    again = pipeline.encode_audio(separation, audio_delay=1.0)
+    assert again.id == audio.id
+    assert again.files[AUDIO].read_bytes() == b"music encoded"
+    assert encodes == [1.0]
+
+    # A different delay is a different input, so the stage runs again
+    assert pipeline.encode_audio(separation, audio_delay=2.0).id != audio.id
+    assert encodes == [1.0, 2.0]
+
+
+def test_encoded_audio_is_stored_by_contents(pipeline, tmp_path, encodes):
+    first = tmp_path / "first.wav"
+    second = tmp_path / "second.wav"
+    first.write_bytes(b"music")
+    second.write_bytes(b"music")
+    separation = Artifact("separate-" + "0" * 64, {"accompaniment.wav": first})
+
+    audio = pipeline.encode_audio(separation, audio_delay=1.0)
+    assert pipeline.encode_accompaniment(second, audio_delay=1.0).id == audio.id
+    assert encodes == [1.0]
+
+
+def test_load(pipeline, tmp_path, encodes):
+    accompaniment = tmp_path / "accompaniment.wav"
+    accompaniment.write_bytes(b"music")
+    separation = Artifact("separate-" + "0" * 64, {"accompaniment.wav": accompaniment})
+    audio = pipeline.encode_audio(separation)
+
+    loaded = pipeline.load(audio.id, "encode_audio")
+    assert loaded.files[AUDIO].read_bytes() == b"music encoded"
+    assert pipeline.load(artifact_id("encode_audio", "missing"), "encode_audio") is None
+
+
+def test_turned_off_store_runs_every_stage(tmp_path, encodes, monkeypatch):
+    monkeypatch.setattr(
+        pipeline_module, "settings", SimpleNamespace(ARTIFACTS_MAX_MB=0)
+    )
+    monkeypatch.setattr(pipeline_module, "_artifact_store", None)
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    pipeline = Pipeline(work_dir)
+    accompaniment = tmp_path / "accompaniment.wav"
+    accompaniment.write_bytes(b"music")
+    separation = Artifact("separate-" + "0" * 64, {"accompaniment.wav": accompaniment})
+
+    audio = pipeline.encode_audio(separation)
+    assert pipeline.encode_audio(separation).id == audio.id
+    assert encodes == [0.0, 0.0]
+    assert pipeline.load(audio.id, "encode_audio") is None
+    assert not pipeline_module.artifact_exists(audio.id, "encode_audio")
+
+
+def test_cancelled_pipeline_starts_no_stage(tmp_path, encodes):
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    pipeline = Pipeline(
+        work_dir, store=DiskCache(tmp_path / "artifacts"), cancelled=lambda: True
+    )
+    accompaniment = tmp_path / "accompaniment.wav"
+    accompaniment.write_bytes(b"music")
+    separation = Artifact("separate-" + "0" * 64, {"accompaniment.wav": accompaniment})
+    with pytest.raises(make_karaoke_video.ProcessCancelled):
+        pipeline.encode_audio(separation)
+    assert encodes == []
+
+
+def test_render_targets_burn_subtitles_once(pipeline, tmp_path, encodes, monkeypatch):
+    burns = []
+    muxes = []
+
+    def burn_subtitles(subtitles, outputs, duration, fonts_dir, **kwargs):
+        burns.append(list(outputs.values()))
+        for path in outputs:
+            path.write_bytes(b"video")
+        return list(outputs)
+
+    def mux(video_path, audio_path, output_path, metadata={}, cancelled=None):
+        muxes.append(video_path.name if video_path else None)
+        output_path.write_bytes(audio_path.read_bytes())
+        return output_path
+
+    # Stands in for Django settings, for the fonts dir
+    monkeypatch.setattr(pipeline_module, "settings", SimpleNamespace(BASE_DIR=tmp_path))
+    monkeypatch.setattr(make_karaoke_video, "audio_duration", lambda path: 10.0)
+    monkeypatch.setattr(make_karaoke_video, "burn_subtitles", burn_subtitles)
+    monkeypatch.setattr(make_karaoke_video, "mux", mux)
+    accompaniment = tmp_path / "accompaniment.wav"
+    accompaniment.write_bytes(b"music")
+    separation = Artifact("separate-" + "0" * 64, {"accompaniment.wav": accompaniment})
+
+    rendered = pipeline.render(
+        separation, "subtitles", targets=["1080p", "mp3", "720p"]
+    )
+    assert burns == [[(1920, 1080), (1280, 720)]]
+    assert encodes == [0.0]
+    assert muxes == ["video-1080p.mp4", None, "video-720p.mp4"]
+    assert rendered.files[output_file("mp3")].read_bytes() == b"music encoded"
+    assert set(rendered.files) == {
+        "karaoke-1080p.mp4",
+        "karaoke-mp3.mp3",
+        "karaoke-720p.mp4",
+    }
+
+
+def test_rerender_reuses_encoded_audio(tmp_path, encodes, monkeypatch):
+    burns = []
+
+    def burn_subtitles(subtitles, outputs, duration, fonts_dir, **kwargs):
+        burns.append(subtitles)
+        for path in outputs:
+            path.write_bytes(b"video")
+        return list(outputs)
+
+    def mux(video_path, audio_path, output_path, metadata={}, cancelled=None):
+        output_path.write_bytes(audio_path.read_bytes())
+        return output_path
+
+    monkeypatch.setattr(pipeline_module, "settings", SimpleNamespace(BASE_DIR=tmp_path))
+    monkeypatch.setattr(make_karaoke_video, "audio_duration", lambda path: 10.0)
+    monkeypatch.setattr(make_karaoke_video, "burn_subtitles", burn_subtitles)
+    monkeypatch.setattr(make_karaoke_video, "mux", mux)
+    accompaniment = tmp_path / "accompaniment.wav"
+    accompaniment.write_bytes(b"music")
+    store = DiskCache(tmp_path / "artifacts")
+    separation_id = "separate-" + "0" * 64
+    store.put(separation_id, {"accompaniment.wav": accompaniment})
+
+    # As GenerateVideo renders the same separation after the lyrics change
+    for subtitles in ["first", "second"]:
+        output_dir = tmp_path / subtitles
+        output_dir.mkdir()
+        outputs = make_karaoke_video.run(
+            None,
+            subtitles,
+            audio_delay=1.5,
+            separation_id=separation_id,
+            output_dir=output_dir,
+            store=store,
+        )
+        assert outputs["720p"].read_bytes() == b"music encoded"
+    assert burns == ["first", "second"]
+    assert encodes == [1.5]
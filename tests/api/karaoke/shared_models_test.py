@@ -0,0 +1,89 @@
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+from karaoke import music_separation, shared_models
+
+
+class FakeOptions:
+    def __init__(self):
+        self.entries = {}
+
+    def add_session_config_entry(self, key, value):
+        self.entries[key] = value
+
+
+def test_sessions_run_off_preloaded_ort_models(tmp_path, monkeypatch):
+    monkeypatch.setattr(music_separation, "MODELS_DIR", tmp_path)
+    monkeypatch.setattr(shared_models, "_preloaded", {})
+    (tmp_path / "shared.onnx").write_bytes(b"onnx")
+    (tmp_path / "shared.ort").write_bytes(b"ort model")
+    (tmp_path / "own.onnx").write_bytes(b"onnx")
+
+    assert shared_models.preload(["shared.onnx", "own.onnx"]) == len(b"ort model")
+
+    options = FakeOptions()
+    assert (
+        shared_models.session_source(str(tmp_path / "shared.onnx"), options)
+        == b"ort model"
+    )
+    assert options.entries["session.use_ort_model_bytes_directly"] == "1"
+    options = FakeOptions()
+    assert shared_models.session_source(str(tmp_path / "own.onnx"), options) == str(
+        tmp_path / "own.onnx"
+    )
+    assert not options.entries
+
+
+def test_memory_usage():
+    usage = shared_models.memory_usage()
+    assert 0 < usage["pss"] <= usage["rss"]
+    assert usage["shared"] <= usage["rss"]
+
+
+def test_deferred_sessions_are_built_when_used():
+    built = []
+
+    class FakeSession:
+        def __init__(self, path, sess_options=None):
+            built.append(path)
+
+        def run(self):
+            return "ran"
+
+    session = shared_models._DeferredSession(
+        FakeSession, "model.onnx", sess_options=None
+    )
+    assert not built
+    assert session.run() == "ran"
+    assert session.run() == "ran"
+    assert built == ["model.onnx"]
+
+
+def test_convert_to_ort_publishes_whole_files(tmp_path, monkeypatch):
+    part_paths = []
+
+    class SessionOptions(FakeOptions):
+        optimized_model_filepath = None
+
+    def InferenceSession(model_path, sess_options, providers):
+        part_paths.append(sess_options.optimized_model_filepath)
+        Path(sess_options.optimized_model_filepath).write_bytes(b"ort model")
+
+    fake_ort = SimpleNamespace(
+        SessionOptions=SessionOptions,
+        InferenceSession=InferenceSession,
+        GraphOptimizationLevel=SimpleNamespace(ORT_ENABLE_EXTENDED=2),
+    )
+    monkeypatch.setitem(sys.modules, "onnxruntime", fake_ort)
+    model_path = tmp_path / "model.onnx"
+    model_path.write_bytes(b"onnx")
+
+    assert shared_models.convert_to_ort(model_path).read_bytes() == b"ort model"
+    shared_models.convert_to_ort(model_path)
+    # Each conversion wrote its own temporary file
+    assert len(set(part_paths)) == 2
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "model.onnx",
+        "model.ort",
+    ]
@@ -0,0 +1,138 @@
+import time
+
+import numpy as np
+import pytest
+
+from karaoke import subtitles
+from karaoke.subtitles import SEGMENT_END, SEGMENT_START, KaraokeOptions
+
+LYRICS = "Be bop_a lu bop\nShe's my ba/by\n\nAnd_here's_screen_two"
+EVENTS = [[1.0, SEGMENT_START], [2.0, SEGMENT_END]] + [
+    [t, SEGMENT_START] for t in (3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0)
+]
+
+PREAMBLE = """[Script Info]
+; Script generated by The Tüül - https://the-tuul.com
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Arial Narrow,20,&H00FF00FF,&H00FFFF00,&H00000000,&H00000000,-1,0,0,0,100,100,0,0,1,1,0,8,0,0,0,0
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+Dialogue: 0,0:00:00.00,0:00:04.00,Default,Singer,0,0,130,,{\\k0}{\\kf200}It's Cøøl to Tüül
+Dialogue: 0,0:00:00.00,0:00:04.00,Default,Singer,0,0,160,,{\\k200}{\\kf200}TÜ/ÜL
+"""
+
+PLAIN = KaraokeOptions(add_instrumental_screens=False, add_staggered_lines=False)
+
+
+def test_parse_segments():
+    segments = subtitles.parse_segments(LYRICS)
+    assert segments == [
+        "Be bop ",
+        "a lu bop\n",
+        "She's my ba",
+        "by\n\n",
+        "And ",
+        "here's ",
+        "screen ",
+        "two",
+    ]
+    assert subtitles.parse_segments("a//b") == ["a", "", "b"]
+
+
+def test_short_intro_delays_the_audio():
+    layout = subtitles.create_layout(
+        LYRICS, EVENTS, 60.0, "It's Cøøl to Tüül", "TÜ/ÜL", PLAIN
+    )
+    # One second to count in, then the title screen
+    assert layout.audio_delay == 5.0
+    assert layout.to_ass() == PREAMBLE + (
+        "Dialogue: 0,0:00:04.00,0:00:11.00,Default,Singer,0,0,130,,{\\k0}{\\kf200}*** {\\kf100}Be bop {\\kf100}{\\kf100}a lu bop\n\n"
+        "Dialogue: 0,0:00:04.00,0:00:11.00,Default,Singer,0,0,160,,{\\k500}{\\kf100}She's my ba{\\kf100}by\n\n\n"
+        "Dialogue: 0,0:00:11.00,0:01:05.00,Default,Singer,0,0,145,,{\\k0}{\\kf100}And {\\kf100}here's {\\kf100}screen {\\kf5100}two\n"
+    )
+
+
+def test_long_intro_counts_in():
+    lyrics = "That was a long intro\nToo bad nothing rhymes with intro"
+    events = [[100.0, SEGMENT_START], [105.0, SEGMENT_START]]
+    layout = subtitles.create_layout(
+        lyrics, events, 60.0, "It's Cøøl to Tüül", "TÜ/ÜL", PLAIN
+    )
+    assert layout.audio_delay == 0.0
+    assert layout.to_ass() == PREAMBLE + (
+        "Dialogue: 0,0:00:04.00,0:01:00.00,Default,Singer,0,0,130,,{\\k9400}{\\kf200}*** {\\kf500}That was a long intro\n\n"
+        "Dialogue: 0,0:00:04.00,0:01:00.00,Default,Singer,0,0,160,,{\\k10100}{\\kf-4500}Too bad nothing rhymes with intro\n"
+    )
+
+
+def test_staggered_lines_and_instrumental_screens():
+    events = [[t, SEGMENT_START] for t in (10.0, 11.0, 12.0, 13.0)]
+    events += [[14.0, SEGMENT_END], [30.0, SEGMENT_START]]
+    ass = subtitles.create_ass_file(
+        "a\nb\n\nc\nd\n\ne", events, 40.0, "Title", "Artist", KaraokeOptions()
+    )
+    assert ass.split("\n")[-13:] == [
+        # The first line goes as the next one is half sung...
+        "Dialogue: 0,0:00:04.00,0:00:11.50,Default,Singer,0,0,130,,{\\fad(0,125)}{\\k400}{\\kf200}*** {\\kf100}a",
+        "",
+        "Dialogue: 0,0:00:04.00,0:00:12.00,Default,Singer,0,0,160,,{\\k700}{\\kf100}b",
+        "",
+        "",
+        # ...and the next screen's first line takes its place
+        "Dialogue: 0,0:00:11.75,0:00:14.00,Default,Singer,0,0,130,,{\\fad(125,0)}{\\k25}{\\kf100}c",
+        "",
+        "Dialogue: 0,0:00:12.00,0:00:14.00,Default,Singer,0,0,160,,{\\k100}{\\kf100}d",
+        "",
+        "",
+        "Dialogue: 0,0:00:14.00,0:00:28.00,Default,Singer,0,0,145,,{\\k0}{\\kf1400}"
+        + subtitles.INSTRUMENTAL_TEXT,
+        "Dialogue: 0,0:00:28.00,0:00:40.00,Default,Singer,0,0,145,,{\\k0}{\\kf200}*** {\\kf1000}e",
+        "",
+    ]
+
+
+def test_options_from_the_frontend():
+    options = KaraokeOptions.from_dict(
+        {
+            "addCountIns": False,
+            "verticalAlignment": 0,
+            "font": {"size": 24, "name": "Verdana"},
+            "color": {
+                "primary": "#102030",
+                "secondary": {"red": 1, "green": 2, "blue": 3},
+            },
+        }
+    )
+    assert options.vertical_alignment == subtitles.VerticalAlignment.TOP
+    assert options.primary_color == (16, 32, 48)
+    assert options.secondary_color == (1, 2, 3)
+    assert options.add_instrumental_screens
+
+
+def test_timecodes():
+    assert subtitles.timecodes(np.array([0, 25.42, 60, 3725.999])) == [
+        "0:00:00.00",
+        "0:00:25.42",
+        "0:01:00.00",
+        "1:02:05.00",
+    ]
+
+
+def test_thousands_of_lines_are_quick():
+    lines = 5000
+    lyrics = "\n\n".join("one_two_three\nfour/five" for _ in range(lines // 2))
+    events = [[1.5 + i * 0.5, SEGMENT_START] for i in range(lines // 2 * 5)]
+    start = time.perf_counter()
+    ass = subtitles.create_ass_file(
+        lyrics, events, 10000.0, "Title", "Artist", KaraokeOptions()
+    )
+    assert time.perf_counter() - start < 1
+    assert ass.count("Dialogue:") == lines + 2
+
+
+def test_malformed_timings():
+    with pytest.raises(ValueError):
+        subtitles.compile_timings("La la", {"a": 1}, 10.0, "", "", KaraokeOptions())
@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+from karaoke import music_separation, shared_models, warmup
+
+
+@pytest.fixture
+def models_dir(tmp_path):
+    (tmp_path / "good.onnx").write_bytes(b"model weights" * 100)
+    (tmp_path / warmup.DOWNLOAD_CHECKS).write_text(
+        json.dumps(
+            {
+                "mdx_download_list": {"MDX Good": "good.onnx", "MDX Bad": "bad.onnx"},
+                "vr_download_list": {"VR": "vr.pth"},
+            }
+        )
+    )
+    (tmp_path / warmup.MODEL_DATA).write_text(
+        json.dumps(
+            {warmup.model_hash(tmp_path / "good.onnx"): {"primary_stem": "Vocals"}}
+        )
+    )
+    return tmp_path
+
+
+def test_model_hash_covers_only_the_end_of_large_files(tmp_path):
+    a = tmp_path / "a.onnx"
+    b = tmp_path / "b.onnx"
+    tail = b"x" * 10000 * 1024
+    a.write_bytes(b"first" + tail)
+    b.write_bytes(b"other" + tail)
+    assert warmup.model_hash(a) == warmup.model_hash(b)
+
+
+def test_verify_model(models_dir):
+    warmup.verify_model(models_dir / "good.onnx")
+    (models_dir / "bad.onnx").write_bytes(b"truncated")
+    with pytest.raises(warmup.ModelError, match="hash"):
+        warmup.verify_model(models_dir / "bad.onnx")
+    with pytest.raises(warmup.ModelError, match="download_checks"):
+        warmup.verify_model(models_dir / "vr.pth")
+
+
+def test_readiness(models_dir, monkeypatch):
+    monkeypatch.setattr(music_separation, "MODELS_DIR", models_dir)
+    monkeypatch.setattr(warmup, "_status", {"state": warmup.IDLE, "models": {}})
+    monkeypatch.setattr(warmup, "warm_up", lambda model_name: 1.5)
+    monkeypatch.setattr(
+        shared_models,
+        "convert_to_ort",
+        lambda model_path: shared_models.ort_path(model_path).write_bytes(b"ort"),
+    )
+    assert warmup.readiness()["ready"]
+
+    assert not warmup.prepare_models(["good.onnx", "bad.onnx"], fetch=False)
+    readiness = warmup.readiness()
+    assert not readiness["ready"]
+    assert readiness["models"]["good.onnx"] == {
+        "verified": True,
+        "ortCopy": True,
+        "warmUpSeconds": 1.5,
+    }
+    assert (models_dir / "good.ort").read_bytes() == b"ort"
+    assert "downloaded" in readiness["models"]["bad.onnx"]["error"]
+
+    assert warmup.prepare_models(["good.onnx"], fetch=False)
+    assert warmup.readiness()["state"] == warmup.READY
+
+
+def test_ready_once_default_model_is(models_dir, monkeypatch):
+    monkeypatch.setattr(music_separation, "MODELS_DIR", models_dir)
+    monkeypatch.setattr(music_separation, "DEFAULT_MODEL", "good.onnx")
+    monkeypatch.setattr(warmup, "_status", {"state": warmup.IDLE, "models": {}})
+    monkeypatch.setattr(warmup, "warm_up", lambda model_name: 1.5)
+    states = []
+    monkeypatch.setattr(
+        shared_models,
+        "convert_to_ort",
+        lambda model_path: states.append(warmup.readiness()["ready"]),
+    )
+
+    assert not warmup.prepare_models(["bad.onnx", "good.onnx"], fetch=False)
+    # The default model went first, before the other failed
+    assert states == [False]
+    readiness = warmup.readiness()
+    assert readiness["state"] == warmup.FAILED
+    assert readiness["ready"]
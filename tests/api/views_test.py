@@ -0,0 +1,46 @@
+import json
+import os
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def client():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+    import django
+    from django.test import Client
+
+    django.setup()
+    return Client()
+
+
+@pytest.mark.parametrize(
+    "timings",
+    [
+        {"a": 1},
+        [["soon", 1]],
+        [[1.0]],
+        [[1.0, {"marker": 1}]],
+        "not a list",
+    ],
+)
+def test_malformed_timings_are_rejected(client, timings):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    response = client.post(
+        "/generate_video",
+        {
+            "songFile": SimpleUploadedFile("song.mp3", b"audio"),
+            "lyrics": "La la la",
+            "timings": json.dumps(timings),
+        },
+    )
+    assert response.status_code == 400
+    assert "timings" in response.json()["error"]
+
+
+def test_youtube_download_job_needs_a_url(client):
+    response = client.post("/jobs/download_video", {"mode": "480p"})
+    assert response.status_code == 400
+    response = client.post("/jobs/download_video", {"url": "x", "mode": "huge"})
+    assert response.status_code == 400